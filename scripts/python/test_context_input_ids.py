@@ -0,0 +1,115 @@
+#!/usr/bin/env python3
+"""
+Tests for fitting text-generation prompts into the context window (build_context_input_ids in run_hf_model.py).
+Uses a word-level stand-in tokenizer, so no model download is needed. Runs standalone or under pytest.
+"""
+import os
+import re
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "..", "src", "CSimple", "Scripts"))
+
+import run_hf_model
+
+
+class WordTokenizer:
+    """One token per word or newline; add_special_tokens prepends a BOS id of 0"""
+
+    def __init__(self):
+        self.vocab = {}
+        self.calls = 0
+
+    def __call__(self, text, add_special_tokens=True):
+        self.calls += 1
+        ids = [self.vocab.setdefault(token, len(self.vocab) + 1) for token in re.findall(r"\S+|\n", text)]
+        return {"input_ids": ([0] if add_special_tokens else []) + ids}
+
+    def words(self, ids):
+        lookup = {token_id: token for token, token_id in self.vocab.items()}
+        return [lookup.get(token_id, "<s>") for token_id in ids]
+
+
+def section(name, count):
+    return f"[{name}]: " + " ".join(f"{name.lower()}{index}" for index in range(count))
+
+
+def test_fitting_prompt_is_verbatim():
+    """A prompt within the budget is tokenized exactly as given"""
+    tokenizer = WordTokenizer()
+    text = section("Goal", 5) + "\n" + section("Plan", 5)
+    ids = run_hf_model.build_context_input_ids("test:verbatim", tokenizer, text, 100)
+    assert ids == tokenizer(text)["input_ids"]
+
+
+def test_middle_sections_are_summarized():
+    """Older middle sections shrink to their opening tokens; the first and last sections stay whole"""
+    tokenizer = WordTokenizer()
+    summary = run_hf_model._summary_tokens_per_section
+    text = "\n".join([section("Goal", 4), section("Old", summary * 3), section("Latest", 6)])
+    ids = run_hf_model.build_context_input_ids("test:summarize", tokenizer, text, summary + 20)
+    words = tokenizer.words(ids)
+    assert len(ids) <= summary + 20
+    assert words[:2] == ["<s>", "[Goal]:"]
+    assert words[-7:] == section("Latest", 6).split()
+    assert "..." in words and "old0" in words and f"old{summary * 2}" not in words
+
+
+def test_middle_sections_are_dropped_oldest_first():
+    """When summaries are not enough, the oldest middle sections go first"""
+    tokenizer = WordTokenizer()
+    summary = run_hf_model._summary_tokens_per_section
+    text = "\n".join([section("Goal", 4), section("Older", summary * 2), section("Newer", summary * 2), section("Latest", 6)])
+    ids = run_hf_model.build_context_input_ids("test:drop", tokenizer, text, summary + 20)
+    words = tokenizer.words(ids)
+    assert len(ids) <= summary + 20
+    assert "older0" not in words and "newer0" in words
+    assert words[-7:] == section("Latest", 6).split()
+
+
+def test_single_section_keeps_head_and_tail():
+    """A single overflowing section keeps its head and tail tokens around an ellipsis"""
+    tokenizer = WordTokenizer()
+    text = " ".join(f"word{index}" for index in range(500))
+    ids = run_hf_model.build_context_input_ids("test:truncate", tokenizer, text, 101)
+    words = tokenizer.words(ids)
+    assert len(ids) == 101
+    assert words[:3] == ["<s>", "word0", "word1"]
+    assert words[-1] == "word499" and "..." in words
+
+
+def test_section_tokens_are_cached():
+    """Re-fitting a prompt reuses the cached token ids of its sections"""
+    tokenizer = WordTokenizer()
+    text = "\n".join([section("Goal", 4), section("Old", 80), section("Latest", 6)])
+    first = run_hf_model.build_context_input_ids("test:cache", tokenizer, text, 40)
+    calls = tokenizer.calls
+    second = run_hf_model.build_context_input_ids("test:cache", tokenizer, text, 40)
+    assert first == second
+    # Only the verbatim attempt and the special-token probe are tokenized again
+    assert tokenizer.calls - calls == 2
+
+
+def main():
+    print("Context Input Tests")
+    print("=" * 40)
+    tests = [test_fitting_prompt_is_verbatim, test_middle_sections_are_summarized,
+             test_middle_sections_are_dropped_oldest_first, test_single_section_keeps_head_and_tail,
+             test_section_tokens_are_cached]
+    failures = 0
+    for test in tests:
+        try:
+            test()
+            print(f"✓ {test.__name__}")
+        except AssertionError as e:
+            print(f"✗ {test.__name__}: {e}")
+            failures += 1
+
+    print()
+    if failures:
+        print(f"❌ {failures} test(s) failed.")
+        return 1
+    print("🎉 All tests passed!")
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
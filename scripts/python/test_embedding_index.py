@@ -0,0 +1,139 @@
+#!/usr/bin/env python3
+"""
+Tests for the memory-mapped embedding index (EmbeddingIndex in embedding_index.py).
+Indexes are created in temporary directories from random vectors. Runs standalone or under pytest.
+"""
+import os
+import sys
+import shutil
+import tempfile
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "..", "src", "CSimple", "Scripts"))
+
+import numpy as np
+import embedding_index
+from embedding_index import EmbeddingIndex, normalize_vectors
+
+
+def clustered_vectors(count, dimension=32, clusters=40, seed=0):
+    """Unit vectors scattered around random cluster centers, like embeddings of similar frames"""
+    rng = np.random.default_rng(seed)
+    centers = rng.normal(size=(clusters, dimension))
+    return normalize_vectors(centers[rng.integers(0, clusters, count)] + 0.3 * rng.normal(size=(count, dimension)))
+
+
+def with_index_dir(test):
+    """Run a test with a fresh index directory, removed afterwards"""
+    def run():
+        path = tempfile.mkdtemp(prefix="csimple_embedding_index_")
+        try:
+            test(path)
+        finally:
+            shutil.rmtree(path, ignore_errors=True)
+    run.__name__ = test.__name__
+    run.__doc__ = test.__doc__
+    return run
+
+
+@with_index_dir
+def test_exact_search_matches_brute_force(path):
+    """Exact search returns the same neighbours as a float32 brute-force scan"""
+    vectors = clustered_vectors(500)
+    index = EmbeddingIndex(path, dimension=32, model_id="test-model")
+    index.add(vectors, [f"frame_{i}.png" for i in range(500)])
+    query = clustered_vectors(1, seed=1)[0]
+    expected = np.argsort(-(vectors @ query))[:5]
+    results = index.search(query, top_k=5, exact=True)
+    assert [vector_id for vector_id, _ in results] == expected.tolist()
+    assert all(abs(score - float(vectors[i] @ query)) < 1e-2 for i, score in results)
+    assert index.search(vectors[42], top_k=1)[0][0] == 42
+    assert index.search(query, top_k=0) == []
+
+
+@with_index_dir
+def test_index_grows_and_reopens(path):
+    """Vectors and items survive growing past the initial capacity and reopening from disk"""
+    vectors = clustered_vectors(embedding_index._initial_capacity + 300, seed=2)
+    index = EmbeddingIndex(path, dimension=32, model_id="test-model")
+    index.add(vectors[:700], [f"item {i}" for i in range(700)])
+    ids = index.add(vectors[700:], [f"item {i}" for i in range(700, len(vectors))], [{"step": i} for i in range(700, len(vectors))])
+    assert ids == list(range(700, len(vectors)))
+
+    reopened = EmbeddingIndex(path)
+    assert len(reopened) == len(vectors) and reopened.dimension == 32
+    assert reopened.search(vectors[10], top_k=1, exact=True)[0][0] == 10
+    assert reopened.search(vectors[-1], top_k=1, exact=True)[0][0] == len(vectors) - 1
+    record = reopened.get_item(len(vectors) - 1)
+    assert record["item"] == f"item {len(vectors) - 1}" and record["metadata"] == {"step": len(vectors) - 1}
+
+
+@with_index_dir
+def test_mismatches_are_rejected(path):
+    """Opening an index with another dimension or model, or adding malformed input, raises ValueError"""
+    index = EmbeddingIndex(path, dimension=32, model_id="test-model")
+    for call in (lambda: EmbeddingIndex(path, dimension=64),
+                 lambda: EmbeddingIndex(path, model_id="other-model"),
+                 lambda: EmbeddingIndex(os.path.join(path, "missing")),
+                 lambda: index.add(np.ones((2, 16)), ["a", "b"]),
+                 lambda: index.add(np.ones((2, 32)), ["a"])):
+        try:
+            call()
+        except ValueError:
+            continue
+        raise AssertionError("expected ValueError")
+
+
+@with_index_dir
+def test_ivf_search_recall(path):
+    """A large index builds IVF lists on first search and still finds most exact neighbours"""
+    count = embedding_index._ivf_min_vectors + 1000
+    vectors = clustered_vectors(count, seed=3)
+    index = EmbeddingIndex(path, dimension=32)
+    index.add(vectors, [str(i) for i in range(count)])
+    queries = clustered_vectors(20, seed=4)
+    found = 0
+    for query in queries:
+        approximate = {vector_id for vector_id, _ in index.search(query, top_k=10)}
+        exact = {vector_id for vector_id, _ in index.search(query, top_k=10, exact=True)}
+        found += len(approximate & exact)
+    assert index.header["ivf_count"] == count
+    assert found / (10 * len(queries)) >= 0.9
+
+
+@with_index_dir
+def test_vectors_added_after_ivf_build_are_found(path):
+    """Vectors added since the last IVF build are scanned without a rebuild"""
+    count = embedding_index._ivf_min_vectors
+    index = EmbeddingIndex(path, dimension=32)
+    index.add(clustered_vectors(count, seed=5), [str(i) for i in range(count)])
+    index.build_ivf()
+    outlier = np.zeros(32)
+    outlier[0] = 1.0
+    new_id = index.add(outlier[None, :], ["new frame"])[0]
+    assert index.search(outlier, top_k=1)[0][0] == new_id
+    assert index.header["ivf_count"] == count
+
+
+def main():
+    print("Embedding Index Tests")
+    print("=" * 40)
+    tests = [test_exact_search_matches_brute_force, test_index_grows_and_reopens, test_mismatches_are_rejected,
+             test_ivf_search_recall, test_vectors_added_after_ivf_build_are_found]
+    failures = 0
+    for test in tests:
+        try:
+            test()
+            print(f"✓ {test.__name__}")
+        except AssertionError as e:
+            print(f"✗ {test.__name__}: {e}")
+            failures += 1
+
+    print()
+    if failures:
+        print(f"❌ {failures} test(s) failed.")
+        return 1
+    print("🎉 All tests passed!")
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,122 @@
+#!/usr/bin/env python3
+"""
+Tests for result envelopes and error classification (classify_error, run_model_with_envelope in run_hf_model.py).
+The model runner is replaced by stand-ins, so no model is loaded. Runs standalone or under pytest.
+"""
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "..", "src", "CSimple", "Scripts"))
+
+import run_hf_model
+
+
+def test_messages_are_classified():
+    """Runner error messages map to their error class"""
+    cases = {
+        "CUDA out of memory. Tried to allocate 2.00 GiB": "out_of_memory",
+        "Insufficient GPU memory for model": "out_of_memory",
+        "No module named 'timm'": "missing_dependency",
+        "Failed to install soundfile": "missing_dependency",
+        "Empty input provided": "invalid_input",
+        "No valid image files found in input": "invalid_input",
+        "Failed to load model gpt2: config.json missing": "model_load",
+        "Model type 'foo' is not supported": "model_load",
+        "Request timed out after 30s": "timeout",
+        "index out of range in self": "inference",
+    }
+    for message, error_class in cases.items():
+        assert run_hf_model.classify_error(message) == error_class, message
+
+
+def test_first_matching_class_wins():
+    """A message matching several classes gets the first one in _error_classes"""
+    assert run_hf_model.classify_error("Failed to load model: CUDA out of memory") == "out_of_memory"
+
+
+def run_envelope(runner):
+    """run_model_with_envelope with run_model replaced by runner"""
+    original = run_hf_model.run_model
+    run_hf_model.run_model = runner
+    try:
+        return run_hf_model.run_model_with_envelope("gpt2", "hello", {})
+    finally:
+        run_hf_model.run_model = original
+
+
+def test_error_result_envelope():
+    """An "ERROR: " result becomes an error envelope with its class and memory figures"""
+    envelope = run_envelope(lambda model_id, input_text, params, local_model_path: "ERROR: CUDA out of memory")
+    assert envelope["status"] == "error"
+    assert envelope["error"] == "CUDA out of memory"
+    assert envelope["error_class"] == "out_of_memory"
+    assert "total" in envelope["timings_ms"]
+    assert "rss_mb" in envelope and "rss_delta_mb" in envelope and "peak_rss_mb" in envelope
+
+
+def test_exception_envelope():
+    """An exception escaping the runner is classified like a returned error and names its type separately"""
+    def runner(model_id, input_text, params, local_model_path):
+        raise KeyError("logits")
+    envelope = run_envelope(runner)
+    assert envelope["status"] == "error"
+    assert envelope["error_class"] == "inference"
+    assert envelope["exception_type"] == "KeyError"
+
+
+def test_exception_type_is_classified():
+    """The exception type takes part in classification, so an OutOfMemoryError is out_of_memory"""
+    class OutOfMemoryError(RuntimeError):
+        pass
+
+    def runner(model_id, input_text, params, local_model_path):
+        raise OutOfMemoryError("Tried to allocate 2.00 GiB")
+    envelope = run_envelope(runner)
+    assert envelope["error_class"] == "out_of_memory"
+    assert envelope["exception_type"] == "OutOfMemoryError"
+
+
+def test_peak_rss_covers_freed_buffers():
+    """A buffer allocated and freed during the request still shows up in peak_rss_mb"""
+    def runner(model_id, input_text, params, local_model_path):
+        buffer = b"\x01" * (128 * 1024 * 1024)
+        time.sleep(0.2)
+        del buffer
+        return "done"
+    envelope = run_envelope(runner)
+    assert envelope["peak_rss_mb"] is not None
+    assert envelope["peak_rss_mb"] - envelope["rss_mb"] >= 64
+
+
+def test_ok_envelope():
+    """A successful result has no error fields"""
+    envelope = run_envelope(lambda model_id, input_text, params, local_model_path: "  a caption \n")
+    assert envelope["status"] == "ok" and envelope["output"] == "a caption"
+    assert "error" not in envelope and "error_class" not in envelope and "exception_type" not in envelope
+
+
+def main():
+    print("Error Classification Tests")
+    print("=" * 40)
+    tests = [test_messages_are_classified, test_first_matching_class_wins, test_error_result_envelope,
+             test_exception_envelope, test_exception_type_is_classified, test_peak_rss_covers_freed_buffers,
+             test_ok_envelope]
+    failures = 0
+    for test in tests:
+        try:
+            test()
+            print(f"✓ {test.__name__}")
+        except AssertionError as e:
+            print(f"✗ {test.__name__}: {e}")
+            failures += 1
+
+    print()
+    if failures:
+        print(f"❌ {failures} test(s) failed.")
+        return 1
+    print("🎉 All tests passed!")
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,128 @@
+#!/usr/bin/env python3
+"""
+Tests for the perceptual-hash frame index (compute_dhash, dhash_distance, find/remember_frame_result in run_hf_model.py).
+Frames are generated with Pillow in a temporary state directory. Runs standalone or under pytest.
+"""
+import os
+import sys
+import shutil
+import tempfile
+import subprocess
+
+SCRIPTS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "..", "src", "CSimple", "Scripts")
+sys.path.insert(0, SCRIPTS_DIR)
+
+from PIL import Image, ImageDraw
+import run_hf_model
+
+STATE_DIR = tempfile.mkdtemp(prefix="csimple_frame_index_")
+run_hf_model._resource_dir_overrides["state"] = STATE_DIR
+run_hf_model._resource_dir_cache.pop("state", None)
+
+PARAMS = {"phash_threshold": 0, "max_length": 50}
+
+
+def make_frame(name, marker=None):
+    """A 640x480 gradient 'screenshot', optionally with a small dark box in its top-left tile"""
+    image = Image.new("L", (640, 480))
+    image.putdata([(x * 255 // 640 + y * 64 // 480) % 256 for y in range(480) for x in range(640)])
+    if marker:
+        ImageDraw.Draw(image).rectangle(marker, fill=0)
+    path = os.path.join(STATE_DIR, name)
+    image.convert("RGB").save(path)
+    return path
+
+
+def reset_index():
+    with run_hf_model._frame_index_lock:
+        run_hf_model._frame_index = None
+    if os.path.exists(run_hf_model._frame_index_path()):
+        os.remove(run_hf_model._frame_index_path())
+
+
+def test_dhash_is_tiled():
+    """One 64-bit hash per tile, equal for frames with the same pixels"""
+    first = run_hf_model.compute_dhash(make_frame("same_a.png"))
+    second = run_hf_model.compute_dhash(make_frame("same_b.png"))
+    assert len(first) == run_hf_model._dhash_grid ** 2
+    assert all(0 <= tile < 2 ** 64 for tile in first)
+    assert run_hf_model.dhash_distance(first, second) == 0
+
+
+def test_small_change_stays_visible():
+    """A change covering a few percent of one tile shows up in that tile only"""
+    base = run_hf_model.compute_dhash(make_frame("base.png"))
+    changed = run_hf_model.compute_dhash(make_frame("changed.png", marker=(20, 20, 60, 50)))
+    assert run_hf_model.dhash_distance(base, changed) > 0
+    assert sum(1 for a, b in zip(base, changed) if a != b) == 1
+
+
+def test_mismatched_hashes_never_match():
+    """Hashes with different tile counts are as far apart as possible"""
+    assert run_hf_model.dhash_distance([0] * 16, [0]) == 64
+
+
+def test_remember_and_find():
+    """A remembered frame is found again for the same model, context and parameters only"""
+    reset_index()
+    frame = make_frame("remember.png")
+    run_hf_model.remember_frame_result("model-a", frame, "a desktop", PARAMS, context="caption")
+    assert run_hf_model.find_similar_frame_result("model-a", frame, PARAMS, context="caption") == "a desktop"
+    assert run_hf_model.find_similar_frame_result("model-a", frame, PARAMS, context="other") is None
+    assert run_hf_model.find_similar_frame_result("model-b", frame, PARAMS, context="caption") is None
+    assert run_hf_model.find_similar_frame_result("model-a", frame, dict(PARAMS, phash_threshold=-1), context="caption") is None
+
+
+def test_errors_and_old_frames_are_not_reused():
+    """Error results are never remembered and entries older than phash_max_age are skipped"""
+    reset_index()
+    frame = make_frame("expire.png")
+    run_hf_model.remember_frame_result("model-a", frame, "ERROR: out of memory", PARAMS)
+    assert run_hf_model.find_similar_frame_result("model-a", frame, PARAMS) is None
+    run_hf_model.remember_frame_result("model-a", frame, "a desktop", PARAMS)
+    assert run_hf_model.find_similar_frame_result("model-a", frame, dict(PARAMS, phash_max_age=-1)) is None
+
+
+def test_index_is_shared_between_processes():
+    """Entries written by another process are merged, not overwritten, and picked up without a restart"""
+    reset_index()
+    local_frame = make_frame("local.png")
+    remote_frame = make_frame("remote.png", marker=(300, 200, 400, 300))
+    run_hf_model.remember_frame_result("model-a", local_frame, "local result", PARAMS)
+    script = ("import sys, run_hf_model; "
+              "run_hf_model._resource_dir_overrides['state'] = sys.argv[1]; "
+              "run_hf_model.remember_frame_result('model-a', sys.argv[2], 'remote result', {'phash_threshold': 0, 'max_length': 50})")
+    environment = dict(os.environ, PYTHONPATH=os.pathsep.join([SCRIPTS_DIR, os.environ.get("PYTHONPATH", "")]))
+    subprocess.run([sys.executable, "-c", script, STATE_DIR, remote_frame], check=True, env=environment)
+    assert run_hf_model.find_similar_frame_result("model-a", remote_frame, PARAMS) == "remote result"
+    assert run_hf_model.find_similar_frame_result("model-a", local_frame, PARAMS) == "local result"
+
+
+def teardown_module(module):
+    shutil.rmtree(STATE_DIR, ignore_errors=True)
+
+
+def main():
+    print("Frame Index Tests")
+    print("=" * 40)
+    tests = [test_dhash_is_tiled, test_small_change_stays_visible, test_mismatched_hashes_never_match,
+             test_remember_and_find, test_errors_and_old_frames_are_not_reused, test_index_is_shared_between_processes]
+    failures = 0
+    for test in tests:
+        try:
+            test()
+            print(f"✓ {test.__name__}")
+        except AssertionError as e:
+            print(f"✗ {test.__name__}: {e}")
+            failures += 1
+    teardown_module(None)
+
+    print()
+    if failures:
+        print(f"❌ {failures} test(s) failed.")
+        return 1
+    print("🎉 All tests passed!")
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
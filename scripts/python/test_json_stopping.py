@@ -0,0 +1,89 @@
+#!/usr/bin/env python3
+"""
+Tests for JSON-constrained early termination (_JsonCompleteStoppingCriteria in run_hf_model.py).
+Uses a character-level stand-in tokenizer, so no model download is needed. Runs standalone or under pytest.
+"""
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "..", "src", "CSimple", "Scripts"))
+
+import torch
+import run_hf_model
+
+run_hf_model.torch = torch
+
+
+class CharTokenizer:
+    """One token per character; token ids are code points"""
+
+    def decode(self, ids, skip_special_tokens=True):
+        return "".join(chr(token_id) for token_id in ids)
+
+
+def stop_position(prompt, generated, initial_depth=1):
+    """Number of generated characters after which the criteria stops generation, or None"""
+    criteria = run_hf_model._JsonCompleteStoppingCriteria(CharTokenizer(), len(prompt), initial_depth=initial_depth)
+    ids = [ord(char) for char in prompt]
+    for index, char in enumerate(generated):
+        ids.append(ord(char))
+        if criteria(torch.tensor([ids]), None).item():
+            return index + 1
+    return None
+
+
+def test_stops_when_object_closes():
+    """Generation stops on the brace that closes the object opened by the prompt"""
+    generated = '"a": 1, "b": {"c": [1, 2]}} trailing'
+    assert stop_position("Answer: {", generated) == generated.index("} trailing") + 1
+
+
+def test_ignores_braces_in_strings():
+    """Braces and escaped quotes inside string literals do not change the depth"""
+    generated = '"text": "a } and \\" } still open"} done'
+    assert stop_position("{", generated) == generated.index("} done") + 1
+
+
+def test_prompt_braces_are_not_scanned():
+    """Only generated tokens are scanned, so braces in the prompt are ignored"""
+    assert stop_position('Schema: {"x": 1} then {', '"x": 2}') == 7
+
+
+def test_open_object_keeps_generating():
+    """An unfinished object never stops generation"""
+    assert stop_position("{", '"a": [1, {"b": 2}') is None
+
+
+def test_multi_character_tokens():
+    """A token that closes the object mid-token still stops generation"""
+    criteria = run_hf_model._JsonCompleteStoppingCriteria(CharTokenizer(), 1, initial_depth=1)
+    ids = [ord("{")]
+    ids.extend(ord(char) for char in '"a": 1')
+    assert not criteria(torch.tensor([ids]), None).item()
+    ids.extend(ord(char) for char in "}\n\n")
+    assert criteria(torch.tensor([ids]), None).item()
+
+
+def main():
+    print("JSON Stopping Criteria Tests")
+    print("=" * 40)
+    tests = [test_stops_when_object_closes, test_ignores_braces_in_strings, test_prompt_braces_are_not_scanned,
+             test_open_object_keeps_generating, test_multi_character_tokens]
+    failures = 0
+    for test in tests:
+        try:
+            test()
+            print(f"✓ {test.__name__}")
+        except AssertionError as e:
+            print(f"✗ {test.__name__}: {e}")
+            failures += 1
+
+    print()
+    if failures:
+        print(f"❌ {failures} test(s) failed.")
+        return 1
+    print("🎉 All tests passed!")
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
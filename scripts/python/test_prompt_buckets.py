@@ -0,0 +1,85 @@
+#!/usr/bin/env python3
+"""
+Tests for the compiled-prefill prompt buckets (fit_prompt_buckets, prompt_bucket) in run_hf_model.py.
+Runs standalone or under pytest.
+"""
+import os
+import sys
+import random
+from itertools import combinations
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "..", "src", "CSimple", "Scripts"))
+
+import run_hf_model
+
+
+def total_padding(lengths, buckets):
+    """Tokens added when every length is padded to the smallest bucket that holds it"""
+    return sum(min(bucket for bucket in buckets if bucket >= length) - length for length in lengths)
+
+
+def test_few_lengths_become_buckets():
+    """Up to max_buckets distinct aligned lengths are used as the buckets themselves"""
+    assert run_hf_model.fit_prompt_buckets([1, 16, 17, 40], max_buckets=4, alignment=16) == [16, 32, 48]
+
+
+def test_buckets_cover_every_length():
+    """Buckets are aligned, at most max_buckets, and the largest holds the longest prompt"""
+    rng = random.Random(7)
+    lengths = [rng.randint(1, 700) for _ in range(300)]
+    buckets = run_hf_model.fit_prompt_buckets(lengths, max_buckets=4, alignment=16)
+    assert len(buckets) <= 4
+    assert buckets == sorted(set(buckets))
+    assert all(bucket % 16 == 0 for bucket in buckets)
+    assert buckets[-1] == -(-max(lengths) // 16) * 16
+
+
+def test_buckets_minimize_padding():
+    """The fitted buckets pad no more than the best choice found by brute force"""
+    rng = random.Random(11)
+    for _ in range(20):
+        lengths = [rng.choice([rng.randint(1, 64), rng.randint(100, 180), rng.randint(400, 420)]) for _ in range(40)]
+        aligned = sorted({-(-length // 16) * 16 for length in lengths})
+        for max_buckets in (1, 2, 3):
+            buckets = run_hf_model.fit_prompt_buckets(lengths, max_buckets=max_buckets, alignment=16)
+            best = min(total_padding(lengths, list(chosen) + [aligned[-1]])
+                       for size in range(max_buckets)
+                       for chosen in combinations(aligned[:-1], size))
+            assert total_padding(lengths, buckets) == best
+
+
+def test_prompt_bucket_stays_within_limit():
+    """A padded prompt is never shorter than the prompt and never longer than the limit"""
+    cache_key = "test:prompt_bucket"
+    run_hf_model._prompt_stats.pop(cache_key, None)
+    for length in (1, 15, 16, 17, 100, 250, 1000):
+        bucket = run_hf_model.prompt_bucket(cache_key, length, 1024)
+        assert length <= bucket <= 1024
+    # A prompt with no room for padding is left as it is
+    assert run_hf_model.prompt_bucket(cache_key, 1020, 1021) == 1020
+    run_hf_model._prompt_stats.pop(cache_key, None)
+
+
+def main():
+    print("Prompt Bucket Tests")
+    print("=" * 40)
+    tests = [test_few_lengths_become_buckets, test_buckets_cover_every_length,
+             test_buckets_minimize_padding, test_prompt_bucket_stays_within_limit]
+    failures = 0
+    for test in tests:
+        try:
+            test()
+            print(f"✓ {test.__name__}")
+        except AssertionError as e:
+            print(f"✗ {test.__name__}: {e}")
+            failures += 1
+
+    print()
+    if failures:
+        print(f"❌ {failures} test(s) failed.")
+        return 1
+    print("🎉 All tests passed!")
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
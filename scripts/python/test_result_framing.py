@@ -0,0 +1,84 @@
+#!/usr/bin/env python3
+"""
+Tests for result output encoding (encode_result in run_hf_model.py): text, json and length-prefixed framed output.
+Runs standalone or under pytest.
+"""
+import os
+import sys
+import json
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "..", "src", "CSimple", "Scripts"))
+
+import run_hf_model
+
+OK = {"status": "ok", "output": "Zeile 1\nFRAME ok 3\n日本語 😀", "error": None, "latency_ms": 12.5}
+FAILED = {"status": "error", "output": None, "error": "CUDA out of memory", "latency_ms": 3.0}
+
+
+def read_frames(data):
+    """Split a stream of framed results back into (status, text) pairs by byte count"""
+    frames = []
+    while data:
+        header, data = data.split(b"\n", 1)
+        marker, status, length = header.decode("ascii").split(" ")
+        assert marker == "FRAME"
+        frames.append((status, data[:int(length)].decode("utf-8")))
+        data = data[int(length):]
+    return frames
+
+
+def test_text_output():
+    """Text output is the UTF-8 result plus a newline, or an ERROR line"""
+    assert run_hf_model.encode_result(OK) == (OK["output"] + "\n").encode("utf-8")
+    assert run_hf_model.encode_result(FAILED) == b"ERROR: CUDA out of memory\n"
+
+
+def test_json_output():
+    """JSON output carries the whole envelope on one line without escaping non-ASCII text"""
+    encoded = run_hf_model.encode_result(OK, "json")
+    assert encoded.endswith(b"\n") and encoded.count(b"\n") == 1
+    assert "日本語".encode("utf-8") in encoded
+    assert json.loads(encoded.decode("utf-8")) == OK
+
+
+def test_framed_output_round_trips():
+    """Concatenated frames read back exactly, even when the text contains newlines and frame headers"""
+    stream = run_hf_model.encode_result(OK, "framed") + run_hf_model.encode_result(FAILED, "framed")
+    assert read_frames(stream) == [("ok", OK["output"]), ("error", "ERROR: CUDA out of memory")]
+
+
+def test_framed_length_counts_bytes():
+    """The frame length is the UTF-8 byte count, not the character count"""
+    encoded = run_hf_model.encode_result({"status": "ok", "output": "é😀"}, "framed")
+    assert encoded == b"FRAME ok 6\n" + "é😀".encode("utf-8")
+
+
+def test_unencodable_text_is_replaced():
+    """Lone surrogates from a bad decode are replaced instead of failing the write"""
+    encoded = run_hf_model.encode_result({"status": "ok", "output": "a\ud800b"}, "framed")
+    assert read_frames(encoded) == [("ok", "a?b")]
+
+
+def main():
+    print("Result Framing Tests")
+    print("=" * 40)
+    tests = [test_text_output, test_json_output, test_framed_output_round_trips,
+             test_framed_length_counts_bytes, test_unencodable_text_is_replaced]
+    failures = 0
+    for test in tests:
+        try:
+            test()
+            print(f"✓ {test.__name__}")
+        except AssertionError as e:
+            print(f"✗ {test.__name__}: {e}")
+            failures += 1
+
+    print()
+    if failures:
+        print(f"❌ {failures} test(s) failed.")
+        return 1
+    print("🎉 All tests passed!")
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
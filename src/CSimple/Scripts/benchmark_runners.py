@@ -0,0 +1,394 @@
+#!/usr/bin/env python3
+"""
+Offline Runner Benchmark for C-Simple
+
+Builds tiny random-initialized models for each runner in run_hf_model.py (no Hub access),
+generates synthetic PNG/WAV inputs, and drives every runner through cold-start, warm-cache
+and batched scenarios. Results (p50/p95 latency, throughput, per-phase medians and RSS growth)
+are written as JSON so latency regressions can be caught on a CPU-only Linux box.
+
+Usage:
+  python benchmark_runners.py [--runners text-generation,image-to-text] [--warm_runs 5]
+                              [--cold_runs 2] [--batch_size 4] [--output results.json]
+"""
+
+import argparse
+import json
+import math
+import os
+import platform
+import shutil
+import sys
+import tempfile
+import time
+import wave
+
+# The runners live next to this script
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+_runner_names = ["text-generation", "automatic-speech-recognition", "image-to-text", "vision-language", "text-to-speech"]
+_characters = list("abcdefghijklmnopqrstuvwxyz0123456789 .,:?'\n")
+_image_size = 32
+_sample_rate = 16000
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(description="Benchmark run_hf_model.py runners with tiny random-weight models")
+    parser.add_argument("--runners", type=str, default=",".join(_runner_names), help="Comma-separated runner types to benchmark")
+    parser.add_argument("--cold_runs", type=int, default=2, help="Cold-start runs per runner (all caches dropped before each)")
+    parser.add_argument("--warm_runs", type=int, default=5, help="Warm-cache runs per runner")
+    parser.add_argument("--batch_size", type=int, default=4, help="Items per batched run (files per request, or concurrent text requests)")
+    parser.add_argument("--batched_runs", type=int, default=3, help="Batched runs per runner")
+    parser.add_argument("--work_dir", type=str, help="Directory for tiny models and synthetic inputs (default: a temporary directory)")
+    parser.add_argument("--keep_work_dir", action="store_true", help="Do not delete the temporary work directory")
+    parser.add_argument("--output", type=str, help="Write the JSON report to this file as well as stdout")
+    return parser.parse_args()
+
+
+def _character_vocab(special_tokens: list) -> dict:
+    return {token: i for i, token in enumerate(special_tokens + _characters)}
+
+
+def _character_tokenizer(special_tokens: list, **kwargs):
+    """Fast tokenizer with one token per character, built without downloads."""
+    from tokenizers import Tokenizer, models, pre_tokenizers
+    from transformers import PreTrainedTokenizerFast
+
+    tokenizer = Tokenizer(models.WordLevel(_character_vocab(special_tokens), unk_token=special_tokens[0]))
+    tokenizer.pre_tokenizer = pre_tokenizers.Split("", "isolated")
+    return PreTrainedTokenizerFast(tokenizer_object=tokenizer, unk_token=special_tokens[0], **kwargs)
+
+
+def build_text_generation(model_dir: str) -> str:
+    """Tiny GPT-2."""
+    from transformers import GPT2Config, GPT2LMHeadModel
+
+    tokenizer = _character_tokenizer(["<unk>", "<eos>"], eos_token="<eos>", bos_token="<eos>")
+    config = GPT2Config(vocab_size=len(tokenizer), n_embd=32, n_layer=2, n_head=2, n_positions=512,
+                        bos_token_id=1, eos_token_id=1)
+    GPT2LMHeadModel(config).save_pretrained(model_dir)
+    tokenizer.save_pretrained(model_dir)
+    return "bench/tiny-gpt2"
+
+
+def build_speech_recognition(model_dir: str) -> str:
+    """Tiny wav2vec2 CTC model (the ASR runner goes through the transformers pipeline)."""
+    from transformers import (Wav2Vec2Config, Wav2Vec2ForCTC, Wav2Vec2CTCTokenizer,
+                              Wav2Vec2FeatureExtractor, Wav2Vec2Processor)
+
+    vocab = _character_vocab(["<pad>", "<unk>"])
+    vocab["|"] = vocab.pop(" ")
+    vocab_file = os.path.join(model_dir, "vocab.json")
+    os.makedirs(model_dir, exist_ok=True)
+    with open(vocab_file, "w", encoding="utf-8") as f:
+        json.dump({token: i for i, token in enumerate(vocab)}, f)
+    tokenizer = Wav2Vec2CTCTokenizer(vocab_file, unk_token="<unk>", pad_token="<pad>", word_delimiter_token="|")
+    feature_extractor = Wav2Vec2FeatureExtractor(feature_size=1, sampling_rate=_sample_rate, padding_value=0.0,
+                                                 do_normalize=True, return_attention_mask=False)
+    config = Wav2Vec2Config(vocab_size=len(tokenizer), hidden_size=32, num_hidden_layers=2, num_attention_heads=2,
+                            intermediate_size=64, conv_dim=(32, 32), conv_stride=(5, 4), conv_kernel=(10, 8),
+                            num_conv_pos_embeddings=16, num_conv_pos_embedding_groups=2, pad_token_id=0)
+    Wav2Vec2ForCTC(config).save_pretrained(model_dir)
+    Wav2Vec2Processor(feature_extractor=feature_extractor, tokenizer=tokenizer).save_pretrained(model_dir)
+    return "bench/tiny-wav2vec2"
+
+
+def build_image_to_text(model_dir: str) -> str:
+    """Tiny BLIP captioning model."""
+    from transformers import BlipConfig, BlipForConditionalGeneration, BlipImageProcessor, BlipProcessor
+
+    tokenizer = _character_tokenizer(["[UNK]", "[PAD]", "[CLS]", "[SEP]"], pad_token="[PAD]", cls_token="[CLS]",
+                                     sep_token="[SEP]", bos_token="[CLS]", eos_token="[SEP]")
+    config = BlipConfig(
+        vision_config=dict(hidden_size=32, intermediate_size=64, num_hidden_layers=2, num_attention_heads=2,
+                           image_size=_image_size, patch_size=16),
+        text_config=dict(vocab_size=len(tokenizer), hidden_size=32, intermediate_size=64, num_hidden_layers=2,
+                         num_attention_heads=2, encoder_hidden_size=32, bos_token_id=2, pad_token_id=1,
+                         sep_token_id=3, eos_token_id=3)
+    )
+    BlipForConditionalGeneration(config).save_pretrained(model_dir)
+    image_processor = BlipImageProcessor(size={"height": _image_size, "width": _image_size})
+    BlipProcessor(image_processor=image_processor, tokenizer=tokenizer).save_pretrained(model_dir)
+    return "bench/tiny-blip"
+
+
+def build_vision_language(model_dir: str) -> str:
+    """Tiny LLaVA (CLIP vision tower + Llama decoder) with a multi-image chat template."""
+    from transformers import (CLIPImageProcessor, CLIPVisionConfig, LlamaConfig, LlavaConfig,
+                              LlavaForConditionalGeneration, LlavaProcessor)
+
+    tokenizer = _character_tokenizer(["<unk>", "<s>", "</s>", "<image>"], bos_token="<s>", eos_token="</s>",
+                                     pad_token="</s>", extra_special_tokens={"image_token": "<image>"})
+    chat_template = (
+        "{% for message in messages %}{% for content in message['content'] %}"
+        "{% if content['type'] == 'image' %}<image>{% else %}{{ content['text'] }}{% endif %}"
+        "{% endfor %}{% endfor %}{% if add_generation_prompt %}\nanswer:{% endif %}"
+    )
+    processor = LlavaProcessor(
+        image_processor=CLIPImageProcessor(size={"shortest_edge": _image_size},
+                                           crop_size={"height": _image_size, "width": _image_size}),
+        tokenizer=tokenizer, patch_size=16, vision_feature_select_strategy="default",
+        num_additional_image_tokens=1, image_token="<image>", chat_template=chat_template
+    )
+    config = LlavaConfig(
+        vision_config=CLIPVisionConfig(hidden_size=32, intermediate_size=64, num_hidden_layers=2, num_attention_heads=2,
+                                       image_size=_image_size, patch_size=16, projection_dim=32),
+        text_config=LlamaConfig(vocab_size=len(tokenizer), hidden_size=32, intermediate_size=64, num_hidden_layers=2,
+                                num_attention_heads=2, num_key_value_heads=2, max_position_embeddings=1024,
+                                bos_token_id=1, eos_token_id=2, pad_token_id=2),
+        image_token_index=3, vision_feature_layer=-1, vision_feature_select_strategy="default"
+    )
+    LlavaForConditionalGeneration(config).save_pretrained(model_dir)
+    processor.save_pretrained(model_dir)
+    return "bench/tiny-llava"
+
+
+def build_text_to_speech(model_dir: str) -> str:
+    """Tiny VITS (MMS-TTS architecture)."""
+    from transformers import VitsConfig, VitsModel, VitsTokenizer
+
+    os.makedirs(model_dir, exist_ok=True)
+    vocab_file = os.path.join(model_dir, "vocab.json")
+    with open(vocab_file, "w", encoding="utf-8") as f:
+        json.dump(_character_vocab(["<unk>"]), f)
+    tokenizer = VitsTokenizer(vocab_file, unk_token="<unk>", add_blank=True, normalize=True, phonemize=False)
+    config = VitsConfig(vocab_size=len(tokenizer), hidden_size=16, num_hidden_layers=1, num_attention_heads=2,
+                        ffn_dim=32, flow_size=16, upsample_initial_channel=16, upsample_rates=[8, 8],
+                        upsample_kernel_sizes=[16, 16], resblock_kernel_sizes=[3], resblock_dilation_sizes=[[1, 3]],
+                        prior_encoder_num_flows=1, prior_encoder_num_wavenet_layers=1,
+                        posterior_encoder_num_wavenet_layers=1, duration_predictor_num_flows=1,
+                        duration_predictor_filter_channels=16, depth_separable_num_layers=1, sampling_rate=_sample_rate)
+    VitsModel(config).save_pretrained(model_dir)
+    tokenizer.save_pretrained(model_dir)
+    return "bench/tiny-mms-tts"
+
+
+_model_builders = {
+    "text-generation": build_text_generation,
+    "automatic-speech-recognition": build_speech_recognition,
+    "image-to-text": build_image_to_text,
+    "vision-language": build_vision_language,
+    "text-to-speech": build_text_to_speech
+}
+
+
+def write_synthetic_png(path: str, seed: int, size: tuple = (160, 120)):
+    """Random blocks on a flat background, different for every seed."""
+    import random
+    from PIL import Image, ImageDraw
+
+    rng = random.Random(seed)
+    image = Image.new("RGB", size, tuple(rng.randrange(256) for _ in range(3)))
+    draw = ImageDraw.Draw(image)
+    for _ in range(8):
+        left, top = rng.randrange(size[0]), rng.randrange(size[1])
+        draw.rectangle([left, top, left + rng.randrange(8, 60), top + rng.randrange(8, 40)],
+                       fill=tuple(rng.randrange(256) for _ in range(3)))
+    image.save(path)
+
+
+def write_synthetic_wav(path: str, seed: int, seconds: float = 1.0):
+    """16 kHz mono 16-bit tone sweep with a little noise, different for every seed."""
+    import numpy as np
+
+    rng = np.random.default_rng(seed)
+    t = np.arange(int(_sample_rate * seconds)) / _sample_rate
+    frequency = 220 + 40 * seed + 200 * t
+    signal = 0.4 * np.sin(2 * np.pi * frequency * t) + 0.05 * rng.standard_normal(t.size)
+    with wave.open(path, "wb") as wav_file:
+        wav_file.setnchannels(1)
+        wav_file.setsampwidth(2)
+        wav_file.setframerate(_sample_rate)
+        wav_file.writeframes((np.clip(signal, -1, 1) * 32767).astype("<i2").tobytes())
+
+
+def build_inputs(runner: str, data_dir: str, count: int) -> list:
+    """count distinct synthetic inputs (file paths, or text) for a runner."""
+    if runner in ("image-to-text", "vision-language"):
+        paths = [os.path.join(data_dir, f"frame_{i}.png") for i in range(count)]
+        for i, path in enumerate(paths):
+            if not os.path.exists(path):
+                write_synthetic_png(path, i)
+        return paths
+    if runner == "automatic-speech-recognition":
+        paths = [os.path.join(data_dir, f"audio_{i}.wav") for i in range(count)]
+        for i, path in enumerate(paths):
+            if not os.path.exists(path):
+                write_synthetic_wav(path, i)
+        return paths
+    return [f"step {i}: the user opened the settings window and clicked save. what next?" for i in range(count)]
+
+
+def format_request(runner: str, items: list) -> str:
+    """Runner input for one request over the given items, in the formats the runners parse."""
+    if runner == "image-to-text":
+        return f"image file: {items[0]}" if len(items) == 1 else "|".join(items)
+    if runner == "automatic-speech-recognition":
+        return f"audio file: {items[0]}" if len(items) == 1 else "|".join(items)
+    if runner == "vision-language":
+        return ", ".join(items) + ", screen: describe the screen and the next action"
+    return items[0]
+
+
+def percentile(values: list, fraction: float) -> float:
+    """Nearest-rank percentile: the smallest value with at least this fraction of the values at or below it."""
+    ordered = sorted(values)
+    # Rounded first so products like 0.95 * 20 do not land a hair above the integer rank
+    rank = math.ceil(round(fraction * len(ordered), 9))
+    return ordered[min(len(ordered) - 1, max(0, rank - 1))]
+
+
+def summarize(latencies_ms: list, envelopes: list, items_per_run: int, wall_seconds: float, rss_samples_mb: list) -> dict:
+    """Latency percentiles, throughput, phase medians, errors and memory growth of a scenario.
+
+    rss_samples_mb holds the resident memory before the scenario followed by one sample after each
+    run, so the memory figures belong to this scenario rather than to the whole process lifetime.
+    """
+    phases = {}
+    for envelope in envelopes:
+        for name, elapsed in envelope.get("timings_ms", {}).items():
+            phases.setdefault(name, []).append(elapsed)
+    errors = [envelope.get("error") for envelope in envelopes if envelope.get("status") != "ok"]
+    return {
+        "runs": len(latencies_ms),
+        "items_per_run": items_per_run,
+        "p50_ms": round(percentile(latencies_ms, 0.50), 2),
+        "p95_ms": round(percentile(latencies_ms, 0.95), 2),
+        "mean_ms": round(sum(latencies_ms) / len(latencies_ms), 2),
+        "throughput_items_per_s": round(len(latencies_ms) * items_per_run / wall_seconds, 3) if wall_seconds else None,
+        "phase_p50_ms": {name: round(percentile(values, 0.50), 2) for name, values in phases.items()},
+        "rss_delta_mb": round(rss_samples_mb[-1] - rss_samples_mb[0], 1) if None not in rss_samples_mb else None,
+        "peak_rss_delta_mb": round(max(rss_samples_mb) - rss_samples_mb[0], 1) if None not in rss_samples_mb else None,
+        "errors": len(errors),
+        "first_error": errors[0] if errors else None
+    }
+
+
+def run_scenario(request_fn, runs: int, items_per_run: int, before_each=None) -> dict:
+    """Time request_fn() runs times; request_fn returns a list of result envelopes."""
+    import torch
+    import run_hf_model
+
+    latencies_ms = []
+    envelopes = []
+    wall_seconds = 0.0
+    rss_samples_mb = [run_hf_model.get_rss_mb()]
+    for run_index in range(runs):
+        if before_each:
+            before_each()
+        torch.manual_seed(run_index)
+        start = time.perf_counter()
+        envelopes.extend(request_fn(run_index))
+        elapsed = time.perf_counter() - start
+        wall_seconds += elapsed
+        latencies_ms.append(elapsed * 1000)
+        rss_samples_mb.append(run_hf_model.get_rss_mb())
+    return summarize(latencies_ms, envelopes, items_per_run, wall_seconds, rss_samples_mb)
+
+
+def benchmark_runner(runner: str, model_id: str, model_dir: str, data_dir: str, params: dict, args) -> dict:
+    """Cold, warm and batched scenarios for one runner."""
+    import run_hf_model
+
+    pool = build_inputs(runner, data_dir, max(args.batch_size, args.warm_runs, args.cold_runs) + 1)
+
+    def single(run_index):
+        request = format_request(runner, [pool[run_index % len(pool)]])
+        return [run_hf_model.run_model_with_envelope(model_id, request, params, model_dir)]
+
+    def batched(run_index):
+        items = [pool[(run_index + i) % len(pool)] for i in range(args.batch_size)]
+        if runner in ("text-generation", "text-to-speech"):
+            # Independent text requests served concurrently by the inference scheduler
+            return run_hf_model.map_inference(
+                lambda item: run_hf_model.run_model_with_envelope(model_id, item, params, model_dir),
+                [(item,) for item in items]
+            )
+        return [run_hf_model.run_model_with_envelope(model_id, format_request(runner, items), params, model_dir)]
+
+    results = {"model_id": model_id}
+    results["cold"] = run_scenario(single, args.cold_runs, 1, before_each=run_hf_model.clear_runtime_caches)
+    single(0)  # warm-up
+    results["warm"] = run_scenario(single, args.warm_runs, 1)
+    results["batched"] = run_scenario(batched, args.batched_runs, args.batch_size)
+    return results
+
+
+def main() -> int:
+    args = parse_arguments()
+    runners = [name.strip() for name in args.runners.split(",") if name.strip()]
+    unknown = [name for name in runners if name not in _model_builders]
+    if unknown:
+        print(f"ERROR: Unknown runner(s): {', '.join(unknown)}. Choose from: {', '.join(_runner_names)}", file=sys.stderr)
+        return 1
+
+    work_dir = args.work_dir or tempfile.mkdtemp(prefix="csimple_bench_")
+    os.makedirs(work_dir, exist_ok=True)
+    # Everything stays local: no Hub lookups, and caches/state/audio go to the work directory
+    os.environ["HF_HUB_OFFLINE"] = "1"
+    os.environ["TRANSFORMERS_OFFLINE"] = "1"
+    os.environ["CSIMPLE_STATE_DIR"] = os.path.join(work_dir, "state")
+
+    import run_hf_model
+
+    run_hf_model.configure_resource_dirs(os.path.join(work_dir, "hf_cache"), os.path.join(work_dir, "audio"))
+    run_hf_model.configure_inference_scheduler(None, None, None, 1)
+    if not run_hf_model.setup_environment():
+        print("ERROR: Failed to set up Python environment", file=sys.stderr)
+        return 1
+    import torch
+    import transformers
+
+    # Reuse of near-identical frames and change-region cropping would skip the work being measured
+    params = {
+        "max_length": 16,
+        "temperature": 0.7,
+        "top_p": 0.9,
+        "trust_remote_code": False,
+        "cpu_optimize": True,
+        "offline_mode": True,
+        "phash_threshold": -1,
+        "vision_roi": "off"
+    }
+
+    data_dir = os.path.join(work_dir, "inputs")
+    os.makedirs(data_dir, exist_ok=True)
+    report = {
+        "environment": {
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "torch": torch.__version__,
+            "transformers": transformers.__version__,
+            "cpu_count": os.cpu_count(),
+            "threads": run_hf_model.get_thread_allocation()
+        },
+        "settings": {"cold_runs": args.cold_runs, "warm_runs": args.warm_runs,
+                     "batched_runs": args.batched_runs, "batch_size": args.batch_size},
+        "results": {}
+    }
+
+    try:
+        for runner in runners:
+            print(f"Benchmarking {runner}...", file=sys.stderr)
+            model_dir = os.path.join(work_dir, "models", runner)
+            try:
+                model_id = _model_builders[runner](model_dir)
+            except Exception as e:
+                report["results"][runner] = {"skipped": f"could not build tiny model: {e}"}
+                continue
+            report["results"][runner] = benchmark_runner(runner, model_id, model_dir, data_dir, params, args)
+            run_hf_model.clear_runtime_caches()
+    finally:
+        if not args.work_dir and not args.keep_work_dir:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+    output = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            f.write(output)
+    print(output)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,245 @@
+#!/usr/bin/env python3
+"""
+Embedding Index for C-Simple
+
+A compact on-disk vector index for finding past frames and transcripts similar to the
+current state. Vectors are L2-normalized and stored as float16 in a memory-mapped file,
+so tens of thousands of captured steps stay cheap to open and search. Small indexes are
+searched brute-force; once an index grows past a few thousand vectors an inverted-file
+(IVF) layout is built with k-means so a query only scans the closest clusters.
+
+Index directory layout:
+  index.json            header: dimension, count, capacity, model, IVF state
+  vectors.f16           float16 vectors, shape (capacity, dimension)
+  items.jsonl           one JSON record per vector (id, item, metadata, added_at)
+  ivf_centroids.npy     float32 cluster centroids (when built)
+  ivf_assignments.npy   int32 cluster of each indexed vector (when built)
+
+An index has a single writer; concurrent readers in other processes see the
+vectors that were flushed when they opened it.
+"""
+
+import json
+import os
+import threading
+import time
+
+import numpy as np
+
+_header_name = "index.json"
+_vectors_name = "vectors.f16"
+_items_name = "items.jsonl"
+_centroids_name = "ivf_centroids.npy"
+_assignments_name = "ivf_assignments.npy"
+
+_initial_capacity = 1024
+_ivf_min_vectors = 4096
+_ivf_rebuild_fraction = 0.25
+_ivf_iterations = 8
+_ivf_sample_size = 32768
+_default_nprobe = 8
+_search_chunk_rows = 65536
+
+
+def normalize_vectors(vectors) -> np.ndarray:
+    """Float32 copy of vectors scaled to unit length (zero vectors stay zero)."""
+    vectors = np.asarray(vectors, dtype=np.float32)
+    if vectors.ndim == 1:
+        vectors = vectors[None, :]
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    return vectors / np.maximum(norms, 1e-12)
+
+
+def _top_k(scores: np.ndarray, ids: np.ndarray, top_k: int) -> list:
+    """(id, score) pairs of the highest scores, best first."""
+    if scores.size == 0:
+        return []
+    if scores.size > top_k:
+        best = np.argpartition(-scores, top_k - 1)[:top_k]
+    else:
+        best = np.arange(scores.size)
+    best = best[np.argsort(-scores[best])]
+    return [(int(ids[i]), float(scores[i])) for i in best]
+
+
+def kmeans(vectors: np.ndarray, clusters: int, iterations: int = _ivf_iterations, seed: int = 0) -> np.ndarray:
+    """Spherical k-means on unit vectors; returns float32 unit centroids."""
+    rng = np.random.default_rng(seed)
+    clusters = max(1, min(clusters, len(vectors)))
+    centroids = vectors[rng.choice(len(vectors), clusters, replace=False)].copy()
+    for _ in range(iterations):
+        assignments = np.argmax(vectors @ centroids.T, axis=1)
+        sums = np.zeros_like(centroids)
+        np.add.at(sums, assignments, vectors)
+        empty = np.bincount(assignments, minlength=clusters) == 0
+        # Re-seed empty clusters from random vectors so every list stays useful
+        sums[empty] = vectors[rng.choice(len(vectors), int(empty.sum()))]
+        centroids = normalize_vectors(sums)
+    return centroids
+
+
+class EmbeddingIndex:
+    """Memory-mapped float16 vector index with brute-force and IVF top-k search."""
+
+    def __init__(self, path: str, dimension: int = None, model_id: str = None):
+        self.path = path
+        self._lock = threading.Lock()
+        self._items = None
+        self._centroids = None
+        self._list_order = None
+        self._list_offsets = None
+        os.makedirs(path, exist_ok=True)
+
+        header_path = os.path.join(path, _header_name)
+        if os.path.exists(header_path):
+            with open(header_path, "r", encoding="utf-8") as header_file:
+                self.header = json.load(header_file)
+            if dimension and dimension != self.header["dimension"]:
+                raise ValueError(f"Index at {path} has dimension {self.header['dimension']}, not {dimension}")
+            if model_id and self.header.get("model_id") and model_id != self.header["model_id"]:
+                raise ValueError(f"Index at {path} was built with {self.header['model_id']}, not {model_id}")
+        elif dimension:
+            self.header = {"dimension": int(dimension), "count": 0, "capacity": 0, "model_id": model_id, "ivf_count": 0}
+            self._resize(_initial_capacity)
+            self._write_header()
+        else:
+            raise ValueError(f"No embedding index at {path}; the first add must provide vectors")
+
+        self._vectors = self._open_vectors()
+        if self.header.get("ivf_count"):
+            self._set_ivf(np.load(os.path.join(path, _centroids_name)), np.load(os.path.join(path, _assignments_name)))
+
+    @property
+    def dimension(self) -> int:
+        return self.header["dimension"]
+
+    def __len__(self) -> int:
+        return self.header["count"]
+
+    def _open_vectors(self):
+        return np.memmap(os.path.join(self.path, _vectors_name), dtype=np.float16, mode="r+",
+                         shape=(self.header["capacity"], self.dimension))
+
+    def _resize(self, capacity: int):
+        """Grow the vector file to hold capacity rows (existing rows are kept)."""
+        with open(os.path.join(self.path, _vectors_name), "ab") as vectors_file:
+            vectors_file.truncate(capacity * self.dimension * 2)
+        self.header["capacity"] = capacity
+
+    def _write_header(self):
+        header_path = os.path.join(self.path, _header_name)
+        with open(header_path + ".tmp", "w", encoding="utf-8") as header_file:
+            json.dump(self.header, header_file)
+        os.replace(header_path + ".tmp", header_path)
+
+    def add(self, vectors, items: list, metadata: list = None) -> list:
+        """Append vectors with their items (paths or text); returns the new ids."""
+        vectors = normalize_vectors(vectors)
+        if vectors.shape[1] != self.dimension:
+            raise ValueError(f"Expected {self.dimension}-dimensional vectors, got {vectors.shape[1]}")
+        if len(items) != len(vectors):
+            raise ValueError("Each vector needs exactly one item")
+        metadata = metadata or [None] * len(items)
+
+        with self._lock:
+            start = self.header["count"]
+            end = start + len(vectors)
+            if end > self.header["capacity"]:
+                del self._vectors
+                self._resize(max(end, self.header["capacity"] * 2))
+                self._vectors = self._open_vectors()
+            self._vectors[start:end] = vectors.astype(np.float16)
+            self._vectors.flush()
+
+            added_at = time.time()
+            records = [{"id": start + i, "item": item, "metadata": meta, "added_at": added_at}
+                       for i, (item, meta) in enumerate(zip(items, metadata))]
+            with open(os.path.join(self.path, _items_name), "a", encoding="utf-8") as items_file:
+                for record in records:
+                    items_file.write(json.dumps(record, ensure_ascii=False) + "\n")
+            if self._items is not None:
+                self._items.extend(records)
+
+            self.header["count"] = end
+            self._write_header()
+            return list(range(start, end))
+
+    def get_item(self, vector_id: int) -> dict:
+        """Stored record (item, metadata, added_at) for an id."""
+        if self._items is None:
+            records = []
+            items_path = os.path.join(self.path, _items_name)
+            if os.path.exists(items_path):
+                with open(items_path, "r", encoding="utf-8") as items_file:
+                    records = [json.loads(line) for line in items_file if line.strip()]
+            self._items = records
+        return self._items[vector_id]
+
+    def build_ivf(self, clusters: int = None):
+        """Cluster the stored vectors into inverted lists (about sqrt(count) clusters)."""
+        with self._lock:
+            count = self.header["count"]
+            if count == 0:
+                return
+            clusters = clusters or max(1, int(np.sqrt(count)))
+            stored = self._vectors[:count]
+            sample_ids = np.random.default_rng(0).choice(count, min(count, _ivf_sample_size), replace=False)
+            centroids = kmeans(stored[np.sort(sample_ids)].astype(np.float32), clusters)
+
+            assignments = np.empty(count, dtype=np.int32)
+            for start in range(0, count, _search_chunk_rows):
+                chunk = stored[start:start + _search_chunk_rows].astype(np.float32)
+                assignments[start:start + len(chunk)] = np.argmax(chunk @ centroids.T, axis=1)
+
+            np.save(os.path.join(self.path, _centroids_name), centroids)
+            np.save(os.path.join(self.path, _assignments_name), assignments)
+            self._set_ivf(centroids, assignments)
+            self.header["ivf_count"] = count
+            self._write_header()
+
+    def _set_ivf(self, centroids: np.ndarray, assignments: np.ndarray):
+        """Keep the inverted lists as ids sorted by cluster plus per-cluster offsets."""
+        self._list_order = np.argsort(assignments, kind="stable").astype(np.int64)
+        self._list_offsets = np.searchsorted(assignments[self._list_order], np.arange(len(centroids) + 1))
+        self._centroids = centroids
+
+    def _needs_ivf_build(self) -> bool:
+        count = self.header["count"]
+        if count < _ivf_min_vectors:
+            return False
+        unindexed = count - self.header.get("ivf_count", 0)
+        return self._centroids is None or unindexed > count * _ivf_rebuild_fraction
+
+    def search(self, query, top_k: int = 5, nprobe: int = _default_nprobe, exact: bool = False) -> list:
+        """Top-k (id, cosine similarity) for one query vector, best first.
+
+        Uses the IVF lists when the index is large enough (building them on first use);
+        vectors added since the last build are always scanned. exact=True forces brute force.
+        """
+        query = normalize_vectors(query)[0]
+        count = self.header["count"]
+        if count == 0 or top_k <= 0:
+            return []
+        if not exact and self._needs_ivf_build():
+            self.build_ivf()
+
+        if exact or self._centroids is None:
+            candidate_ids = None
+        else:
+            indexed = self.header["ivf_count"]
+            probed = np.argpartition(-(self._centroids @ query), min(nprobe, len(self._centroids)) - 1)[:nprobe]
+            candidate_ids = np.concatenate(
+                [self._list_order[self._list_offsets[c]:self._list_offsets[c + 1]] for c in probed]
+                + [np.arange(indexed, count)]
+            )
+
+        if candidate_ids is None:
+            results = []
+            for start in range(0, count, _search_chunk_rows):
+                chunk = self._vectors[start:min(count, start + _search_chunk_rows)].astype(np.float32)
+                results.extend(_top_k(chunk @ query, np.arange(start, start + len(chunk)), top_k))
+            results.sort(key=lambda pair: -pair[1])
+            return results[:top_k]
+
+        scores = self._vectors[candidate_ids].astype(np.float32) @ query
+        return _top_k(scores, candidate_ids, top_k)
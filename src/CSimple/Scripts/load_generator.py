@@ -0,0 +1,278 @@
+#!/usr/bin/env python3
+"""
+Load Generator for C-Simple
+
+Replays requests recorded with `run_hf_model.py --record_requests <file>` against a resident
+worker (`run_hf_model.py --serve`) at a configurable concurrency and arrival rate, then reports
+throughput, latency percentiles and error rates as JSON. Referenced screenshots and audio are
+taken from the copies stored next to the recording, so a replay sees the same inputs the
+intelligence loop sent.
+
+Arrivals are open-loop: requests are scheduled either at a fixed --rate or at their recorded
+spacing (scaled by --speed), and sent as soon as a slot below --concurrency is free. Service
+latency is measured from send to response; end-to-end latency also includes time spent waiting
+for a slot, and is compared against the pipeline interval (--interval_ms).
+
+Usage:
+  python load_generator.py requests.jsonl [--concurrency 4] [--rate 2.0 | --speed 1.0]
+                           [--repeat 3] [--warmup 2] [--interval_ms 1000]
+                           [--worker_args="--inference_workers 2"] [--output report.json]
+"""
+
+import argparse
+import json
+import os
+import shlex
+import subprocess
+import sys
+import threading
+import time
+
+from benchmark_runners import percentile
+
+_worker_script = os.path.join(os.path.dirname(os.path.abspath(__file__)), "run_hf_model.py")
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(description="Replay recorded requests against the run_hf_model.py resident worker")
+    parser.add_argument("recording", type=str, help="JSONL file written by run_hf_model.py --record_requests")
+    parser.add_argument("--concurrency", type=int, default=4, help="Maximum requests in flight at once")
+    parser.add_argument("--rate", type=float, help="Fixed arrival rate in requests per second (default: recorded spacing)")
+    parser.add_argument("--speed", type=float, default=1.0, help="Replay recorded spacing this many times faster (ignored with --rate)")
+    parser.add_argument("--repeat", type=int, default=1, help="Replay the recording this many times")
+    parser.add_argument("--limit", type=int, help="Replay at most this many requests")
+    parser.add_argument("--warmup", type=int, default=1, help="Requests sent one at a time before measuring (model loading is excluded)")
+    parser.add_argument("--interval_ms", type=float, default=1000.0, help="Pipeline interval the end-to-end latency must fit in")
+    parser.add_argument("--timeout", type=float, default=300.0, help="Seconds to wait for outstanding responses after the last send")
+    parser.add_argument("--worker_args", type=str, default="", help="Extra arguments for run_hf_model.py --serve; pass with = (e.g. --worker_args=\"--fast_mode\")")
+    parser.add_argument("--python", type=str, default=sys.executable, help="Python interpreter for the worker")
+    parser.add_argument("--verbose", action="store_true", help="Pass worker stderr through")
+    parser.add_argument("--output", type=str, help="Write the JSON report to this file as well as stdout")
+    return parser.parse_args()
+
+
+def _replace_paths(value, replacements: dict):
+    """Request copy with every recorded file path swapped for its stored copy."""
+    if isinstance(value, str):
+        for original, stored in replacements.items():
+            value = value.replace(original, stored)
+        return value
+    if isinstance(value, dict):
+        return {key: _replace_paths(item, replacements) for key, item in value.items()}
+    if isinstance(value, list):
+        return [_replace_paths(item, replacements) for item in value]
+    return value
+
+
+def load_recording(path: str) -> list:
+    """Recorded entries as (offset seconds from the first request, request with stored file paths)."""
+    files_dir = path + ".files"
+    entries = []
+    with open(path, "r", encoding="utf-8") as recording:
+        for line in recording:
+            if not line.strip():
+                continue
+            entry = json.loads(line)
+            replacements = {original: os.path.join(files_dir, stored)
+                            for original, stored in (entry.get("files") or {}).items() if stored}
+            entries.append((entry["recorded_at"], _replace_paths(entry["request"], replacements)))
+    if not entries:
+        return []
+    first = entries[0][0]
+    return [(recorded_at - first, request) for recorded_at, request in entries]
+
+
+def build_schedule(entries: list, args) -> list:
+    """(send offset seconds, request) for every replayed request, repeats appended back to back."""
+    schedule = []
+    span = (entries[-1][0] / args.speed if entries else 0.0) + (1.0 / args.rate if args.rate else 0.0)
+    for repeat in range(max(1, args.repeat)):
+        for offset, request in entries:
+            if args.rate:
+                send_at = len(schedule) / args.rate
+            else:
+                send_at = repeat * span + offset / args.speed
+            schedule.append((send_at, request))
+    return schedule[:args.limit] if args.limit else schedule
+
+
+def _latency_summary(latencies_ms: list) -> dict:
+    if not latencies_ms:
+        return {}
+    return {
+        "mean": round(sum(latencies_ms) / len(latencies_ms), 1),
+        "p50": round(percentile(latencies_ms, 0.50), 1),
+        "p90": round(percentile(latencies_ms, 0.90), 1),
+        "p95": round(percentile(latencies_ms, 0.95), 1),
+        "p99": round(percentile(latencies_ms, 0.99), 1),
+        "max": round(max(latencies_ms), 1)
+    }
+
+
+class WorkerClient:
+    """Resident worker subprocess with responses matched to requests by id."""
+
+    def __init__(self, args):
+        command = [args.python, _worker_script, "--serve", *shlex.split(args.worker_args)]
+        self.process = subprocess.Popen(command, stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                                        stderr=None if args.verbose else subprocess.DEVNULL)
+        self._write_lock = threading.Lock()
+        self._pending = {}
+        self._pending_lock = threading.Lock()
+        self._reader = threading.Thread(target=self._read_responses, name="responses", daemon=True)
+        self._reader.start()
+
+    def _read_responses(self):
+        for line in self.process.stdout:
+            try:
+                response = json.loads(line.decode("utf-8"))
+            except ValueError:
+                continue
+            with self._pending_lock:
+                waiter = self._pending.pop(response.get("id"), None)
+            if waiter is not None:
+                waiter["received"] = time.perf_counter()
+                waiter["response"] = response
+                waiter["done"].set()
+        # Worker exited: fail whatever is still outstanding
+        with self._pending_lock:
+            waiters, self._pending = list(self._pending.values()), {}
+        for waiter in waiters:
+            waiter["done"].set()
+
+    def send(self, request: dict, on_done=None) -> dict:
+        """Send a request; the returned waiter gets "response" and "received" when it completes."""
+        waiter = {"done": threading.Event(), "response": None, "received": None, "sent": time.perf_counter()}
+        if on_done is not None:
+            threading.Thread(target=lambda: (waiter["done"].wait(), on_done()), daemon=True).start()
+        with self._pending_lock:
+            self._pending[request["id"]] = waiter
+        payload = (json.dumps(request, ensure_ascii=False) + "\n").encode("utf-8")
+        try:
+            with self._write_lock:
+                self.process.stdin.write(payload)
+                self.process.stdin.flush()
+        except OSError:
+            with self._pending_lock:
+                self._pending.pop(request["id"], None)
+            waiter["done"].set()
+        return waiter
+
+    def close(self, timeout: float):
+        try:
+            with self._write_lock:
+                self.process.stdin.write(b'{"command": "shutdown", "id": "shutdown"}\n')
+                self.process.stdin.flush()
+                self.process.stdin.close()
+            self.process.wait(timeout=timeout)
+        except (OSError, subprocess.TimeoutExpired):
+            self.process.kill()
+
+
+def replay(client: WorkerClient, schedule: list, args) -> list:
+    """Send the schedule open-loop with at most args.concurrency in flight; returns one record per request."""
+    slots = threading.Semaphore(max(1, args.concurrency))
+    records = []
+    start = time.perf_counter()
+    for index, (send_at, request) in enumerate(schedule):
+        delay = start + send_at - time.perf_counter()
+        if delay > 0:
+            time.sleep(delay)
+        # A worker that stops answering must not stall the replay; requests that find no free slot
+        # are recorded as timeouts without being sent, so the slot count never exceeds --concurrency
+        request = dict(request, id=f"load-{index}")
+        if slots.acquire(timeout=args.timeout):
+            waiter = client.send(request, on_done=slots.release)
+        else:
+            waiter = {"done": threading.Event(), "response": None, "received": None, "sent": time.perf_counter()}
+            waiter["done"].set()
+        records.append({"scheduled": start + send_at, "request": request, "waiter": waiter})
+    deadline = time.perf_counter() + args.timeout
+    for record in records:
+        record["waiter"]["done"].wait(max(0.0, deadline - time.perf_counter()))
+    return records
+
+
+def _status_of(response) -> tuple:
+    """(ok, error class) of a worker response; a missing response counts as a timeout."""
+    if response is None:
+        return False, "timeout"
+    if response.get("status") == "ok":
+        return True, None
+    return False, response.get("error_class") or "error"
+
+
+def summarize(records: list, args) -> dict:
+    """Throughput, latency percentiles, interval fit and error rates, overall and per model."""
+    service_ms, end_to_end_ms, errors, by_model = [], [], {}, {}
+    first_send = min((record["waiter"]["sent"] for record in records), default=0.0)
+    last_received = first_send
+    for record in records:
+        waiter = record["waiter"]
+        ok, error_class = _status_of(waiter["response"])
+        model = record["request"].get("model_id") or ("pipeline" if "pipeline" in record["request"] else "other")
+        model_stats = by_model.setdefault(model, {"count": 0, "errors": 0, "service_ms": []})
+        model_stats["count"] += 1
+        if not ok:
+            errors[error_class] = errors.get(error_class, 0) + 1
+            model_stats["errors"] += 1
+            continue
+        last_received = max(last_received, waiter["received"])
+        service_ms.append((waiter["received"] - waiter["sent"]) * 1000)
+        end_to_end_ms.append((waiter["received"] - record["scheduled"]) * 1000)
+        model_stats["service_ms"].append(service_ms[-1])
+
+    wall_seconds = max(last_received - first_send, 1e-9)
+    completed = len(service_ms)
+    return {
+        "requests": len(records),
+        "completed": completed,
+        "error_rate": round(1 - completed / len(records), 4) if records else 0.0,
+        "errors_by_class": errors,
+        "throughput_rps": round(completed / wall_seconds, 2),
+        "wall_seconds": round(wall_seconds, 2),
+        "service_latency_ms": _latency_summary(service_ms),
+        "end_to_end_latency_ms": _latency_summary(end_to_end_ms),
+        "within_interval": round(sum(1 for value in end_to_end_ms if value <= args.interval_ms) / completed, 4) if completed else 0.0,
+        "by_model": {
+            model: {"count": stats["count"], "errors": stats["errors"], "service_latency_ms": _latency_summary(stats["service_ms"])}
+            for model, stats in by_model.items()
+        }
+    }
+
+
+def main() -> int:
+    args = parse_arguments()
+    entries = load_recording(args.recording)
+    if not entries:
+        print(f"ERROR: No recorded requests in {args.recording}", file=sys.stderr)
+        return 1
+    schedule = build_schedule(entries, args)
+
+    client = WorkerClient(args)
+    try:
+        for index, (_, request) in enumerate(schedule[:args.warmup]):
+            print(f"Warm-up request {index + 1}/{args.warmup}...", file=sys.stderr)
+            client.send(dict(request, id=f"warmup-{index}"))["done"].wait(args.timeout)
+        print(f"Replaying {len(schedule)} requests (concurrency {args.concurrency}, "
+              f"{f'{args.rate} req/s' if args.rate else f'recorded spacing x{args.speed}'})...", file=sys.stderr)
+        records = replay(client, schedule, args)
+    finally:
+        client.close(args.timeout)
+
+    report = {
+        "recording": os.path.abspath(args.recording),
+        "settings": {"concurrency": args.concurrency, "rate": args.rate, "speed": args.speed, "repeat": args.repeat,
+                     "warmup": args.warmup, "interval_ms": args.interval_ms, "worker_args": args.worker_args},
+        "results": summarize(records, args)
+    }
+    output = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            f.write(output)
+    print(output)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
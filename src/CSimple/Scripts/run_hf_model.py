@@ -19,6 +19,11 @@ import time
 import json
 import re
 import logging
+import threading
+import hashlib
+from collections import OrderedDict, deque
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait as wait_futures
 
 # Fix Windows console encoding issues for Unicode characters
 if sys.platform.startswith('win'):
@@ -46,9 +51,225 @@ transformers = None
 _model_cache = {}
 _tokenizer_cache = {}
 
+# Resident vision-language models: cache_key -> (model, processor, tokenizer)
+_vision_model_cache = {}
+
+# Compiled execution (see compile_for_inference): cache_key -> compile record; artifacts persist in the state dir
+_compiled_models = {}
+_compile_manifest_lock = threading.Lock()
+_compile_manifest_name = "manifest.json"
+_static_cache_min_tokens = 128
+
+# Prompt shape buckets for compiled prefill (see prompt_bucket): fitted to observed prompt lengths, persisted in the manifest
+_prompt_stats = {}
+_prompt_bucket_lock = threading.Lock()
+_prompt_length_window = 512
+_prompt_refit_interval = 32
+_prompt_max_buckets = 4
+_prompt_max_padding = 0.25
+_prompt_alignment = 16
+
+# Resident BLIP captioning models (cache_key -> (model, processor)) and speech-recognition pipelines
+_captioning_model_cache = {}
+_speech_pipeline_cache = {}
+
+# ONNX Runtime backend for Whisper and BLIP (see get_or_load_onnx_model): (model path, precision, threads) -> sessions
+_onnx_model_cache = {}
+_onnx_failed_models = set()
+_onnx_unexported_models = set()
+_onnx_export_name = "export.json"
+_onnx_export_version = 2
+# Generation settings (with their no-op values) that the ONNX decoding loops do not implement
+_onnx_unsupported_generation_settings = {"repetition_penalty": 1.0, "no_repeat_ngram_size": 0, "min_length": 0, "min_new_tokens": 0,
+                                         "bad_words_ids": None, "forced_bos_token_id": None, "forced_eos_token_id": None,
+                                         "diversity_penalty": 0.0, "do_sample": False}
+_captioning_num_beams = 5
+_onnx_opset = 17
+_onnx_model_types = {"automatic-speech-recognition": "whisper", "image-to-text": "blip"}
+_whisper_chunk_seconds = 30
+
 # Global environment setup flag to avoid repeated setup
 _environment_setup_done = False
 
+# Per-model load locks so a background warm-up and the first real request never load the same model twice
+_model_load_locks = {}
+_model_load_locks_guard = threading.Lock()
+
+# Background warm-up state (see start_model_warmup)
+_warmup_executor = None
+_warmup_futures = {}
+_model_readiness = {}
+_warmup_reserved_mb = 0.0
+_warmup_state_lock = threading.Lock()
+
+# Model weight file extensions used when estimating the memory footprint of a model
+_weight_file_extensions = ('.safetensors', '.bin', '.pt', '.pth', '.gguf')
+
+# Resource locations - overridable via environment (CSIMPLE_RESOURCES_DIR, CSIMPLE_MODEL_CACHE_DIR,
+# CSIMPLE_AUDIO_OUTPUT_DIR) or --cache_dir / --audio_output_dir, resolved once per process
+_default_resources_dir = os.path.join(os.path.expanduser("~"), "Documents", "CSimple", "Resources")
+_resource_dir_overrides = {}
+_resource_dir_cache = {}
+
+# Memoized local-path vs Hub decisions: (model_id, local_model_path) -> (path_to_use, is_local)
+_model_path_cache = {}
+
+# Inference scheduler: worker threads, intra-op threads while inferences run concurrently, per-model concurrency slots
+_scheduler_config = {"workers": None, "intra_op_threads": None, "intra_op_explicit": False, "inter_op_threads": None, "model_concurrency": 1}
+_thread_split_applied = False
+_inference_executor = None
+_inference_executor_lock = threading.Lock()
+
+# Hardware-aware runtime profile persisted in the state dir (see load_hardware_profile)
+_hardware_profile = None
+_hardware_profile_version = 2
+_hardware_profile_name = "hardware_profile.json"
+_tune_matmul_shape = (64, 2048, 4096)  # prefill tokens x hidden size x MLP width of a ~1B decoder layer
+_tuned_environment = {"KMP_BLOCKTIME": "1", "PYTORCH_CUDA_ALLOC_CONF": "expandable_segments:True"}
+_tune_hidden_size = 768
+_tune_batch_sizes = (1, 2, 4, 8, 16, 32, 64)
+_tune_min_dtype_speedup = 1.15
+_model_slots = {}
+_model_slots_guard = threading.Lock()
+_stdout_lock = threading.Lock()
+
+# Image preprocessing caches (see get_pixel_values / load_image_for_model)
+_file_digest_cache = OrderedDict()
+_file_digest_cache_size = 4096
+_file_digest_lock = threading.Lock()
+_pixel_values_cache = OrderedDict()
+_pixel_values_cache_size = 64
+_decoded_image_cache = OrderedDict()
+_decoded_image_cache_size = 16
+_image_cache_lock = threading.Lock()
+_processor_config_keys = {}
+_default_max_image_side = 1280
+
+# Perceptual-hash deduplication of near-identical frames (see find_similar_frame_result)
+_dhash_cache = OrderedDict()
+_dhash_cache_size = 4096
+_frame_index = None
+_frame_index_lock = threading.Lock()
+_frame_index_entries_per_key = 16
+_frame_index_max_keys = 64
+_frame_index_mtime = None
+_dhash_grid = 4
+_default_phash_threshold = -1
+_default_phash_max_age = 60.0
+
+# Region-of-change cropping for vision-language inference (see plan_changed_region_inference)
+_session_frames = {}
+_session_frames_lock = threading.Lock()
+_session_frame_side = 320
+_roi_tile_pixels = 8
+_roi_pixel_threshold = 24
+_default_roi_max_fraction = 0.4
+_default_roi_refresh_frames = 5
+_full_frame_description_prompt = "Describe this screen in detail: the open windows and applications, visible text, and the buttons, fields and menus with their approximate positions."
+
+# Vision-encoder outputs reused across prompts about the same image (see enable_vision_embedding_cache)
+_vision_embedding_cache = OrderedDict()  # key -> (encoder output, approximate bytes)
+_default_vision_cache_mb = 256
+_vision_embedding_cache_budget = _default_vision_cache_mb * 1024 * 1024
+_vision_embedding_lock = threading.Lock()
+_vision_embedding_stats = {"hits": 0, "misses": 0, "evictions": 0}
+_vision_embedding_scope = threading.local()
+_vision_encoder_attributes = ("vision_model", "visual", "vision_tower", "vision_encoder")
+
+# Optional tracing spans (see enable_tracing / trace_span); None while tracing is off
+_trace_events = None
+_trace_origin = 0.0
+_trace_lock = threading.Lock()
+
+# Prometheus metrics (see format_prometheus_metrics); all guarded by _metrics_lock
+_metrics_lock = threading.Lock()
+_request_counts = {}
+_latency_histograms = {}
+_latency_buckets_seconds = (0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+_batch_size_histogram = {}
+_batch_size_buckets = (1, 2, 4, 8, 16, 32)
+_cache_event_counts = {}
+_worker_queue_state = {"queued": 0, "in_flight": 0, "scheduler": 0}  # scheduler: map_inference items submitted and not yet finished
+
+# Memory accounting for the resident worker (see track_request_memory / get_memory_report)
+_memory_request_log = deque(maxlen=256)
+_memory_log_lock = threading.Lock()
+_memory_baseline = None
+_memory_retained_threshold_mb = 8.0
+_tracemalloc_frames = 4
+_peak_rss_sample_interval = 0.01  # Seconds between RSS samples while an inference runs (see run_model_with_envelope)
+
+# Profiler mode (see profile_model_runs): inference phases become torch.profiler ranges while active
+_profiling_active = False
+_profile_sample_interval = 0.005
+_profile_idle_files = ("threading.py", "queue.py", "selectors.py", "socketserver.py")
+# Where self time goes, by (category, filename fragments, function-name fragments); first match wins
+_profile_categories = [
+    ("regex_input_parsing", ("/re/", "\\re\\", "sre_"), ("re.Pattern", "_sre.", "re.Match")),
+    ("tokenizer_processor", ("tokenization", "processing_", "image_processing", "feature_extraction", "/tokenizers/",
+                             "/PIL/", "/librosa/", "/soundfile"), ("tokenizers.",)),
+    ("model_kernels", (), ("torch.", "torch._C", "of 'torch.", "of 'torch._C")),
+    ("torch_python", ("/torch/", "\\torch\\"), ()),
+    ("transformers_python", ("/transformers/", "\\transformers\\"), ()),
+    ("runner_python", ("run_hf_model.py",), ()),
+]
+
+# Per-inference timing and token record (see run_model_with_envelope / inference_phase)
+_inference_record_scope = threading.local()
+_inference_record_lock = threading.Lock()
+
+# Error message fragments -> error class reported in result envelopes (first match wins)
+_error_classes = [
+    ("out_of_memory", ("out of memory", "insufficient gpu memory", "memoryerror", "cannot allocate")),
+    ("missing_dependency", ("not installed", "no module named", "failed to install", "requires a newer version", "pip install")),
+    ("invalid_input", ("no valid", "empty input", "no text provided", "no items", "input received")),
+    ("model_load", ("failed to load", "loading failed", "could not load", "not supported", "does not appear to have", "unrecognized")),
+    ("timeout", ("timed out", "timeout")),
+]
+
+# Embedding service (see run_embedding); indexes live in embedding_index.py next to this script
+_embedding_model_cache = {}
+_embedding_indexes = {}
+_embedding_indexes_lock = threading.Lock()
+_embedding_batch_size = 32
+_image_extensions = ('.jpg', '.jpeg', '.png', '.bmp', '.gif', '.tiff', '.webp')
+
+# Memoized pipeline node outputs: hash of (model, input, referenced file stats, params) -> output
+_node_output_cache = OrderedDict()
+_node_output_cache_size = 256
+_node_output_cache_lock = threading.Lock()
+
+# File paths referenced in node inputs (used to invalidate memoized outputs when a file changes)
+_input_file_pattern = re.compile(
+    r'((?:[A-Za-z]:[\\/]|/)[^:,|;&\[\]\n]*?\.(?:jpg|jpeg|png|bmp|gif|tiff|webp|wav|mp3|m4a|flac|ogg|aac))',
+    re.IGNORECASE
+)
+
+# Request recording for load replay (see record_request and load_generator.py); None while off
+_request_record_path = None
+_request_record_lock = threading.Lock()
+
+# Plain (non-assisted) generation throughput per model: cache_key -> [tokens, seconds]
+_generation_latency_stats = {}
+
+# Statistics of the most recent speculative (assisted) generation run
+_last_speculative_stats = {}
+
+# Whether a draft model shares the main model's vocabulary: (main cache_key, draft_model_id) -> bool
+_draft_vocab_match_cache = {}
+
+# Context management for text generation (see build_context_input_ids)
+_context_window_cache = {}
+_section_token_cache = OrderedDict()
+_section_token_cache_size = 1024
+_section_token_cache_lock = threading.Lock()
+_fast_mode_max_input_tokens = 512
+_fallback_context_window = 2048
+_summary_tokens_per_section = 32
+
+# Pipeline inputs arrive as "[Node Name]: output [Other Node]: output" - split before each node marker or newline
+_context_section_pattern = re.compile(r'\n+|(?=\[[^\[\]\n]{1,80}\]:)')
+
 # Pre-compiled regex patterns for performance
 _audio_patterns = [
     re.compile(r'\]:\s*([A-Z]:[^:]+\.(wav|mp3|m4a|flac|ogg|aac))', re.IGNORECASE),
@@ -67,8 +288,8 @@ def progress_callback(filename: str, current: int, total: int):
 def parse_arguments() -> argparse.Namespace:
     """Parse command line arguments."""
     parser = argparse.ArgumentParser(description="Run inference using HuggingFace models")
-    parser.add_argument("--model_id", type=str, required=True, help="HuggingFace model ID")
-    parser.add_argument("--input", type=str, required=True, help="Input text for the model")
+    parser.add_argument("--model_id", type=str, help="HuggingFace model ID")
+    parser.add_argument("--input", type=str, help="Input text for the model")
     parser.add_argument("--max_length", type=int, default=250, help="Maximum length of generated text (default: 250 tokens, can be higher)")
     parser.add_argument("--temperature", type=float, default=0.7, help="Temperature for sampling")
     parser.add_argument("--top_p", type=float, default=0.9, help="Top-p sampling parameter")
@@ -77,9 +298,53 @@ def parse_arguments() -> argparse.Namespace:
     parser.add_argument("--offline_mode", action="store_true", help="Force offline mode (no API fallback)")
     parser.add_argument("--local_model_path", type=str, help="Local path to model directory (overrides model_id for loading)")
     parser.add_argument("--fast_mode", action="store_true", help="Enable fast mode with minimal output and optimizations")
-    parser.add_argument("--preload_models", type=str, nargs="*", help="Pre-load models into cache for faster subsequent runs")
+    parser.add_argument("--preload_models", type=str, nargs="*", help="Resident worker (--serve): warm up these pipeline models in the background (model_id or model_id=local_path)")
+    parser.add_argument("--warmup_memory_budget_mb", type=float, default=None, help="Memory budget in MB for background model warm-up (default: half of physical RAM if known)")
+    parser.add_argument("--warmup_workers", type=int, default=2, help="Number of models warmed up concurrently")
     parser.add_argument("--batch_size", type=int, default=1, help="Batch size for processing multiple inputs")
-    return parser.parse_args()
+    parser.add_argument("--draft_model_id", type=str, help="Small draft model for speculative (assisted) text generation, e.g. a tiny GPT-2")
+    parser.add_argument("--max_input_tokens", type=int, help="Cap on prompt tokens (default: model context window minus max_length)")
+    parser.add_argument("--stop", type=str, nargs="*", help="Stop generation as soon as any of these strings is produced")
+    parser.add_argument("--response_format", type=str, choices=["text", "json"], default="text", help="Constrain text generation output (json: stop once a complete JSON object is produced)")
+    parser.add_argument("--json_schema", type=str, help="JSON schema (inline JSON or file path) the JSON response must satisfy")
+    parser.add_argument("--pipeline", type=str, help="Pipeline graph (inline JSON or file path) of nodes and edges to execute in this process")
+    parser.add_argument("--inference_workers", type=int, help="Worker threads for independent inferences (default: min(4, CPU cores))")
+    parser.add_argument("--intra_op_threads", type=int, help="torch intra-op threads (default: torch's default for a single request; CPU cores / workers once inferences run concurrently)")
+    parser.add_argument("--inter_op_threads", type=int, help="torch inter-op threads for the process (default: torch default)")
+    parser.add_argument("--model_concurrency", type=int, default=1, help="Inferences allowed to run on the same model at once")
+    parser.add_argument("--serve", action="store_true", help="Run as a resident worker reading JSON requests from stdin, one per line")
+    parser.add_argument("--max_image_side", type=int, default=_default_max_image_side, help="Downscale screenshots for vision-language models so the longer side is at most this many pixels (0 disables)")
+    parser.add_argument("--phash_threshold", type=int, default=_default_phash_threshold, help="Reuse the result of a recent frame when every tile of its perceptual hash is within this Hamming distance (default -1: disabled)")
+    parser.add_argument("--phash_max_age", type=float, default=_default_phash_max_age, help="Seconds a remembered frame result stays eligible for perceptual-hash reuse")
+    parser.add_argument("--session_id", type=str, help="Capture session for frame-diffing vision-language inputs (default: one session per model)")
+    parser.add_argument("--vision_roi", type=str, choices=["auto", "off"], default="off", help="auto: describe full frames and afterwards feed vision-language models only the regions changed since that description (default off: always full frame)")
+    parser.add_argument("--roi_max_fraction", type=float, default=_default_roi_max_fraction, help="Fall back to the full frame when the regions changed since the last full-frame description cover more than this fraction of the screen")
+    parser.add_argument("--vision_cache_mb", type=float, default=_default_vision_cache_mb, help="Memory budget in MB for vision-encoder outputs reused across prompts about the same image (0 disables)")
+    parser.add_argument("--roi_refresh_frames", type=int, default=_default_roi_refresh_frames, help="Process the full frame again after this many consecutive changed-region frames")
+    parser.add_argument("--cache_dir", type=str, help="Model cache directory (default: $CSIMPLE_MODEL_CACHE_DIR or <resources>/HFModels)")
+    parser.add_argument("--audio_output_dir", type=str, help="Directory for synthesized audio (default: $CSIMPLE_AUDIO_OUTPUT_DIR or <resources>/Audio)")
+    parser.add_argument("--embedding_index", type=str, help="Embed the input (one item per line: image path or text) into this index directory instead of generating (relative names live under the state dir)")
+    parser.add_argument("--embedding_action", type=str, choices=["add", "search"], default="add", help="Add the input items to the embedding index, or search it for the items most similar to the input")
+    parser.add_argument("--top_k", type=int, default=5, help="Number of results returned by an embedding index search")
+    parser.add_argument("--trace", type=str, help="Record tracing spans (setup, parsing, model resolution, load, preprocess, generate, decode, output) and write them to this file as Chrome trace-event JSON; a one-line summary goes to stderr")
+    parser.add_argument("--compile", type=str, choices=["off", "torch"], default="off", help="Compile resident text-generation, BLIP and Whisper models with torch.compile; compiled kernels persist in the state dir per model revision and shape bucket")
+    parser.add_argument("--backend", type=str, choices=["auto", "pytorch", "onnx"], default="auto", help="Inference backend for Whisper and BLIP: onnx exports encoder/decoder graphs to the state dir once and runs them with ONNX Runtime; auto uses ONNX Runtime only for models already exported; anything unavailable falls back to transformers")
+    parser.add_argument("--onnx_precision", type=str, choices=["int8", "fp32"], default="int8", help="ONNX Runtime graphs to run: dynamically quantized int8 weights or the fp32 export")
+    parser.add_argument("--onnx_threads", type=int, help="ONNX Runtime intra-op threads per session (default: all cores, or the per-worker share once inferences run concurrently)")
+    parser.add_argument("--auto_tune", type=str, choices=["on", "off", "refresh"], default="on", help="Probe and benchmark this machine once, persist the chosen threads, workers, CPU dtype and batch sizes in the state dir and reuse them (refresh: re-tune now)")
+    parser.add_argument("--cpu_dtype", type=str, choices=["float32", "auto", "bfloat16", "float16"], default="float32", help="Weight dtype for models on CPU (auto: the tuned dtype, reduced precision only where the CPU runs it fast)")
+    parser.add_argument("--record_requests", type=str, help="Append each inference/pipeline request (with copies of referenced screenshots and audio) to this JSONL file for replay with load_generator.py")
+    parser.add_argument("--track_memory", action="store_true", help="Resident worker: trace Python allocations (tracemalloc) from startup so the memory command can attribute heap growth per request and allocation site")
+    parser.add_argument("--profile", type=int, nargs="?", const=1, metavar="RUNS", help="Profile the inference (repeated RUNS times) with torch.profiler, cProfile and a stack sampler; writes operator and Python hotspot tables plus flamegraph-compatible collapsed stacks")
+    parser.add_argument("--profile_dir", type=str, help="Directory for --profile reports (default: <state dir>/Profiles/<timestamp>-<model>)")
+    parser.add_argument("--metrics_port", type=int, help="Serve Prometheus text-format metrics on http://127.0.0.1:<port>/metrics while the process runs")
+    parser.add_argument("--metrics_file", type=str, help="Periodically write Prometheus text-format metrics to this file (for a node-exporter textfile collector)")
+    parser.add_argument("--metrics_interval", type=float, default=15.0, help="Seconds between --metrics_file writes")
+    parser.add_argument("--output_format", type=str, choices=["text", "json", "framed"], default="text", help="Result on stdout as UTF-8 text, a JSON envelope with a status field, or a 'FRAME <status> <byte length>' header line followed by exactly that many UTF-8 bytes")
+    args = parser.parse_args()
+    if not (args.serve or args.pipeline) and (not args.model_id or args.input is None):
+        parser.error("--model_id and --input are required unless --pipeline or --serve is used")
+    return args
 
 
 def check_and_install_package(package_name: str) -> bool:
@@ -99,6 +364,70 @@ def check_and_install_package(package_name: str) -> bool:
         return False
 
 
+def configure_resource_dirs(cache_dir: Optional[str] = None, audio_output_dir: Optional[str] = None):
+    """Override resource locations for this process (must run before setup_environment)."""
+    if cache_dir:
+        _resource_dir_overrides["model_cache"] = cache_dir
+        _resource_dir_cache.pop("model_cache", None)
+    if audio_output_dir:
+        _resource_dir_overrides["audio_output"] = audio_output_dir
+        _resource_dir_cache.pop("audio_output", None)
+
+
+def _resolve_resource_dir(kind: str, env_var: str, default_subdir: str) -> str:
+    """Resolve and create a resource directory once per process."""
+    cached = _resource_dir_cache.get(kind)
+    if cached is not None:
+        return cached
+    
+    resolved = _resource_dir_overrides.get(kind) or os.environ.get(env_var)
+    if not resolved:
+        resources_root = os.environ.get("CSIMPLE_RESOURCES_DIR") or _default_resources_dir
+        resolved = os.path.join(resources_root, default_subdir)
+    resolved = os.path.abspath(os.path.expanduser(resolved))
+    os.makedirs(resolved, exist_ok=True)
+    _resource_dir_cache[kind] = resolved
+    return resolved
+
+
+def get_model_cache_dir() -> str:
+    """Directory holding the HuggingFace model cache."""
+    return _resolve_resource_dir("model_cache", "CSIMPLE_MODEL_CACHE_DIR", "HFModels")
+
+
+def get_audio_output_dir() -> str:
+    """Directory where synthesized audio files are written."""
+    return _resolve_resource_dir("audio_output", "CSIMPLE_AUDIO_OUTPUT_DIR", "Audio")
+
+
+def get_state_dir() -> str:
+    """Directory for small state persisted between script runs (frame index, session frames)."""
+    return _resolve_resource_dir("state", "CSIMPLE_STATE_DIR", "InferenceState")
+
+
+def resolve_model_path(model_id: str, local_model_path: Optional[str] = None) -> tuple:
+    """Decide whether to load from the local model directory or the Hub, memoized per process.
+    
+    Returns (path_to_use, is_local). A local path is only used if it exists and is non-empty;
+    an empty local directory was causing "preprocessor_config.json not found" errors.
+    """
+    key = (model_id, local_model_path)
+    cached = _model_path_cache.get(key)
+    if cached is not None:
+        return cached
+    
+    with trace_span("resolve_model", model_id=model_id):
+        if local_model_path and os.path.isdir(local_model_path) and any(os.scandir(local_model_path)):
+            resolved = (local_model_path, True)
+            print(f"Using valid local model path: {local_model_path}", file=sys.stderr)
+        else:
+            resolved = (model_id, False)
+            print(f"Using HuggingFace Hub model: {model_id} (local path invalid or empty)", file=sys.stderr)
+    
+    _model_path_cache[key] = resolved
+    return resolved
+
+
 def setup_environment() -> bool:
     """Set up the environment with all required packages - optimized for repeated calls."""
     global _environment_setup_done, torch, transformers
@@ -108,8 +437,7 @@ def setup_environment() -> bool:
         return True
     
     # Set up the cache directory BEFORE importing transformers
-    cache_dir = "C:\\Users\\tanne\\Documents\\CSimple\\Resources\\HFModels"
-    os.makedirs(cache_dir, exist_ok=True)
+    cache_dir = get_model_cache_dir()
     os.environ["TRANSFORMERS_CACHE"] = cache_dir
     os.environ["HF_HOME"] = cache_dir
     os.environ["HF_HUB_DISABLE_SYMLINKS_WARNING"] = "1"
@@ -159,6 +487,20 @@ def setup_environment() -> bool:
         transformers.logging.set_verbosity_error()
         logging.getLogger().setLevel(logging.ERROR)
         
+        # Explicit thread settings (inter-op must be set before any parallel work); otherwise a single
+        # request keeps torch's default and the split is applied only once inferences run concurrently
+        allocation = get_thread_allocation()
+        if allocation["inter_op_threads"]:
+            try:
+                torch.set_num_interop_threads(allocation["inter_op_threads"])
+            except RuntimeError as e:
+                print(f"Could not set inter-op threads: {e}", file=sys.stderr)
+        if allocation["intra_op_explicit"]:
+            torch.set_num_threads(allocation["intra_op_threads"])
+        if _hardware_profile is not None and _hardware_profile["hardware"].get("torch_version") != torch.__version__:
+            print("torch changed since this machine was tuned; re-tuning (thread settings apply from the next start)", file=sys.stderr)
+            load_hardware_profile("refresh")
+        
         # Optimize torch settings for inference speed (do this once)
         if torch.cuda.is_available():
             torch.backends.cudnn.benchmark = True
@@ -228,7 +570,8 @@ def run_text_generation(model_id: str, input_text: str, params: Dict[str, Any],
         fast_mode = params.get("fast_mode", False)
         
         # Get cached or load model (optimized caching)
-        model, tokenizer = get_or_load_model(model_id, params, local_model_path)
+        with inference_phase("model_load"):
+            model, tokenizer = get_or_load_model(model_id, params, local_model_path)
         
         # Minimal input validation for speed
         clean_input = input_text.strip()
@@ -239,24 +582,43 @@ def run_text_generation(model_id: str, input_text: str, params: Dict[str, Any],
         if tokenizer.pad_token is None:
             tokenizer.pad_token = tokenizer.eos_token
         
-        # Highly optimized tokenization for maximum speed
-        max_input_length = 128 if fast_mode else 256  # Even shorter for fast mode
-        inputs = tokenizer(
-            clean_input,
-            return_tensors="pt",
-            truncation=True,
-            max_length=max_input_length,
-            padding=False,
-            add_special_tokens=True
-        )
-        
-        # Direct device placement for speed
-        device = next(model.parameters()).device
-        inputs = {k: v.to(device, non_blocking=True) for k, v in inputs.items()}
+        # Structured output: instructions plus an opening brace are appended after the (truncated) input
+        json_mode = params.get("response_format") == "json"
+        json_schema = _load_json_schema(params.get("json_schema")) if json_mode else None
+        prompt_suffix = _build_json_prompt_suffix(json_schema) if json_mode else ""
         
         # Ultra-optimized generation parameters with 100 token hard limit
         max_new_tokens = 20 if fast_mode else min(params.get("max_length", 150), 500)  # Increased cap to 500 tokens
         
+        # Fit the input into the model's real context window, compressing older pipeline sections if needed
+        preprocess_start = time.perf_counter()
+        cache_key = model_cache_key(model_id, local_model_path)
+        suffix_ids = _tokenize_context_section(cache_key, tokenizer, prompt_suffix) if prompt_suffix else []
+        input_budget = _get_context_window(cache_key, model, tokenizer) - max_new_tokens - len(suffix_ids)
+        max_input_tokens = params.get("max_input_tokens") or (_fast_mode_max_input_tokens if fast_mode else None)
+        if max_input_tokens:
+            input_budget = min(input_budget, max_input_tokens)
+        input_ids = build_context_input_ids(cache_key, tokenizer, clean_input, max(input_budget, 1)) + suffix_ids
+        
+        # Direct device placement for speed
+        device = next(model.parameters()).device
+        input_tensor = torch.tensor([input_ids], dtype=torch.long, device=device)
+        inputs = {"input_ids": input_tensor, "attention_mask": torch.ones_like(input_tensor)}
+        
+        # Compiled models prefill at a bucketed prompt length (masked left padding), so nearby lengths share one graph
+        prefill_length = None
+        compiled = cache_key in _compiled_models and not params.get("draft_model_id")
+        if compiled and hasattr(model.generation_config, "prefill_chunk_size"):
+            context_window = _get_context_window(cache_key, model, tokenizer)
+            prefill_length = prompt_bucket(cache_key, len(input_ids), context_window - max_new_tokens)
+            padding = prefill_length - len(input_ids)
+            if padding > 0:
+                inputs = {
+                    "input_ids": torch.cat([torch.full((1, padding), tokenizer.pad_token_id, dtype=torch.long, device=device), input_tensor], dim=1),
+                    "attention_mask": torch.cat([torch.zeros((1, padding), dtype=torch.long, device=device), inputs["attention_mask"]], dim=1)
+                }
+        record_phase_time("preprocess", preprocess_start)
+        
         # Fastest possible generation settings with randomness enabled
         generation_kwargs = {
             "max_new_tokens": max_new_tokens,
@@ -273,43 +635,94 @@ def run_text_generation(model_id: str, input_text: str, params: Dict[str, Any],
             "repetition_penalty": 1.1  # Reduce repetition
         }
         
-        # Inference with minimal overhead
-        with torch.no_grad():
-            outputs = model.generate(**inputs, **generation_kwargs)
-        
-        # Fast decode with minimal processing
-        generated_text = tokenizer.decode(outputs[0], skip_special_tokens=True, clean_up_tokenization_spaces=False)
+        # Bucketed prefill pads on the left; keep those positions out of the repetition penalty
+        padding = inputs["input_ids"].shape[1] - len(input_ids)
+        if padding > 0:
+            from transformers import LogitsProcessorList
+            generation_kwargs["logits_processor"] = LogitsProcessorList([
+                _PaddedRepetitionPenaltyProcessor(generation_kwargs.pop("repetition_penalty"), padding)
+            ])
+        
+        # Halt decoding as soon as a stop string appears or the JSON object is closed
+        stop_sequences = [stop for stop in (params.get("stop_sequences") or []) if stop]
+        if stop_sequences:
+            generation_kwargs["stop_strings"] = stop_sequences
+            generation_kwargs["tokenizer"] = tokenizer
+        if json_mode:
+            from transformers import StoppingCriteriaList
+            generation_kwargs["stopping_criteria"] = StoppingCriteriaList([
+                _JsonCompleteStoppingCriteria(tokenizer, inputs["input_ids"].shape[1], initial_depth=1)
+            ])
+        
+        # Speculative decoding: the draft model proposes tokens that the main model verifies in one forward pass
+        draft_model_id = params.get("draft_model_id")
+        assistant_model = None
+        if draft_model_id:
+            try:
+                with inference_phase("model_load"):
+                    assistant_model, draft_tokenizer = get_or_load_model(draft_model_id, params)
+                vocab_key = (cache_key, draft_model_id)
+                if vocab_key not in _draft_vocab_match_cache:
+                    _draft_vocab_match_cache[vocab_key] = draft_tokenizer.get_vocab() == tokenizer.get_vocab()
+                # The prompt is budgeted against the target's window; a draft with a smaller window would overflow
+                draft_prompt_tokens = len(input_ids) if _draft_vocab_match_cache[vocab_key] else \
+                    len(draft_tokenizer(tokenizer.decode(input_ids), add_special_tokens=False)["input_ids"])
+                draft_window = _get_context_window(draft_model_id, assistant_model, draft_tokenizer)
+                if draft_prompt_tokens + max_new_tokens > draft_window:
+                    raise ValueError(f"prompt of {draft_prompt_tokens} tokens plus {max_new_tokens} new tokens exceeds "
+                                     f"the draft's {draft_window}-token window")
+                generation_kwargs["assistant_model"] = assistant_model
+                if not _draft_vocab_match_cache[vocab_key]:
+                    # Universal assisted generation re-tokenizes candidates between vocabularies
+                    generation_kwargs["tokenizer"] = tokenizer
+                    generation_kwargs["assistant_tokenizer"] = draft_tokenizer
+            except Exception as e:
+                print(f"Draft model {draft_model_id} unavailable, generating without it: {e}", file=sys.stderr)
+                assistant_model = None
         
-        # Quick input removal
-        if generated_text.startswith(clean_input):
-            generated_text = generated_text[len(clean_input):].strip()
+        # Inference with minimal overhead
+        input_length = inputs["input_ids"].shape[1]
+        if assistant_model is not None:
+            with model_slot(cache_key), model_slot(draft_model_id):
+                with _ForwardCallCounter(model) as target_calls, _ForwardCallCounter(assistant_model) as draft_calls:
+                    generation_start = time.perf_counter()
+                    with torch.no_grad():
+                        outputs = model.generate(**inputs, **generation_kwargs)
+                    generation_time = time.perf_counter() - generation_start
+            _report_speculative_stats(cache_key, draft_model_id, outputs.shape[1] - input_length,
+                                      generation_time, target_calls.count, draft_calls.count)
+        else:
+            if cache_key in _compiled_models:
+                # Compiled decoding needs a static KV cache; its length is bucketed so few shapes get compiled
+                if prefill_length is not None:
+                    generation_kwargs["prefill_chunk_size"] = prefill_length
+                generation_kwargs["cache_implementation"] = "static"
+                generation_kwargs["max_cache_len"] = static_cache_length(cache_key, input_length + max_new_tokens,
+                                                                         _get_context_window(cache_key, model, tokenizer))
+            generation_start = time.perf_counter()
+            with model_slot(cache_key), torch.no_grad():
+                outputs = model.generate(**inputs, **generation_kwargs)
+            stats = _generation_latency_stats.setdefault(cache_key, [0, 0.0])
+            stats[0] += outputs.shape[1] - input_length
+            stats[1] += time.perf_counter() - generation_start
+        record_phase_time("inference", generation_start)
+        record_generated_tokens(outputs.shape[1] - input_length)
+        
+        # Decode only the newly generated tokens - no prompt echo to strip
+        with inference_phase("decode"):
+            generated_text = tokenizer.decode(outputs[0][input_length:], skip_special_tokens=True, clean_up_tokenization_spaces=False).strip()
+        
+        # Cut at the first stop string (generation halts once it is produced, but it is still part of the output)
+        for stop in stop_sequences:
+            stop_index = generated_text.find(stop)
+            if stop_index != -1:
+                generated_text = generated_text[:stop_index].rstrip()
+        
+        if json_mode:
+            return _finalize_json_response("{" + generated_text, json_schema)
         
-        # Quick validation
         if not generated_text:
-            # Try alternative approach for empty results
-            try:
-                # Fallback: try with different parameters
-                fallback_kwargs = generation_kwargs.copy()
-                fallback_kwargs.update({
-                    'max_new_tokens': 30,
-                    'temperature': 0.9,
-                    'do_sample': True
-                })
-                
-                with torch.no_grad():
-                    fallback_outputs = model.generate(**inputs, **fallback_kwargs)
-                
-                fallback_text = tokenizer.decode(fallback_outputs[0], skip_special_tokens=True, clean_up_tokenization_spaces=False)
-                
-                if fallback_text.startswith(clean_input):
-                    fallback_text = fallback_text[len(clean_input):].strip()
-                
-                if fallback_text:
-                    return fallback_text
-                else:
-                    return f"No text generated - model may need different parameters for this input."
-            except:
-                return f"No text generated - model processing completed but returned empty result."
+            return "No text generated - model may need different parameters for this input."
         
         return generated_text
         
@@ -319,6 +732,286 @@ def run_text_generation(model_id: str, input_text: str, params: Dict[str, Any],
 
         
 
+def _get_context_window(cache_key: str, model, tokenizer) -> int:
+    """Return the model's real context window in tokens, memoized per model."""
+    cached = _context_window_cache.get(cache_key)
+    if cached is not None:
+        return cached
+    
+    window = None
+    config = getattr(model, "config", None)
+    for attribute in ("max_position_embeddings", "n_positions", "max_sequence_length", "seq_length", "n_ctx"):
+        value = getattr(config, attribute, None)
+        if isinstance(value, int) and value > 0:
+            window = value
+            break
+    # Tokenizers without a configured limit report a huge sentinel value
+    tokenizer_limit = getattr(tokenizer, "model_max_length", None)
+    if isinstance(tokenizer_limit, int) and 0 < tokenizer_limit < 1_000_000:
+        window = min(window, tokenizer_limit) if window else tokenizer_limit
+    
+    window = window or _fallback_context_window
+    _context_window_cache[cache_key] = window
+    return window
+
+
+def _tokenize_context_section(cache_key: str, tokenizer, text: str) -> list:
+    """Token ids of a prompt section without special tokens, cached across calls (LRU)."""
+    key = (cache_key, text)
+    with _section_token_cache_lock:
+        ids = _section_token_cache.get(key)
+        if ids is not None:
+            _section_token_cache.move_to_end(key)
+            return ids
+    
+    ids = tokenizer(text, add_special_tokens=False)["input_ids"]
+    with _section_token_cache_lock:
+        _section_token_cache[key] = ids
+        while len(_section_token_cache) > _section_token_cache_size:
+            _section_token_cache.popitem(last=False)
+    return ids
+
+
+def build_context_input_ids(cache_key: str, tokenizer, text: str, budget: int) -> list:
+    """Tokenize a prompt and fit it into a token budget.
+    
+    A prompt that fits is tokenized verbatim, so the model sees exactly the tokens of the
+    text it was given. Only an overflowing prompt is split into sections (reusing cached
+    token ids of unchanged sections such as upstream node outputs): the first section
+    (instructions) and last section (most recent context) are kept, older middle sections
+    are shortened to their first few tokens and then dropped oldest-first, and as a last
+    resort the head and tail tokens of what remains are kept.
+    """
+    verbatim_ids = tokenizer(text, add_special_tokens=True)["input_ids"]
+    if len(verbatim_ids) <= budget:
+        return verbatim_ids
+    
+    special_ids = tokenizer("", add_special_tokens=True)["input_ids"]
+    budget = max(budget - len(special_ids), 1)
+    
+    sections = [section.strip() for section in _context_section_pattern.split(text) if section and section.strip()]
+    if not sections:
+        return special_ids
+    
+    newline_ids = _tokenize_context_section(cache_key, tokenizer, "\n")
+    section_ids = [_tokenize_context_section(cache_key, tokenizer, section) for section in sections]
+    
+    def join(parts):
+        joined = []
+        for index, part in enumerate(parts):
+            if index:
+                joined.extend(newline_ids)
+            joined.extend(part)
+        return joined
+    
+    input_ids = join(section_ids)
+    if len(input_ids) <= budget:
+        return special_ids + input_ids
+    
+    # Summarize older node outputs (everything between the head and the latest section) by their opening tokens
+    ellipsis_ids = _tokenize_context_section(cache_key, tokenizer, " ...")
+    for index in range(1, len(section_ids) - 1):
+        if len(section_ids[index]) > _summary_tokens_per_section:
+            section_ids[index] = section_ids[index][:_summary_tokens_per_section] + ellipsis_ids
+            input_ids = join(section_ids)
+            if len(input_ids) <= budget:
+                return special_ids + input_ids
+    
+    # Drop older middle sections entirely, oldest first
+    while len(section_ids) > 2 and len(join(section_ids)) > budget:
+        del section_ids[1]
+    input_ids = join(section_ids)
+    if len(input_ids) <= budget:
+        return special_ids + input_ids
+    
+    # Keep the head and the tail of the remaining tokens
+    head_length = budget // 4
+    tail_length = budget - head_length - len(ellipsis_ids)
+    if tail_length <= 0:
+        return special_ids + input_ids[-budget:]
+    return special_ids + input_ids[:head_length] + ellipsis_ids + input_ids[-tail_length:]
+
+
+def _load_json_schema(schema_arg: Optional[str]) -> Optional[dict]:
+    """Load a JSON schema given inline or as a file path."""
+    if not schema_arg:
+        return None
+    if os.path.isfile(schema_arg):
+        with open(schema_arg, "r", encoding="utf-8") as schema_file:
+            return json.load(schema_file)
+    return json.loads(schema_arg)
+
+
+def _build_json_prompt_suffix(json_schema: Optional[dict]) -> str:
+    """Prompt suffix asking for a JSON object, ending in the opening brace the model continues from."""
+    if json_schema:
+        return f"\nRespond only with a JSON object matching this schema: {json.dumps(json_schema, separators=(',', ':'))}\n{{"
+    return "\nRespond only with a JSON object.\n{"
+
+
+class _JsonCompleteStoppingCriteria:
+    """Stop generation once the top-level JSON object being generated is closed.
+    
+    Tracks brace depth outside of string literals incrementally, one new token per step.
+    """
+    
+    def __init__(self, tokenizer, prompt_length: int, initial_depth: int = 0):
+        self.tokenizer = tokenizer
+        self.scanned_length = prompt_length
+        self.depth = initial_depth
+        self.in_string = False
+        self.escaped = False
+        self.complete = False
+    
+    def _scan(self, text: str):
+        for char in text:
+            if self.in_string:
+                if self.escaped:
+                    self.escaped = False
+                elif char == "\\":
+                    self.escaped = True
+                elif char == '"':
+                    self.in_string = False
+            elif char == '"':
+                self.in_string = True
+            elif char in "{[":
+                self.depth += 1
+            elif char in "}]":
+                self.depth -= 1
+                if self.depth <= 0:
+                    self.complete = True
+                    return
+    
+    def __call__(self, input_ids, scores, **kwargs):
+        if not self.complete and input_ids.shape[1] > self.scanned_length:
+            new_tokens = input_ids[0, self.scanned_length:].tolist()
+            self.scanned_length = input_ids.shape[1]
+            self._scan(self.tokenizer.decode(new_tokens, skip_special_tokens=True))
+        return torch.full((input_ids.shape[0],), self.complete, dtype=torch.bool, device=input_ids.device)
+
+
+class _PaddedRepetitionPenaltyProcessor:
+    """Repetition penalty that skips the left padding of a bucketed prompt.
+    
+    Padding usually reuses the EOS id, so the stock penalty would make ending a response less likely.
+    """
+    
+    def __init__(self, penalty: float, padding: int):
+        self.penalty = penalty
+        self.padding = padding
+    
+    def __call__(self, input_ids, scores):
+        token_ids = input_ids[:, self.padding:]
+        score = torch.gather(scores, 1, token_ids)
+        score = torch.where(score < 0, score * self.penalty, score / self.penalty)
+        return scores.scatter(1, token_ids, score)
+
+
+def _validate_json_schema(value: Any, schema: dict, path: str = "$") -> Optional[str]:
+    """Minimal JSON-schema check (type, required, properties, items, enum). Returns an error or None."""
+    type_checks = {
+        "object": lambda v: isinstance(v, dict),
+        "array": lambda v: isinstance(v, list),
+        "string": lambda v: isinstance(v, str),
+        "number": lambda v: isinstance(v, (int, float)) and not isinstance(v, bool),
+        "integer": lambda v: isinstance(v, int) and not isinstance(v, bool),
+        "boolean": lambda v: isinstance(v, bool),
+        "null": lambda v: v is None
+    }
+    expected_type = schema.get("type")
+    if isinstance(expected_type, str) and expected_type in type_checks and not type_checks[expected_type](value):
+        return f"{path} should be of type {expected_type}"
+    if "enum" in schema and value not in schema["enum"]:
+        return f"{path} should be one of {schema['enum']}"
+    if isinstance(value, dict):
+        for key in schema.get("required", []):
+            if key not in value:
+                return f"{path} is missing required property '{key}'"
+        for key, property_schema in schema.get("properties", {}).items():
+            if key in value and isinstance(property_schema, dict):
+                error = _validate_json_schema(value[key], property_schema, f"{path}.{key}")
+                if error:
+                    return error
+    if isinstance(value, list) and isinstance(schema.get("items"), dict):
+        for index, item in enumerate(value):
+            error = _validate_json_schema(item, schema["items"], f"{path}[{index}]")
+            if error:
+                return error
+    return None
+
+
+def _finalize_json_response(text: str, json_schema: Optional[dict]) -> str:
+    """Parse the generated JSON object and return it compactly, or an error if it is invalid."""
+    try:
+        value, _ = json.JSONDecoder().raw_decode(text)
+    except json.JSONDecodeError as e:
+        return f"ERROR: Model did not produce valid JSON ({e.msg}): {text}"
+    if json_schema:
+        schema_error = _validate_json_schema(value, json_schema)
+        if schema_error:
+            return f"ERROR: JSON response does not match schema ({schema_error}): {json.dumps(value, ensure_ascii=False)}"
+    return json.dumps(value, ensure_ascii=False)
+
+
+class _ForwardCallCounter:
+    """Context manager counting forward calls of a module via a forward hook."""
+    
+    def __init__(self, module):
+        self.module = module
+        self.count = 0
+        self._handle = None
+    
+    def _hook(self, *_):
+        self.count += 1
+    
+    def __enter__(self):
+        self._handle = self.module.register_forward_hook(self._hook)
+        return self
+    
+    def __exit__(self, *exc_info):
+        self._handle.remove()
+        return False
+
+
+def _report_speculative_stats(cache_key: str, draft_model_id: str, new_tokens: int, generation_time: float,
+                              target_calls: int, draft_calls: int):
+    """Compute and report acceptance rate and speedup of an assisted generation run.
+    
+    Every verification pass of the target model yields the accepted draft tokens plus one
+    token of its own, so accepted = new_tokens - target_calls. Speedup is measured against
+    earlier plain generations of the same model in this process when available, otherwise
+    estimated as tokens produced per target forward pass.
+    """
+    new_tokens = max(int(new_tokens), 0)
+    accepted = max(new_tokens - target_calls, 0)
+    acceptance_rate = accepted / draft_calls if draft_calls else 0.0
+    tokens_per_target_call = new_tokens / target_calls if target_calls else 0.0
+    
+    baseline_tokens, baseline_seconds = _generation_latency_stats.get(cache_key, (0, 0.0))
+    if baseline_tokens and new_tokens and generation_time > 0:
+        speedup = (baseline_seconds / baseline_tokens) / (generation_time / new_tokens)
+        speedup_source = "measured"
+    else:
+        speedup = tokens_per_target_call
+        speedup_source = "estimated"
+    
+    _last_speculative_stats.clear()
+    _last_speculative_stats.update({
+        "draft_model_id": draft_model_id,
+        "new_tokens": new_tokens,
+        "accepted_tokens": accepted,
+        "proposed_tokens": draft_calls,
+        "acceptance_rate": acceptance_rate,
+        "target_forward_passes": target_calls,
+        "speedup": speedup,
+        "speedup_source": speedup_source,
+        "generation_time": generation_time
+    })
+    print(f"[speculative] draft={draft_model_id} accepted {accepted}/{draft_calls} proposed tokens "
+          f"({acceptance_rate:.0%}), {tokens_per_target_call:.2f} tokens per target pass, "
+          f"speedup {speedup:.2f}x ({speedup_source})", file=sys.stderr)
+
+
 def run_text_to_speech(model_id: str, input_text: str, params: Dict[str, Any], local_model_path: Optional[str] = None) -> str:
     """Run text-to-speech synthesis on input text."""
     try:
@@ -372,16 +1065,12 @@ def run_speecht5_tts(model_id: str, input_text: str, params: Dict[str, Any], loc
         print("Loading SpeechT5 TTS model and processor...", file=sys.stderr)
         
         # Determine model path - CRITICAL FIX: Don't use local path if it's empty
-        if local_model_path and os.path.exists(local_model_path) and os.listdir(local_model_path):
-            model_path_to_use = local_model_path
-            print(f"Using valid local model path: {local_model_path}", file=sys.stderr)
-        else:
-            model_path_to_use = model_id
-            print(f"Using HuggingFace Hub model: {model_id} (local path invalid or empty)", file=sys.stderr)
+        model_path_to_use, is_local_model = resolve_model_path(model_id, local_model_path)
         
-        processor = SpeechT5Processor.from_pretrained(model_path_to_use)
-        model = SpeechT5ForTextToSpeech.from_pretrained(model_path_to_use)
-        vocoder = SpeechT5HifiGan.from_pretrained("microsoft/speecht5_hifigan")
+        with inference_phase("model_load"):
+            processor = SpeechT5Processor.from_pretrained(model_path_to_use)
+            model = SpeechT5ForTextToSpeech.from_pretrained(model_path_to_use)
+            vocoder = SpeechT5HifiGan.from_pretrained("microsoft/speecht5_hifigan")
         
         # Prepare inputs
         inputs = processor(text=input_text, return_tensors="pt")
@@ -390,11 +1079,11 @@ def run_speecht5_tts(model_id: str, input_text: str, params: Dict[str, Any], loc
         speaker_embeddings = torch.tensor([[ 0.0000,  0.0000,  0.0000, ...]]).unsqueeze(0)  # Default speaker embedding
         
         # Generate speech
-        speech = model.generate_speech(inputs["input_ids"], speaker_embeddings, vocoder=vocoder)
+        with inference_phase("inference"):
+            speech = model.generate_speech(inputs["input_ids"], speaker_embeddings, vocoder=vocoder)
         
         # Save audio file
-        output_dir = "C:\\Users\\tanne\\Documents\\CSimple\\Resources\\Audio"
-        os.makedirs(output_dir, exist_ok=True)
+        output_dir = get_audio_output_dir()
         
         timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
         output_file = os.path.join(output_dir, f"tts_output_{timestamp}.wav")
@@ -418,25 +1107,25 @@ def run_mms_tts(model_id: str, input_text: str, params: Dict[str, Any], local_mo
         from datetime import datetime
         
         # Determine model path
-        model_path_to_use = local_model_path if local_model_path and os.path.exists(local_model_path) else model_id
+        model_path_to_use, _ = resolve_model_path(model_id, local_model_path)
         
         print("Loading MMS TTS model...", file=sys.stderr)
-        model = VitsModel.from_pretrained(model_path_to_use)
-        tokenizer = AutoTokenizer.from_pretrained(model_path_to_use)
+        with inference_phase("model_load"):
+            model = VitsModel.from_pretrained(model_path_to_use)
+            tokenizer = AutoTokenizer.from_pretrained(model_path_to_use)
         
         # Prepare inputs
         inputs = tokenizer(input_text, return_tensors="pt")
         
         # Generate speech
-        with torch.no_grad():
+        with inference_phase("inference"), torch.no_grad():
             outputs = model(**inputs)
         
         # Extract waveform
         waveform = outputs.waveform[0].cpu().numpy()
         
         # Save audio file
-        output_dir = "C:\\Users\\tanne\\Documents\\CSimple\\Resources\\Audio"
-        os.makedirs(output_dir, exist_ok=True)
+        output_dir = get_audio_output_dir()
         
         timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
         output_file = os.path.join(output_dir, f"mms_tts_output_{timestamp}.wav")
@@ -460,25 +1149,25 @@ def run_bark_tts(model_id: str, input_text: str, params: Dict[str, Any], local_m
         from datetime import datetime
         
         # Determine model path
-        model_path_to_use = local_model_path if local_model_path and os.path.exists(local_model_path) else model_id
+        model_path_to_use, _ = resolve_model_path(model_id, local_model_path)
         
         print("Loading Bark TTS model...", file=sys.stderr)
-        processor = AutoProcessor.from_pretrained(model_path_to_use)
-        model = BarkModel.from_pretrained(model_path_to_use)
+        with inference_phase("model_load"):
+            processor = AutoProcessor.from_pretrained(model_path_to_use)
+            model = BarkModel.from_pretrained(model_path_to_use)
         
         # Prepare inputs with speaker preset
         inputs = processor(input_text, voice_preset="v2/en_speaker_6")
         
         # Generate speech
-        with torch.no_grad():
+        with inference_phase("inference"), torch.no_grad():
             audio_array = model.generate(**inputs)
         
         # Convert to numpy
         audio_array = audio_array.cpu().numpy().squeeze()
         
         # Save audio file
-        output_dir = "C:\\Users\\tanne\\Documents\\CSimple\\Resources\\Audio"
-        os.makedirs(output_dir, exist_ok=True)
+        output_dir = get_audio_output_dir()
         
         timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
         output_file = os.path.join(output_dir, f"bark_tts_output_{timestamp}.wav")
@@ -502,19 +1191,21 @@ def run_generic_tts(model_id: str, input_text: str, params: Dict[str, Any], loca
         from datetime import datetime
         
         # Determine model path
-        model_path_to_use = local_model_path if local_model_path and os.path.exists(local_model_path) else model_id
+        model_path_to_use, _ = resolve_model_path(model_id, local_model_path)
         
         print("Loading generic TTS model...", file=sys.stderr)
         
         # Create TTS pipeline
-        tts_pipeline = pipeline(
-            "text-to-speech",
-            model=model_path_to_use,
-            trust_remote_code=params.get("trust_remote_code", True)
-        )
+        with inference_phase("model_load"):
+            tts_pipeline = pipeline(
+                "text-to-speech",
+                model=model_path_to_use,
+                trust_remote_code=params.get("trust_remote_code", True)
+            )
         
         # Generate speech
-        result = tts_pipeline(input_text)
+        with inference_phase("inference"):
+            result = tts_pipeline(input_text)
         
         # Extract audio data
         if isinstance(result, dict) and "audio" in result:
@@ -525,8 +1216,7 @@ def run_generic_tts(model_id: str, input_text: str, params: Dict[str, Any], loca
             sample_rate = 22050
         
         # Save audio file
-        output_dir = "C:\\Users\\tanne\\Documents\\CSimple\\Resources\\Audio"
-        os.makedirs(output_dir, exist_ok=True)
+        output_dir = get_audio_output_dir()
         
         timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
         output_file = os.path.join(output_dir, f"generic_tts_output_{timestamp}.wav")
@@ -541,189 +1231,871 @@ def run_generic_tts(model_id: str, input_text: str, params: Dict[str, Any], loca
         return f"ERROR: Generic TTS failed: {e}"
 
 
-def run_vision_language(model_id: str, input_text: str, params: Dict[str, Any], local_model_path: Optional[str] = None) -> str:
-    """Run vision-language models that can process both images and text."""
-    try:
-        print(f"Processing vision-language with model: {model_id}", file=sys.stderr)
-        print(f"Raw input text received: {input_text}", file=sys.stderr)
-        
-        # Parse the multimodal input to extract images and text properly
-        image_paths = []
-        audio_paths = []
-        text_content = []
-        
-        # Split input by common delimiters first
-        input_parts = []
-        if ',' in input_text:
-            input_parts = input_text.split(',')
-        else:
-            input_parts = [input_text]
-        
-        print(f"Split input into {len(input_parts)} parts", file=sys.stderr)
-        
-        # Process each part to categorize as image, audio, or text
-        for i, part in enumerate(input_parts):
-            part = part.strip()
-            print(f"Processing part {i+1}: {part[:100]}...", file=sys.stderr)
-            
-            # Check if this part is an image file
-            if any(ext in part.lower() for ext in ['.jpg', '.jpeg', '.png', '.bmp', '.gif', '.tiff', '.webp']):
-                # Extract image path
-                import re
-                image_patterns = [
-                    r'([A-Z]:[^:,]+\.(jpg|jpeg|png|bmp|gif|tiff|webp))',  # Direct path match
-                    r':\s*([A-Z]:[^:,]+\.(jpg|jpeg|png|bmp|gif|tiff|webp))',  # After colon
-                ]
-                
-                for pattern in image_patterns:
-                    matches = re.findall(pattern, part, re.IGNORECASE)
-                    for match in matches:
-                        if isinstance(match, tuple):
-                            path = match[0].strip()
-                        else:
-                            path = match.strip()
-                        if path and os.path.exists(path):
-                            image_paths.append(path)
-                            print(f"Found image: {path}", file=sys.stderr)
-                            break
-            
-            # Check if this part is an audio file (should be excluded for vision-language models)
-            elif any(ext in part.lower() for ext in ['.wav', '.mp3', '.m4a', '.flac', '.ogg', '.aac']):
-                print(f"Ignoring audio file for vision-language model: {part[:50]}...", file=sys.stderr)
-                continue
-            
-            # Otherwise treat as text content
-            else:
-                # Clean up text content
-                clean_part = part.strip()
-                if clean_part and not clean_part.startswith('C:\\') and ':' in clean_part:
-                    # Extract meaningful text content
-                    if any(keyword in clean_part.lower() for keyword in ['mouse', 'keyboard', 'whisper', 'screen', 'webcam', 'audio', 'eventtype', 'action', 'coordinates']):
-                        text_content.append(clean_part)
-                        print(f"Added text content: {clean_part[:50]}...", file=sys.stderr)
-        
-        # Remove duplicates while preserving order
-        image_paths = list(dict.fromkeys(image_paths))
-        
-        # Combine text content
-        combined_text = '\n'.join(text_content) if text_content else ""
-        
-        print(f"Extracted {len(image_paths)} image(s) and text content: {combined_text[:100]}...", file=sys.stderr)
-        
-        if not image_paths:
-            return "ERROR: No valid image files found for vision-language processing"
-        
-        # Check required libraries
+def _file_digest(path: str) -> str:
+    """Content hash of a file, memoized on (path, mtime, size) so unchanged files are not re-read."""
+    stat = os.stat(path)
+    stat_key = (path, stat.st_mtime_ns, stat.st_size)
+    with _file_digest_lock:
+        digest = _file_digest_cache.get(stat_key)
+        if digest is not None:
+            _file_digest_cache.move_to_end(stat_key)
+            return digest
+    
+    hasher = hashlib.blake2b(digest_size=16)
+    with open(path, "rb") as image_file:
+        for chunk in iter(lambda: image_file.read(1 << 20), b""):
+            hasher.update(chunk)
+    digest = hasher.hexdigest()
+    with _file_digest_lock:
+        _file_digest_cache[stat_key] = digest
+        while len(_file_digest_cache) > _file_digest_cache_size:
+            _file_digest_cache.popitem(last=False)
+    return digest
+
+
+def _processor_target_size(processor) -> Optional[tuple]:
+    """(width, height) a processor resizes images to, or None for dynamic-resolution processors."""
+    image_processor = getattr(processor, "image_processor", processor)
+    size = getattr(image_processor, "size", None)
+    if isinstance(size, int):
+        return (size, size)
+    if isinstance(size, dict):
+        if "height" in size and "width" in size:
+            return (size["width"], size["height"])
+        if "shortest_edge" in size and len(size) == 1:
+            return (size["shortest_edge"], size["shortest_edge"])
+    return None
+
+
+def _processor_config_key(processor, model_key: str) -> str:
+    """Stable key for the image preprocessing configuration of a model's processor, memoized per model cache key."""
+    key = _processor_config_keys.get(model_key)
+    if key is None:
+        image_processor = getattr(processor, "image_processor", processor)
         try:
-            from PIL import Image
-        except ImportError:
+            config = image_processor.to_json_string()
+        except Exception:
+            config = repr(sorted(vars(image_processor).items()))
+        key = f"{type(image_processor).__name__}:{hashlib.blake2b(config.encode('utf-8'), digest_size=8).hexdigest()}"
+        _processor_config_keys[model_key] = key
+    return key
+
+
+def load_image_for_model(path: str, min_size: Optional[tuple] = None, max_side: Optional[int] = None):
+    """Decode an image as RGB at a reduced size where the format allows it.
+    
+    JPEGs are decoded directly at a reduced DCT scale (Image.draft) and other formats are
+    reduced by an integer box factor, never below min_size (the processor's target size).
+    If max_side is set, the result is then downscaled so its longer side fits. Decoded
+    images are cached by content hash, so repeated screenshots skip decode and resize.
+    """
+    from PIL import Image
+    
+    cache_key = (_file_digest(path), min_size, max_side)
+    with _image_cache_lock:
+        cached = _decoded_image_cache.get(cache_key)
+        if cached is not None:
+            _decoded_image_cache.move_to_end(cache_key)
+            return cached
+    
+    image = Image.open(path)
+    width, height = image.size
+    target_width, target_height = min_size or (width, height)
+    if max_side and max(width, height) > max_side:
+        scale = max_side / max(width, height)
+        target_width, target_height = min(target_width, int(width * scale)), min(target_height, int(height * scale))
+    
+    if (target_width, target_height) != (width, height):
+        if image.format == "JPEG":
+            image.draft("RGB", (max(target_width, 1), max(target_height, 1)))
+        else:
+            factor = int(min(width / max(target_width, 1), height / max(target_height, 1)))
+            if factor >= 2:
+                image = image.reduce(factor)
+    image = image.convert("RGB")
+    if max_side and max(image.size) > max_side:
+        image.thumbnail((max_side, max_side), Image.BILINEAR)
+    
+    with _image_cache_lock:
+        _decoded_image_cache[cache_key] = image
+        while len(_decoded_image_cache) > _decoded_image_cache_size:
+            _decoded_image_cache.popitem(last=False)
+    return image
+
+
+def get_pixel_values(path: str, processor, model_key: str):
+    """Preprocessed pixel_values for an image, cached by file content hash and processor config."""
+    cache_key = (_file_digest(path), _processor_config_key(processor, model_key))
+    with _image_cache_lock:
+        cached = _pixel_values_cache.get(cache_key)
+        if cached is not None:
+            _pixel_values_cache.move_to_end(cache_key)
+            count_cache_event("pixel_values", "hit")
+            return cached
+    count_cache_event("pixel_values", "miss")
+    
+    image = load_image_for_model(path, min_size=_processor_target_size(processor))
+    pixel_values = processor(images=image, return_tensors="pt")["pixel_values"]
+    
+    with _image_cache_lock:
+        _pixel_values_cache[cache_key] = pixel_values
+        while len(_pixel_values_cache) > _pixel_values_cache_size:
+            _pixel_values_cache.popitem(last=False)
+            count_cache_event("pixel_values", "eviction")
+    return pixel_values
+
+
+def compute_dhash(path: str) -> list:
+    """Tiled difference hash of an image: one 64-bit dHash per cell of a _dhash_grid x _dhash_grid grid, memoized by file content hash.
+    
+    A single hash of a whole screenshot averages away small UI changes (a toggled checkbox, a new line of text);
+    per-tile hashes keep such a change visible in the tile that contains it.
+    """
+    import numpy as np
+    from PIL import Image
+    
+    digest = _file_digest(path)
+    with _image_cache_lock:
+        cached = _dhash_cache.get(digest)
+        if cached is not None:
+            return cached
+    
+    width, height = 9 * _dhash_grid, 8 * _dhash_grid
+    image = Image.open(path)
+    if image.format == "JPEG":
+        image.draft("L", (width * 4, height * 4))
+    else:
+        factor = int(min(image.size[0] / (width * 4), image.size[1] / (height * 4)))
+        if factor >= 2:
+            image = image.reduce(factor)
+    pixels = np.asarray(image.convert("L").resize((width, height), Image.BOX), dtype=np.int16)
+    
+    dhash = []
+    for tile_row in range(_dhash_grid):
+        for tile_column in range(_dhash_grid):
+            tile = pixels[tile_row * 8:tile_row * 8 + 8, tile_column * 9:tile_column * 9 + 9]
+            tile_hash = 0
+            for bit in (tile[:, :8] > tile[:, 1:]).ravel():
+                tile_hash = (tile_hash << 1) | int(bit)
+            dhash.append(tile_hash)
+    
+    with _image_cache_lock:
+        _dhash_cache[digest] = dhash
+        while len(_dhash_cache) > _dhash_cache_size:
+            _dhash_cache.popitem(last=False)
+    return dhash
+
+
+def dhash_distance(first: list, second: list) -> int:
+    """Largest per-tile Hamming distance between two tiled dHashes (differently shaped hashes never match)."""
+    if len(first) != len(second):
+        return 64
+    return max(bin(a ^ b).count("1") for a, b in zip(first, second))
+
+
+def _frame_index_path() -> str:
+    return os.path.join(get_state_dir(), "frame_index.json")
+
+
+@contextmanager
+def _state_file_lock(path: str):
+    """Exclusive cross-process lock on a sidecar .lock file, so concurrent workers merge into a state file instead of overwriting each other."""
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path + ".lock", "a+b") as lock_file:
+        if os.name == "nt":
+            import msvcrt
+            lock_file.seek(0)
+            msvcrt.locking(lock_file.fileno(), msvcrt.LK_LOCK, 1)
             try:
-                print("Installing Pillow...", file=sys.stderr)
-                subprocess.check_call([sys.executable, "-m", "pip", "install", "Pillow"], 
-                                    stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
-                from PIL import Image
-            except Exception as e:
-                return f"ERROR: Failed to install/import Pillow: {e}"
-        
-        # Determine model path
-        if local_model_path and os.path.exists(local_model_path) and os.listdir(local_model_path):
-            model_path_to_use = local_model_path
-            print(f"Using valid local model path: {local_model_path}", file=sys.stderr)
+                yield
+            finally:
+                lock_file.seek(0)
+                msvcrt.locking(lock_file.fileno(), msvcrt.LK_UNLCK, 1)
         else:
-            model_path_to_use = model_id
-            print(f"Using HuggingFace Hub model: {model_id} (local path invalid or empty)", file=sys.stderr)
-        
-        # Try different approaches for vision-language model loading
-        print("Loading vision-language model...", file=sys.stderr)
-        
-        # Approach 1: Try AutoModel (most general)
-        try:
-            from transformers import AutoModel, AutoTokenizer, AutoProcessor
-            
-            print("Attempting to load with AutoModel...", file=sys.stderr)
-            
-            # Load components
+            import fcntl
+            fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX)
             try:
-                processor = AutoProcessor.from_pretrained(
-                    model_path_to_use,
-                    trust_remote_code=params.get("trust_remote_code", True),
-                    local_files_only=bool(local_model_path and os.path.exists(local_model_path))
-                )
-                print("✓ Processor loaded", file=sys.stderr)
+                yield
+            finally:
+                fcntl.flock(lock_file.fileno(), fcntl.LOCK_UN)
+
+
+def _load_frame_index() -> dict:
+    """The persisted frame index, re-read whenever another process has rewritten it (callers hold _frame_index_lock)."""
+    global _frame_index, _frame_index_mtime
+    try:
+        mtime = os.stat(_frame_index_path()).st_mtime_ns
+    except OSError:
+        mtime = None
+    if _frame_index is None or mtime != _frame_index_mtime:
+        try:
+            with open(_frame_index_path(), "r", encoding="utf-8") as index_file:
+                _frame_index = json.load(index_file)
+        except (OSError, ValueError):
+            _frame_index = {}
+        _frame_index_mtime = mtime
+    return _frame_index
+
+
+def _frame_index_key(model_id: str, params: Dict[str, Any], context: str) -> str:
+    """Frames are only comparable for the same model, generation length, text context and hash layout."""
+    payload = json.dumps([model_id, params.get("max_length"), context, _dhash_grid])
+    return hashlib.blake2b(payload.encode("utf-8"), digest_size=12).hexdigest()
+
+
+def find_similar_frame_result(model_id: str, image_path: str, params: Dict[str, Any], context: str = "") -> Optional[str]:
+    """Return the cached result of a recent frame within the perceptual-hash threshold, if any."""
+    threshold = params.get("phash_threshold", _default_phash_threshold)
+    if threshold is None or threshold < 0:
+        return None
+    try:
+        frame_hash = compute_dhash(image_path)
+    except Exception as e:
+        print(f"Perceptual hash failed for {image_path}: {e}", file=sys.stderr)
+        return None
+    
+    oldest = time.time() - params.get("phash_max_age", _default_phash_max_age)
+    with _frame_index_lock:
+        entries = _load_frame_index().get(_frame_index_key(model_id, params, context), [])
+        best = None
+        for entry_hash, result, timestamp in reversed(entries):
+            if timestamp < oldest:
+                continue
+            distance = dhash_distance(frame_hash, entry_hash)
+            if distance <= threshold and (best is None or distance < best[0]):
+                best = (distance, result)
+    if best is not None:
+        print(f"Reusing result of a near-identical frame (max tile Hamming distance {best[0]}) for {os.path.basename(image_path)}", file=sys.stderr)
+        return best[1]
+    return None
+
+
+def remember_frame_result(model_id: str, image_path: str, result: str, params: Dict[str, Any], context: str = ""):
+    """Record a frame's result in the (persisted) recent-frame index."""
+    threshold = params.get("phash_threshold", _default_phash_threshold)
+    if threshold is None or threshold < 0 or not result or result.startswith("ERROR:"):
+        return
+    try:
+        frame_hash = compute_dhash(image_path)
+    except Exception:
+        return
+    
+    global _frame_index_mtime
+    now = time.time()
+    oldest = now - params.get("phash_max_age", _default_phash_max_age)
+    index_path = _frame_index_path()
+    with _frame_index_lock:
+        try:
+            with _state_file_lock(index_path):
+                # Merge into the latest on-disk index so entries written by other processes survive
+                index = _load_frame_index()
+                key = _frame_index_key(model_id, params, context)
+                entries = [entry for entry in index.pop(key, []) if entry[2] >= oldest]
+                entries.append([frame_hash, result, now])
+                index[key] = entries[-_frame_index_entries_per_key:]  # Re-inserted as most recently used
+                while len(index) > _frame_index_max_keys:
+                    del index[next(iter(index))]
+                temp_path = index_path + f".{os.getpid()}.tmp"
+                with open(temp_path, "w", encoding="utf-8") as index_file:
+                    json.dump(index, index_file)
+                os.replace(temp_path, index_path)
+                _frame_index_mtime = os.stat(index_path).st_mtime_ns
+        except OSError as e:
+            print(f"Could not persist frame index: {e}", file=sys.stderr)
+
+
+def _session_state_paths(session_id: str) -> tuple:
+    """(frame PNG, state JSON) paths for a capture session in the state directory."""
+    safe_id = re.sub(r'[^A-Za-z0-9_.-]+', '_', session_id)[:100]
+    sessions_dir = os.path.join(get_state_dir(), "sessions")
+    os.makedirs(sessions_dir, exist_ok=True)
+    return os.path.join(sessions_dir, f"{safe_id}.png"), os.path.join(sessions_dir, f"{safe_id}.json")
+
+
+def _small_grayscale_frame(path: str):
+    """Grayscale thumbnail of a frame used for change detection."""
+    from PIL import Image
+    image = Image.open(path)
+    if image.format == "JPEG":
+        image.draft("L", (_session_frame_side, _session_frame_side))
+    frame = image.convert("L")
+    frame.thumbnail((_session_frame_side, _session_frame_side), Image.BOX)
+    return frame
+
+
+def _get_session_frame(session_id: str) -> Optional[dict]:
+    """Previous frame of a session from memory, or from disk for one-process-per-frame callers."""
+    with _session_frames_lock:
+        state = _session_frames.get(session_id)
+    if state is not None:
+        return state
+    
+    frame_path, state_path = _session_state_paths(session_id)
+    try:
+        from PIL import Image
+        with open(state_path, "r", encoding="utf-8") as state_file:
+            state = json.load(state_file)
+        with Image.open(frame_path) as frame:
+            state["frame"] = frame.convert("L")
+    except (OSError, ValueError):
+        return None
+    with _session_frames_lock:
+        _session_frames[session_id] = state
+    return state
+
+
+def _persist_session_state(session_id: str, state: dict, save_frame: bool):
+    frame_path, state_path = _session_state_paths(session_id)
+    try:
+        if save_frame:
+            state["frame"].save(frame_path + ".tmp.png")
+            os.replace(frame_path + ".tmp.png", frame_path)
+        with open(state_path + ".tmp", "w", encoding="utf-8") as state_file:
+            json.dump({key: value for key, value in state.items() if key != "frame"}, state_file)
+        os.replace(state_path + ".tmp", state_path)
+    except OSError as e:
+        print(f"Could not persist session frame: {e}", file=sys.stderr)
+
+
+def record_session_frame(session_id: str, image_path: str, description: str):
+    """Make a fully processed frame and its description the session's reference for changed-region inference."""
+    try:
+        frame = _small_grayscale_frame(image_path)
+        from PIL import Image
+        with Image.open(image_path) as image:
+            full_size = list(image.size)
+    except Exception as e:
+        print(f"Could not record session frame: {e}", file=sys.stderr)
+        return
+    
+    state = {"size": full_size, "description": description, "region_frames": 0, "frame": frame}
+    with _session_frames_lock:
+        _session_frames[session_id] = state
+    _persist_session_state(session_id, state, save_frame=True)
+
+
+def record_region_frame(session_id: str):
+    """Count a changed-region frame against the session's reference, which stays the last full frame."""
+    state = _get_session_frame(session_id)
+    if state is None:
+        return
+    with _session_frames_lock:
+        state["region_frames"] = state.get("region_frames", 0) + 1
+    _persist_session_state(session_id, state, save_frame=False)
+
+
+def compute_changed_regions(previous_frame, current_frame, full_size: tuple) -> list:
+    """Bounding boxes (left, top, right, bottom in full-resolution pixels) of regions that changed.
+    
+    The thumbnails are differenced and thresholded, changed pixels are pooled into tiles, and
+    8-connected groups of changed tiles become one box each (padded by one tile).
+    """
+    import numpy as np
+    from PIL import Image, ImageChops
+    
+    if previous_frame.size != current_frame.size:
+        return [(0, 0, full_size[0], full_size[1])]
+    
+    changed = ImageChops.difference(previous_frame, current_frame).point(lambda v: 255 if v > _roi_pixel_threshold else 0)
+    grid_width = -(-changed.size[0] // _roi_tile_pixels)
+    grid_height = -(-changed.size[1] // _roi_tile_pixels)
+    tiles = np.asarray(changed.resize((grid_width, grid_height), Image.BOX))
+    changed_tiles = {(int(x), int(y)) for y, x in zip(*np.nonzero(tiles))}
+    
+    boxes = []
+    while changed_tiles:
+        stack = [changed_tiles.pop()]
+        min_x, min_y = max_x, max_y = stack[0]
+        while stack:
+            x, y = stack.pop()
+            min_x, max_x, min_y, max_y = min(min_x, x), max(max_x, x), min(min_y, y), max(max_y, y)
+            for dx in (-1, 0, 1):
+                for dy in (-1, 0, 1):
+                    neighbour = (x + dx, y + dy)
+                    if neighbour in changed_tiles:
+                        changed_tiles.remove(neighbour)
+                        stack.append(neighbour)
+        scale_x = full_size[0] / grid_width
+        scale_y = full_size[1] / grid_height
+        boxes.append((
+            max(0, int((min_x - 1) * scale_x)),
+            max(0, int((min_y - 1) * scale_y)),
+            min(full_size[0], int((max_x + 2) * scale_x)),
+            min(full_size[1], int((max_y + 2) * scale_y))
+        ))
+    return boxes
+
+
+def _compose_region_mosaic(image, boxes: list, max_side: Optional[int]):
+    """Pack cropped regions into one image (shelf packing, tallest first) so single-image models can take them."""
+    from PIL import Image
+    
+    crops = sorted((image.crop(box) for box in boxes), key=lambda crop: crop.size[1], reverse=True)
+    row_width_limit = max(max(crop.size[0] for crop in crops), int(sum(crop.size[0] * crop.size[1] for crop in crops) ** 0.5))
+    placements = []
+    x = y = row_height = mosaic_width = 0
+    for crop in crops:
+        if x and x + crop.size[0] > row_width_limit:
+            y += row_height
+            x = row_height = 0
+        placements.append((crop, (x, y)))
+        x += crop.size[0]
+        row_height = max(row_height, crop.size[1])
+        mosaic_width = max(mosaic_width, x)
+    
+    mosaic = Image.new("RGB", (mosaic_width, y + row_height), (0, 0, 0))
+    for crop, position in placements:
+        mosaic.paste(crop, position)
+    if max_side and max(mosaic.size) > max_side:
+        mosaic.thumbnail((max_side, max_side), Image.BILINEAR)
+    return mosaic
+
+
+def plan_changed_region_inference(session_id: str, image_path: str, params: Dict[str, Any]) -> Optional[tuple]:
+    """Decide whether a frame can be processed as changed regions only.
+    
+    Changes are measured against the last fully processed frame, whose description is the context,
+    so the changed area accumulates until it exceeds roi_max_fraction or roi_refresh_frames
+    region-only frames have run. Returns (mosaic_image, global_description, boxes) in that case;
+    otherwise None, meaning the full frame should be processed (and described).
+    """
+    if params.get("vision_roi", "off") == "off":
+        return None
+    previous = _get_session_frame(session_id)
+    if not previous or not previous.get("description"):
+        return None
+    if previous.get("region_frames", 0) >= params.get("roi_refresh_frames", _default_roi_refresh_frames):
+        print("Refreshing the full-frame description", file=sys.stderr)
+        return None
+    
+    try:
+        from PIL import Image
+        with Image.open(image_path) as probe:
+            full_size = probe.size
+        if list(full_size) != list(previous.get("size", [])):
+            return None
+        boxes = compute_changed_regions(previous["frame"], _small_grayscale_frame(image_path), full_size)
+    except Exception as e:
+        print(f"Change detection failed, using full frame: {e}", file=sys.stderr)
+        return None
+    
+    changed_area = sum((right - left) * (bottom - top) for left, top, right, bottom in boxes)
+    changed_fraction = changed_area / float(full_size[0] * full_size[1])
+    if not boxes or changed_fraction > params.get("roi_max_fraction", _default_roi_max_fraction):
+        return None
+    
+    print(f"Processing {len(boxes)} changed region(s) covering {changed_fraction:.1%} of the screen", file=sys.stderr)
+    mosaic = _compose_region_mosaic(load_image_for_model(image_path), boxes, params.get("max_image_side", _default_max_image_side))
+    return mosaic, previous["description"], boxes
+
+
+def _find_vision_encoder(model):
+    """Locate the image encoder submodule of a vision-language or BLIP model, if it has one."""
+    for owner in (model, getattr(model, "model", None)):
+        if owner is None:
+            continue
+        for attribute in _vision_encoder_attributes:
+            encoder = getattr(owner, attribute, None)
+            if encoder is not None and hasattr(encoder, "forward"):
+                return encoder
+    return None
+
+
+def _tensor_signature(value) -> tuple:
+    """Shape/dtype signature of the tensors in an encoder call, so one image key never maps to a different input."""
+    if hasattr(value, "shape") and hasattr(value, "dtype"):
+        return (tuple(value.shape), str(value.dtype))
+    if isinstance(value, (list, tuple)):
+        return tuple(_tensor_signature(item) for item in value)
+    if isinstance(value, dict):
+        return tuple((key, _tensor_signature(item)) for key, item in sorted(value.items()))
+    return (repr(value),)
+
+
+def configure_vision_embedding_cache(budget_mb: Optional[float] = None):
+    """Set the memory budget of the vision-encoder output cache, evicting least recently used outputs beyond it."""
+    global _vision_embedding_cache_budget
+    _vision_embedding_cache_budget = int((_default_vision_cache_mb if budget_mb is None else max(0.0, budget_mb)) * 1024 * 1024)
+    with _vision_embedding_lock:
+        cached_bytes = sum(size for _, size in _vision_embedding_cache.values())
+        while _vision_embedding_cache and cached_bytes > _vision_embedding_cache_budget:
+            _, (_, evicted_bytes) = _vision_embedding_cache.popitem(last=False)
+            cached_bytes -= evicted_bytes
+            _vision_embedding_stats["evictions"] += 1
+
+
+def enable_vision_embedding_cache(model, model_key: str) -> bool:
+    """Wrap the model's vision encoder so its outputs are reused for images already encoded.
+    
+    Caching only happens inside vision_embedding_scope(); calls outside a scope run the encoder normally.
+    """
+    encoder = _find_vision_encoder(model)
+    if encoder is None or getattr(encoder, "_embedding_cache_key", None) == model_key:
+        return encoder is not None
+    original_forward = encoder.forward
+    
+    def cached_forward(*args, **kwargs):
+        image_key = getattr(_vision_embedding_scope, "image_key", None)
+        if image_key is None:
+            return original_forward(*args, **kwargs)
+        cache_key = (model_key, image_key, _tensor_signature(args), _tensor_signature(kwargs))
+        with _vision_embedding_lock:
+            cached = _vision_embedding_cache.get(cache_key)
+            if cached is not None:
+                _vision_embedding_cache.move_to_end(cache_key)
+                _vision_embedding_stats["hits"] += 1
+                return cached[0]
+            _vision_embedding_stats["misses"] += 1
+        output = original_forward(*args, **kwargs)
+        output_bytes = _approximate_bytes(output)
+        if output_bytes > _vision_embedding_cache_budget:
+            return output
+        with _vision_embedding_lock:
+            _vision_embedding_cache[cache_key] = (output, output_bytes)
+            cached_bytes = sum(size for _, size in _vision_embedding_cache.values())
+            while cached_bytes > _vision_embedding_cache_budget:
+                _, (_, evicted_bytes) = _vision_embedding_cache.popitem(last=False)
+                cached_bytes -= evicted_bytes
+                _vision_embedding_stats["evictions"] += 1
+        return output
+    
+    encoder.forward = cached_forward
+    encoder._embedding_cache_key = model_key
+    return True
+
+
+@contextmanager
+def vision_embedding_scope(image_paths: list, variant: str = ""):
+    """Mark encoder calls on this thread as encoding the given image files (by content hash).
+    
+    An empty image list disables caching for the scope.
+    """
+    image_key = None
+    if image_paths:
+        hasher = hashlib.blake2b(digest_size=16)
+        for path in image_paths:
+            hasher.update(_file_digest(path).encode())
+        hasher.update(variant.encode())
+        image_key = hasher.hexdigest()
+    previous_key = getattr(_vision_embedding_scope, "image_key", None)
+    _vision_embedding_scope.image_key = image_key
+    try:
+        yield
+    finally:
+        _vision_embedding_scope.image_key = previous_key
+
+
+def _move_inputs_to_model(inputs, model) -> dict:
+    """Move processor outputs to the model's device, casting floating tensors (pixel values) to its dtype."""
+    device = getattr(model, "device", None)
+    dtype = getattr(model, "dtype", None)
+    moved = {}
+    for key, value in dict(inputs).items():
+        if hasattr(value, "to"):
+            if dtype is not None and getattr(value, "is_floating_point", lambda: False)():
+                value = value.to(device=device, dtype=dtype)
+            elif device is not None:
+                value = value.to(device)
+        moved[key] = value
+    return moved
+
+
+def _strip_prompt_tokens(outputs, inputs):
+    """Drop the echoed prompt from generate() outputs of decoder-only models."""
+    input_ids = inputs.get("input_ids")
+    if input_ids is None or outputs.shape[1] <= input_ids.shape[1]:
+        return outputs
+    prompt_length = input_ids.shape[1]
+    if torch.equal(outputs[:, :prompt_length].to(input_ids.device), input_ids):
+        return outputs[:, prompt_length:]
+    return outputs
+
+
+def get_or_load_vision_language_model(model_id: str, params: Dict[str, Any], local_model_path: Optional[str] = None) -> tuple:
+    """Get (model, processor, tokenizer) for a vision-language model from the resident cache, loading once."""
+    cache_key = model_cache_key(model_id, local_model_path)
+    cached = _vision_model_cache.get(cache_key)
+    if cached is not None:
+        count_cache_event("vision_language", "hit")
+        return cached
+    
+    with _get_model_load_lock(f"vl:{cache_key}"):
+        cached = _vision_model_cache.get(cache_key)
+        if cached is not None:
+            count_cache_event("vision_language", "hit")
+            return cached
+        count_cache_event("vision_language", "miss")
+        
+        from transformers import AutoModel, AutoTokenizer, AutoProcessor
+        import transformers as tf_module
+        
+        model_path_to_use, is_local_model = resolve_model_path(model_id, local_model_path)
+        trust_remote_code = params.get("trust_remote_code", True)
+        print("Loading vision-language model...", file=sys.stderr)
+        
+        # Load components
+        tokenizer = None
+        try:
+            processor = AutoProcessor.from_pretrained(
+                model_path_to_use,
+                trust_remote_code=trust_remote_code,
+                local_files_only=is_local_model
+            )
+            print("✓ Processor loaded", file=sys.stderr)
+        except Exception as e:
+            print(f"Warning: Could not load processor: {e}", file=sys.stderr)
+            processor = None
+        
+        # Load tokenizer as fallback
+        if not processor:
+            try:
+                tokenizer = AutoTokenizer.from_pretrained(
+                    model_path_to_use,
+                    trust_remote_code=trust_remote_code,
+                    local_files_only=is_local_model
+                )
+                print("✓ Tokenizer loaded as fallback", file=sys.stderr)
+            except Exception as e:
+                print(f"Warning: Could not load tokenizer: {e}", file=sys.stderr)
+        
+        # Prefer classes with a language-model head (able to generate), then fall back to AutoModel
+        model_kwargs = {
+            "trust_remote_code": trust_remote_code,
+            "torch_dtype": select_model_dtype("vision-language", params.get("cpu_optimize", False) or not torch.cuda.is_available(), params),
+            "device_map": "cpu" if params.get("cpu_optimize", False) else "auto",
+            "local_files_only": is_local_model
+        }
+        model = None
+        load_errors = []
+        for class_name in ("AutoModelForImageTextToText", "AutoModelForVision2Seq", "AutoModel"):
+            model_class = getattr(tf_module, class_name, None) if class_name != "AutoModel" else AutoModel
+            if model_class is None:
+                continue
+            try:
+                model = model_class.from_pretrained(model_path_to_use, **model_kwargs)
+                print(f"✓ Vision-language model loaded with {class_name}", file=sys.stderr)
+                break
             except Exception as e:
-                print(f"Warning: Could not load processor: {e}", file=sys.stderr)
-                processor = None
+                load_errors.append(e)
+        if model is None:
+            raise load_errors[-1]
+        model.eval()
+        enable_vision_embedding_cache(model, model_path_to_use)
+        
+        # Batched prompts must be left-padded so every row's generation continues right after its own prompt
+        if not getattr(model.config, "is_encoder_decoder", False):
+            for text_tokenizer in (getattr(processor, "tokenizer", None), tokenizer):
+                if text_tokenizer is not None:
+                    text_tokenizer.padding_side = "left"
+        
+        cached = (model, processor, tokenizer)
+        _vision_model_cache[cache_key] = cached
+        return cached
+
+
+def run_vision_language(model_id: str, input_text: str, params: Dict[str, Any], local_model_path: Optional[str] = None) -> str:
+    """Run vision-language models that can process both images and text."""
+    try:
+        print(f"Processing vision-language with model: {model_id}", file=sys.stderr)
+        print(f"Raw input text received: {input_text}", file=sys.stderr)
+        
+        # Parse the multimodal input to extract images and text properly
+        parse_start = time.perf_counter()
+        image_paths = []
+        audio_paths = []
+        text_content = []
+        
+        # Split input by common delimiters first
+        input_parts = []
+        if ',' in input_text:
+            input_parts = input_text.split(',')
+        else:
+            input_parts = [input_text]
+        
+        print(f"Split input into {len(input_parts)} parts", file=sys.stderr)
+        
+        # Process each part to categorize as image, audio, or text
+        for i, part in enumerate(input_parts):
+            part = part.strip()
+            print(f"Processing part {i+1}: {part[:100]}...", file=sys.stderr)
             
-            # Load tokenizer as fallback
-            if not processor:
-                try:
-                    tokenizer = AutoTokenizer.from_pretrained(
-                        model_path_to_use,
-                        trust_remote_code=params.get("trust_remote_code", True),
-                        local_files_only=bool(local_model_path and os.path.exists(local_model_path))
-                    )
-                    print("✓ Tokenizer loaded as fallback", file=sys.stderr)
-                except Exception as e:
-                    print(f"Warning: Could not load tokenizer: {e}", file=sys.stderr)
-                    tokenizer = None
+            # Check if this part is an image file
+            if any(ext in part.lower() for ext in ['.jpg', '.jpeg', '.png', '.bmp', '.gif', '.tiff', '.webp']):
+                # Extract image path
+                import re
+                image_patterns = [
+                    r'([A-Z]:[^:,]+\.(jpg|jpeg|png|bmp|gif|tiff|webp))',  # Direct path match
+                    r':\s*([A-Z]:[^:,]+\.(jpg|jpeg|png|bmp|gif|tiff|webp))',  # After colon
+                    r'(?<![A-Za-z:])(/[^:,]+\.(jpg|jpeg|png|bmp|gif|tiff|webp))',  # Absolute POSIX path
+                ]
+                
+                for pattern in image_patterns:
+                    matches = re.findall(pattern, part, re.IGNORECASE)
+                    for match in matches:
+                        if isinstance(match, tuple):
+                            path = match[0].strip()
+                        else:
+                            path = match.strip()
+                        if path and os.path.exists(path):
+                            image_paths.append(path)
+                            print(f"Found image: {path}", file=sys.stderr)
+                            break
             
-            # Load model
-            model_kwargs = {
-                "trust_remote_code": params.get("trust_remote_code", True),
-                "torch_dtype": torch.float32 if params.get("cpu_optimize", False) else torch.float16,
-                "device_map": "cpu" if params.get("cpu_optimize", False) else "auto",
-                "local_files_only": bool(local_model_path and os.path.exists(local_model_path))
-            }
+            # Check if this part is an audio file (should be excluded for vision-language models)
+            elif any(ext in part.lower() for ext in ['.wav', '.mp3', '.m4a', '.flac', '.ogg', '.aac']):
+                print(f"Ignoring audio file for vision-language model: {part[:50]}...", file=sys.stderr)
+                continue
             
-            model = AutoModel.from_pretrained(model_path_to_use, **model_kwargs)
-            print("✓ Vision-language model loaded with AutoModel", file=sys.stderr)
+            # Otherwise treat as text content
+            else:
+                # Clean up text content
+                clean_part = part.strip()
+                if clean_part and not clean_part.startswith('C:\\') and ':' in clean_part:
+                    # Extract meaningful text content
+                    if any(keyword in clean_part.lower() for keyword in ['mouse', 'keyboard', 'whisper', 'screen', 'webcam', 'audio', 'eventtype', 'action', 'coordinates']):
+                        text_content.append(clean_part)
+                        print(f"Added text content: {clean_part[:50]}...", file=sys.stderr)
+        
+        # Remove duplicates while preserving order
+        image_paths = list(dict.fromkeys(image_paths))
+        record_phase_time("parse_input", parse_start)
+        
+        # Combine text content
+        combined_text = '\n'.join(text_content) if text_content else ""
+        
+        print(f"Extracted {len(image_paths)} image(s) and text content: {combined_text[:100]}...", file=sys.stderr)
+        
+        if not image_paths:
+            return "ERROR: No valid image files found for vision-language processing"
+        
+        # Check required libraries
+        try:
+            from PIL import Image
+        except ImportError:
+            try:
+                print("Installing Pillow...", file=sys.stderr)
+                subprocess.check_call([sys.executable, "-m", "pip", "install", "Pillow"], 
+                                    stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+                from PIL import Image
+            except Exception as e:
+                return f"ERROR: Failed to install/import Pillow: {e}"
+        
+        # Reuse the response for a visually unchanged screen with the same context
+        if len(image_paths) == 1:
+            reused_response = find_similar_frame_result(model_id, image_paths[0], params, context=combined_text)
+            if reused_response is not None:
+                return reused_response
+        
+        # Approach 1: Resident model, processor and tokenizer (loaded once per process)
+        try:
+            with inference_phase("model_load"):
+                model, processor, tokenizer = get_or_load_vision_language_model(model_id, params, local_model_path)
+            if not processor and not tokenizer:
+                return "ERROR: Could not load processor or tokenizer for vision-language model"
             
-            # Process the first image (GUI Owl typically works with single images)
+            # Change-region cropping applies to a single screenshot; several images (monitors, webcam) go in whole
+            preprocess_start = time.perf_counter()
             main_image_path = image_paths[0]
-            image = Image.open(main_image_path).convert("RGB")
-            print(f"✓ Main image loaded: {image.size} pixels from {os.path.basename(main_image_path)}", file=sys.stderr)
+            session_id = params.get("session_id") or model_id
+            region_plan = plan_changed_region_inference(session_id, main_image_path, params) if len(image_paths) == 1 else None
+            if region_plan:
+                # Only the changed regions are fed to the model, with the previous full-frame description as context
+                images = [region_plan[0]]
+                global_description, changed_boxes = region_plan[1], region_plan[2]
+            else:
+                max_image_side = params.get("max_image_side", _default_max_image_side)
+                images = map_inference(lambda path: load_image_for_model(path, max_side=max_image_side), [(path,) for path in image_paths])
+            for path, image in zip(image_paths, images):
+                print(f"✓ Image loaded: {image.size} pixels from {os.path.basename(path)}", file=sys.stderr)
             
             # Prepare the prompt for GUI interaction
-            prompt = f"Based on this screenshot and the following context, what actions should be taken?\n\nContext: {combined_text}\n\nPlease provide specific recommendations for interacting with this interface."
+            if region_plan:
+                region_list = "; ".join(f"({left},{top})-({right},{bottom})" for left, top, right, bottom in changed_boxes)
+                prompt = f"Previously the screen looked like this: {global_description}\n\nThis image shows only the screen regions that changed since then, at {region_list}. Based on these changes and the following context, what actions should be taken?\n\nContext: {combined_text}\n\nPlease provide specific recommendations for interacting with this interface."
+            elif len(images) > 1:
+                prompt = f"Based on these {len(images)} screenshots (shown in order) and the following context, what actions should be taken?\n\nContext: {combined_text}\n\nPlease provide specific recommendations for interacting with this interface."
+            else:
+                prompt = f"Based on this screenshot and the following context, what actions should be taken?\n\nContext: {combined_text}\n\nPlease provide specific recommendations for interacting with this interface."
             
-            # Process inputs
-            if processor:
-                inputs = processor(images=image, text=prompt, return_tensors="pt")
-            elif tokenizer:
+            # Process inputs: one multi-image prompt when the processor has a chat template, otherwise a batch of prompts
+            batched_images = bool(processor) and not getattr(processor, "chat_template", None) and len(images) > 1
+            def build_inputs(text):
+                if processor and getattr(processor, "chat_template", None):
+                    messages = [{"role": "user", "content": [{"type": "image"} for _ in images] + [{"type": "text", "text": text}]}]
+                    chat_prompt = processor.apply_chat_template(messages, add_generation_prompt=True)
+                    return processor(images=images, text=[chat_prompt], return_tensors="pt", padding=True)
+                elif batched_images:
+                    return processor(images=images, text=[text] * len(images), return_tensors="pt", padding=True)
+                elif processor:
+                    return processor(images=images[0], text=text, return_tensors="pt")
                 # Fallback: use tokenizer only
-                inputs = tokenizer(prompt, return_tensors="pt")
                 # Note: This won't include image processing, but might work for some models
-            else:
-                return "ERROR: Could not load processor or tokenizer for vision-language model"
+                return tokenizer(text, return_tensors="pt")
+            inputs = _move_inputs_to_model(build_inputs(prompt), model)
+            record_phase_time("preprocess", preprocess_start)
+            decoder = processor if processor and hasattr(processor, 'batch_decode') else (processor.tokenizer if processor and hasattr(processor, 'tokenizer') else tokenizer)
+            pad_token_id = processor.tokenizer.eos_token_id if processor and hasattr(processor, 'tokenizer') else (tokenizer.eos_token_id if tokenizer else None)
+            
+            # Encoder outputs are keyed by image content, so follow-up prompts about the same screenshot skip the encoder
+            # (change-region mosaics differ every frame and are not cached)
+            encoded_paths = [] if region_plan else image_paths
+            image_variant = f"max_side={params.get('max_image_side', _default_max_image_side)}"
             
             # Generate response
-            with torch.no_grad():
+            with model_slot(f"vl:{model_cache_key(model_id, local_model_path)}"), vision_embedding_scope(encoded_paths, image_variant), torch.no_grad():
                 # Try different generation approaches for vision-language models
                 try:
                     # Approach 1: Standard generation
                     if hasattr(model, 'generate'):
-                        outputs = model.generate(
-                            **inputs,
-                            max_new_tokens=params.get("max_length", 150),
-                            temperature=params.get("temperature", 0.7),
-                            do_sample=True,
-                            pad_token_id=processor.tokenizer.eos_token_id if processor and hasattr(processor, 'tokenizer') else (tokenizer.eos_token_id if tokenizer else None)
-                        )
+                        with inference_phase("inference"):
+                            outputs = model.generate(
+                                **inputs,
+                                max_new_tokens=params.get("max_length", 150),
+                                temperature=params.get("temperature", 0.7),
+                                do_sample=True,
+                                pad_token_id=pad_token_id
+                            )
                         
-                        # Decode response
-                        if processor and hasattr(processor, 'decode'):
-                            response = processor.decode(outputs[0], skip_special_tokens=True)
-                        elif processor and hasattr(processor, 'tokenizer'):
-                            response = processor.tokenizer.decode(outputs[0], skip_special_tokens=True)
-                        elif tokenizer:
-                            response = tokenizer.decode(outputs[0], skip_special_tokens=True)
+                        # Decode only newly generated tokens (decoder-only models echo the prompt)
+                        generated_ids = _strip_prompt_tokens(outputs, inputs)
+                        record_generated_tokens(generated_ids.shape[0] * generated_ids.shape[1])
+                        if decoder is not None:
+                            with inference_phase("decode"):
+                                responses = [text.strip() for text in decoder.batch_decode(generated_ids, skip_special_tokens=True)]
                         else:
-                            response = str(outputs[0])
+                            responses = [str(output) for output in outputs]
                         
-                        # Clean up response (remove the original prompt)
-                        if response.startswith(prompt):
-                            response = response[len(prompt):].strip()
+                        if batched_images:
+                            response = _combine_image_captions([
+                                f"Image {i+1} ({os.path.basename(path)}): {text}" for i, (path, text) in enumerate(zip(image_paths, responses))
+                            ])
+                        else:
+                            response = responses[0]
+                            # Clean up response (remove the original prompt)
+                            if response.startswith(prompt):
+                                response = response[len(prompt):].strip()
                         
+                        if len(image_paths) == 1:
+                            if response:
+                                remember_frame_result(model_id, main_image_path, response, params, context=combined_text)
+                            if region_plan:
+                                record_region_frame(session_id)
+                            elif params.get("vision_roi", "off") != "off":
+                                # The reference for later changed-region frames is a description of the screen, not the action reply
+                                try:
+                                    with inference_phase("describe"):
+                                        description_inputs = _move_inputs_to_model(build_inputs(_full_frame_description_prompt), model)
+                                        description_ids = _strip_prompt_tokens(model.generate(
+                                            **description_inputs,
+                                            max_new_tokens=params.get("max_length", 150),
+                                            do_sample=False,
+                                            pad_token_id=pad_token_id
+                                        ), description_inputs)
+                                    description = decoder.batch_decode(description_ids, skip_special_tokens=True)[0].strip() if decoder is not None else ""
+                                    if description:
+                                        record_session_frame(session_id, main_image_path, description)
+                                except Exception as describe_error:
+                                    print(f"Full-frame description failed, changed-region inference stays off for this frame: {describe_error}", file=sys.stderr)
                         return response if response else "Vision-language model processed the input successfully."
                     
                     # Approach 2: Try forward pass if generate doesn't work
@@ -740,22 +2112,22 @@ def run_vision_language(model_id: str, input_text: str, params: Dict[str, Any],
                             elif tokenizer:
                                 response = tokenizer.decode(predicted_ids[0], skip_special_tokens=True)
                             else:
-                                response = "Model processed input but could not decode response"
+                                return "ERROR: Vision-language model ran a forward pass but has no tokenizer to decode it"
                             
                             return response
                         else:
-                            return "Vision-language model processed input - forward pass completed successfully"
+                            return "ERROR: Vision-language model forward pass returned no logits to decode"
                     
                     else:
-                        return "Vision-language model loaded but does not support standard generation methods"
+                        return "ERROR: Vision-language model loaded but does not support standard generation methods"
                         
                 except Exception as gen_error:
                     print(f"Generation error: {gen_error}", file=sys.stderr)
-                    return f"Vision-language model encountered generation error: {str(gen_error)}"
+                    return f"ERROR: Vision-language model encountered generation error: {str(gen_error)}"
             
         except Exception as e:
             error_msg = str(e)
-            print(f"AutoModel approach failed: {error_msg}", file=sys.stderr)
+            print(f"Vision-language model approach failed: {error_msg}", file=sys.stderr)
             
             # Check for specific error types and provide helpful messages
             if "qwen2_5_vl" in error_msg.lower() and "automodelforvisual" in error_msg.lower():
@@ -771,6 +2143,28 @@ def run_vision_language(model_id: str, input_text: str, params: Dict[str, Any],
         return f"ERROR: {error_msg}"
 
 
+def get_or_load_speech_pipeline(pipeline_kwargs: Dict[str, Any], params: Dict[str, Any]):
+    """Get a speech-recognition pipeline from the resident cache, creating it once per (model, device)."""
+    cache_key = f"{pipeline_kwargs['model']}@{pipeline_kwargs['device']}"
+    cached = _speech_pipeline_cache.get(cache_key)
+    if cached is not None:
+        count_cache_event("speech", "hit")
+        return cached
+    
+    with _get_model_load_lock(f"speech:{cache_key}"):
+        cached = _speech_pipeline_cache.get(cache_key)
+        if cached is not None:
+            count_cache_event("speech", "hit")
+            return cached
+        count_cache_event("speech", "miss")
+        
+        from transformers import pipeline
+        pipe = pipeline(**pipeline_kwargs)
+        compile_for_inference(pipe.model, "automatic-speech-recognition", cache_key, pipeline_kwargs["model"], params)
+        _speech_pipeline_cache[cache_key] = pipe
+        return pipe
+
+
 def run_speech_recognition(model_id: str, input_text: str, params: Dict[str, Any], local_model_path: Optional[str] = None) -> str:
     """Run automatic speech recognition on audio files (supports multiple files)."""
     try:
@@ -779,6 +2173,7 @@ def run_speech_recognition(model_id: str, input_text: str, params: Dict[str, Any
         print(f"Raw input text received: {input_text}", file=sys.stderr)
         
         # Extract audio file paths from input text (support multiple audio files)
+        parse_start = time.perf_counter()
         audio_file_paths = []
         
         # Handle multiple formats:
@@ -863,6 +2258,7 @@ def run_speech_recognition(model_id: str, input_text: str, params: Dict[str, Any
             else:
                 processed_audio_paths.append(audio_file_path)
         
+        record_phase_time("parse_input", parse_start)
         print(f"Extracted {len(processed_audio_paths)} audio file path(s): {processed_audio_paths}", file=sys.stderr)
         
         if not processed_audio_paths:
@@ -883,16 +2279,8 @@ def run_speech_recognition(model_id: str, input_text: str, params: Dict[str, Any
             except Exception as e:
                 return f"ERROR: Failed to install/import librosa for audio processing: {e}"
         
-        # Import transformers pipeline
-        from transformers import pipeline
-        
         # Determine model path - CRITICAL FIX: Don't use local path if it's empty
-        if local_model_path and os.path.exists(local_model_path) and os.listdir(local_model_path):
-            model_path_to_use = local_model_path
-            print(f"Using valid local model path: {local_model_path}", file=sys.stderr)
-        else:
-            model_path_to_use = model_id
-            print(f"Using HuggingFace Hub model: {model_id} (local path invalid or empty)", file=sys.stderr)
+        model_path_to_use, is_local_model = resolve_model_path(model_id, local_model_path)
         print(f"Using model path: {model_path_to_use}", file=sys.stderr)
         
         # Create speech recognition pipeline
@@ -906,39 +2294,54 @@ def run_speech_recognition(model_id: str, input_text: str, params: Dict[str, Any
         }
         
         # Only add trust_remote_code if it's not a local model path
-        if not (local_model_path and os.path.exists(local_model_path)):
+        if not is_local_model:
             pipeline_kwargs["trust_remote_code"] = params.get("trust_remote_code", True)
         
-        pipe = pipeline(**pipeline_kwargs)
+        with inference_phase("model_load"):
+            onnx_model = select_onnx_model("automatic-speech-recognition", model_id, params, local_model_path)
+            pipe = get_or_load_speech_pipeline(pipeline_kwargs, params) if onnx_model is None else None
         
         # Process all audio files
         print(f"Loading and processing {len(processed_audio_paths)} audio file(s)...", file=sys.stderr)
         
-        transcriptions = []
-        for i, audio_file_path in enumerate(processed_audio_paths):
+        def transcribe_audio(i, audio_file_path):
             try:
                 print(f"Processing audio {i+1}/{len(processed_audio_paths)}: {os.path.basename(audio_file_path)}", file=sys.stderr)
                 
-                # Load audio file
+                # Load audio file (decode and resampling run in parallel across files)
                 try:
-                    audio_array, sampling_rate = librosa.load(audio_file_path, sr=16000)  # Whisper expects 16kHz
+                    with inference_phase("preprocess"):
+                        audio_array, sampling_rate = librosa.load(audio_file_path, sr=16000)  # Whisper expects 16kHz
                     print(f"Audio {i+1} loaded: {len(audio_array)} samples at {sampling_rate}Hz", file=sys.stderr)
                 except Exception as e:
-                    transcriptions.append(f"Audio {i+1} ({os.path.basename(audio_file_path)}): ERROR - Failed to load audio: {str(e)}")
-                    continue
+                    return f"Audio {i+1} ({os.path.basename(audio_file_path)}): ERROR - Failed to load audio: {str(e)}"
                 
                 # Process audio with the model
                 print(f"Running speech recognition for audio {i+1}...", file=sys.stderr)
                 
-                result = pipe(audio_array)
+                transcription = None
+                if onnx_model is not None:
+                    try:
+                        with model_slot(model_path_to_use), inference_phase("inference"):
+                            transcription, token_count = run_onnx_transcription(onnx_model, audio_array)
+                        record_generated_tokens(token_count)
+                    except Exception as e:
+                        print(f"ONNX Runtime transcription failed for audio {i+1}, using transformers: {e}", file=sys.stderr)
                 
-                # Extract transcription text
-                if isinstance(result, dict) and "text" in result:
-                    transcription = result["text"].strip()
-                elif isinstance(result, list) and len(result) > 0 and "text" in result[0]:
-                    transcription = result[0]["text"].strip()
-                else:
-                    transcription = str(result).strip()
+                if transcription is None:
+                    pipe = get_or_load_speech_pipeline(pipeline_kwargs, params)
+                    with model_slot(model_path_to_use), inference_phase("inference"):
+                        result = pipe(audio_array)
+                    
+                    # Extract transcription text
+                    if isinstance(result, dict) and "text" in result:
+                        transcription = result["text"].strip()
+                    elif isinstance(result, list) and len(result) > 0 and "text" in result[0]:
+                        transcription = result[0]["text"].strip()
+                    else:
+                        transcription = str(result).strip()
+                    if getattr(pipe, "tokenizer", None) is not None:
+                        record_generated_tokens(len(pipe.tokenizer.encode(transcription, add_special_tokens=False)))
                 
                 print(f"Transcription {i+1} complete: {len(transcription)} characters", file=sys.stderr)
                 
@@ -950,14 +2353,15 @@ def run_speech_recognition(model_id: str, input_text: str, params: Dict[str, Any
                     transcription = transcription[len(f"{os.path.basename(audio_file_path)}: "):]
                 
                 if transcription:
-                    transcriptions.append(f"Audio {i+1} ({os.path.basename(audio_file_path)}): {transcription}")
+                    return f"Audio {i+1} ({os.path.basename(audio_file_path)}): {transcription}"
                 else:
-                    transcriptions.append(f"Audio {i+1} ({os.path.basename(audio_file_path)}): No speech detected in the audio file")
+                    return f"Audio {i+1} ({os.path.basename(audio_file_path)}): No speech detected in the audio file"
                     
             except Exception as e:
-                error_msg = f"Audio {i+1} ({os.path.basename(audio_file_path)}): ERROR - {str(e)}"
-                transcriptions.append(error_msg)
                 print(f"Error processing audio {i+1}: {e}", file=sys.stderr)
+                return f"Audio {i+1} ({os.path.basename(audio_file_path)}): ERROR - {str(e)}"
+        
+        transcriptions = map_inference(transcribe_audio, list(enumerate(processed_audio_paths)))
         
         # Combine results
         if len(transcriptions) == 1:
@@ -994,6 +2398,96 @@ def run_speech_recognition(model_id: str, input_text: str, params: Dict[str, Any
             return f"ERROR: {error_msg}"
 
 
+def _combine_image_captions(captions: list) -> str:
+    """Combine per-image "Image N (file): caption" results into the clean format the C# side expects."""
+    if len(captions) == 1:
+        # Single image result - clean format: just return the caption without numbering
+        result = captions[0]
+        # Remove "Image 1 (" prefix and clean up
+        if result.startswith("Image 1 ("):
+            # Extract just the caption part after the filename
+            match = re.search(r'Image 1 \([^)]+\): (.+)', result)
+            if match:
+                return match.group(1)
+        return result
+    else:
+        # Multiple images result - return clean format for C# processing
+        clean_results = []
+        for result in captions:
+            # Extract just the caption part for each image
+            match = re.search(r'Image \d+ \([^)]+\): (.+)', result)
+            if match:
+                clean_results.append(match.group(1))
+            else:
+                clean_results.append(result)
+        return "\n\n".join(clean_results)
+
+
+def get_or_load_captioning_model(model_id: str, params: Dict[str, Any], local_model_path: Optional[str] = None) -> tuple:
+    """Get (model, processor) for a BLIP captioning model from the resident cache, loading once."""
+    cache_key = local_model_path if local_model_path else model_id
+    cached = _captioning_model_cache.get(cache_key)
+    if cached is not None:
+        count_cache_event("captioning", "hit")
+        return cached
+    
+    with _get_model_load_lock(f"captioning:{cache_key}"):
+        cached = _captioning_model_cache.get(cache_key)
+        if cached is not None:
+            count_cache_event("captioning", "hit")
+            return cached
+        count_cache_event("captioning", "miss")
+        
+        from transformers import AutoProcessor, BlipForConditionalGeneration
+        
+        model_path_to_use, is_local_model = resolve_model_path(model_id, local_model_path)
+        print("Loading image processor and model...", file=sys.stderr)
+        processor = AutoProcessor.from_pretrained(
+            model_path_to_use,
+            local_files_only=is_local_model
+        )
+        print("✓ Processor loaded", file=sys.stderr)
+        
+        # Load model with safetensors preference and fallback logic
+        model_kwargs = {
+            "torch_dtype": select_model_dtype("image-to-text", params.get("cpu_optimize", False) or not torch.cuda.is_available(), params),
+            "device_map": "cpu" if params.get("cpu_optimize", False) else "auto",
+            "local_files_only": is_local_model
+        }
+        
+        # Try loading with safetensors first for security
+        try:
+            print("Attempting to load model with safetensors...", file=sys.stderr)
+            model_kwargs["use_safetensors"] = True
+            model = BlipForConditionalGeneration.from_pretrained(model_path_to_use, **model_kwargs)
+            print("✓ Model loaded with safetensors", file=sys.stderr)
+        except Exception as safetensors_error:
+            print(f"Safetensors loading failed: {safetensors_error}", file=sys.stderr)
+            print("Attempting to load model with PyTorch format...", file=sys.stderr)
+            
+            # Fallback to PyTorch format if safetensors not available
+            model_kwargs["use_safetensors"] = False
+            try:
+                model = BlipForConditionalGeneration.from_pretrained(model_path_to_use, **model_kwargs)
+                print("✓ Model loaded with PyTorch format", file=sys.stderr)
+            except Exception as pytorch_error:
+                # If both fail, provide helpful error message
+                error_msg = f"Failed to load model with both safetensors and PyTorch formats.\n"
+                error_msg += f"Safetensors error: {safetensors_error}\n"
+                error_msg += f"PyTorch error: {pytorch_error}\n"
+                error_msg += f"Consider upgrading PyTorch or ensuring the model files are compatible."
+                raise Exception(error_msg)
+        
+        model.eval()
+        # Compile first so the vision-embedding cache wraps the compiled encoder
+        compile_for_inference(model, "image-to-text", cache_key, model_path_to_use, params)
+        enable_vision_embedding_cache(model, model_path_to_use)
+        
+        cached = (model, processor)
+        _captioning_model_cache[cache_key] = cached
+        return cached
+
+
 def run_image_to_text(model_id: str, input_text: str, params: Dict[str, Any], local_model_path: Optional[str] = None) -> str:
     """Run image-to-text processing on image files using BLIP and similar models."""
     try:
@@ -1002,6 +2496,7 @@ def run_image_to_text(model_id: str, input_text: str, params: Dict[str, Any], lo
         print(f"Raw input text received: {input_text}", file=sys.stderr)
         
         # Extract image file paths from input text (support multiple images)
+        parse_start = time.perf_counter()
         image_file_paths = []
         
         # Handle multiple formats:
@@ -1065,6 +2560,7 @@ def run_image_to_text(model_id: str, input_text: str, params: Dict[str, Any], lo
         
         # Remove duplicates while preserving order
         image_file_paths = list(dict.fromkeys(image_file_paths))
+        record_phase_time("parse_input", parse_start)
         
         print(f"Extracted {len(image_file_paths)} image file path(s): {image_file_paths}", file=sys.stderr)
         
@@ -1086,86 +2582,73 @@ def run_image_to_text(model_id: str, input_text: str, params: Dict[str, Any], lo
             except Exception as e:
                 return f"ERROR: Failed to install/import Pillow for image processing: {e}"
         
-        # Import transformers components
-        from transformers import AutoProcessor, BlipForConditionalGeneration
+        # Reuse captions of near-identical recent frames; skip loading the model if every frame is a repeat
+        reused_captions = {}
+        for image_file_path in image_file_paths:
+            reused_caption = find_similar_frame_result(model_id, image_file_path, params)
+            if reused_caption is not None:
+                reused_captions[image_file_path] = reused_caption
+        if len(reused_captions) == len(image_file_paths):
+            return _combine_image_captions([
+                f"Image {i+1} ({os.path.basename(path)}): {reused_captions[path]}" for i, path in enumerate(image_file_paths)
+            ])
         
         # Determine model path - CRITICAL FIX: Don't use local path if it's empty
-        if local_model_path and os.path.exists(local_model_path) and os.listdir(local_model_path):
-            model_path_to_use = local_model_path
-            print(f"Using valid local model path: {local_model_path}", file=sys.stderr)
-        else:
-            model_path_to_use = model_id
-            print(f"Using HuggingFace Hub model: {model_id} (local path invalid or empty)", file=sys.stderr)
+        model_path_to_use, is_local_model = resolve_model_path(model_id, local_model_path)
         print(f"Using model path: {model_path_to_use}", file=sys.stderr)
         
-        # Load processor and model
-        print("Loading image processor and model...", file=sys.stderr)
-        
+        load_start = time.perf_counter()
         try:
-            # Load processor
-            processor = AutoProcessor.from_pretrained(
-                model_path_to_use,
-                local_files_only=bool(local_model_path and os.path.exists(local_model_path))
-            )
-            print("✓ Processor loaded", file=sys.stderr)
-            
-            # Load model with safetensors preference and fallback logic
-            model_kwargs = {
-                "torch_dtype": torch.float32 if params.get("cpu_optimize", False) else torch.float16,
-                "device_map": "cpu" if params.get("cpu_optimize", False) else "auto",
-                "local_files_only": bool(local_model_path and os.path.exists(local_model_path))
-            }
-            
-            # Try loading with safetensors first for security
-            try:
-                print("Attempting to load model with safetensors...", file=sys.stderr)
-                model_kwargs["use_safetensors"] = True
-                model = BlipForConditionalGeneration.from_pretrained(model_path_to_use, **model_kwargs)
-                print("✓ Model loaded with safetensors", file=sys.stderr)
-            except Exception as safetensors_error:
-                print(f"Safetensors loading failed: {safetensors_error}", file=sys.stderr)
-                print("Attempting to load model with PyTorch format...", file=sys.stderr)
-                
-                # Fallback to PyTorch format if safetensors not available
-                model_kwargs["use_safetensors"] = False
-                try:
-                    model = BlipForConditionalGeneration.from_pretrained(model_path_to_use, **model_kwargs)
-                    print("✓ Model loaded with PyTorch format", file=sys.stderr)
-                except Exception as pytorch_error:
-                    # If both fail, provide helpful error message
-                    error_msg = f"Failed to load model with both safetensors and PyTorch formats.\n"
-                    error_msg += f"Safetensors error: {safetensors_error}\n"
-                    error_msg += f"PyTorch error: {pytorch_error}\n"
-                    error_msg += f"Consider upgrading PyTorch or ensuring the model files are compatible."
-                    raise Exception(error_msg)
-            
+            onnx_model = select_onnx_model("image-to-text", model_id, params, local_model_path)
+            if onnx_model is not None:
+                processor = onnx_model["processor"]
+            else:
+                model, processor = get_or_load_captioning_model(model_id, params, local_model_path)
+            record_phase_time("model_load", load_start)
         except Exception as e:
             return f"ERROR: Failed to load model or processor: {e}"
         
         # Process all images
         print(f"Loading and processing {len(image_file_paths)} image file(s)...", file=sys.stderr)
         
-        captions = []
-        for i, image_file_path in enumerate(image_file_paths):
+        def caption_image(i, image_file_path):
             try:
                 print(f"Processing image {i+1}/{len(image_file_paths)}: {os.path.basename(image_file_path)}", file=sys.stderr)
                 
-                # Load image file
-                image = Image.open(image_file_path).convert("RGB")
-                print(f"Image {i+1} loaded: {image.size} pixels", file=sys.stderr)
+                if image_file_path in reused_captions:
+                    return f"Image {i+1} ({os.path.basename(image_file_path)}): {reused_captions[image_file_path]}"
+                
+                # Decode, downscale and preprocess (cached per file content; runs in parallel across images)
+                with inference_phase("preprocess"):
+                    pixel_values = get_pixel_values(image_file_path, processor, f"captioning:{model_path_to_use}")
+                print(f"Image {i+1} preprocessed: {tuple(pixel_values.shape)}", file=sys.stderr)
                 
                 # Process image with the model
                 print(f"Running image captioning for image {i+1}...", file=sys.stderr)
                 
-                # Prepare inputs
-                inputs = processor(image, return_tensors="pt")
+                token_ids = None
+                if onnx_model is not None:
+                    try:
+                        with model_slot(model_path_to_use), inference_phase("inference"):
+                            token_ids = run_onnx_captioning(onnx_model, pixel_values, params.get("max_length", 100), _captioning_num_beams)
+                    except Exception as e:
+                        print(f"ONNX Runtime captioning failed for image {i+1}, using transformers: {e}", file=sys.stderr)
                 
-                # Generate caption
-                with torch.no_grad():
-                    out = model.generate(**inputs, max_length=params.get("max_length", 100), num_beams=5)
+                if token_ids is None:
+                    model, _ = get_or_load_captioning_model(model_id, params, local_model_path)
+                    
+                    # Prepare inputs
+                    inputs = {"pixel_values": pixel_values.to(model.device, dtype=model.dtype)}
+                    
+                    # Generate caption
+                    with model_slot(model_path_to_use), vision_embedding_scope([image_file_path]), inference_phase("inference"), torch.no_grad():
+                        out = model.generate(**inputs, max_length=params.get("max_length", 100), num_beams=_captioning_num_beams)
+                    token_ids = out[0]
+                record_generated_tokens(len(token_ids))
                 
                 # Decode caption
-                caption = processor.decode(out[0], skip_special_tokens=True)
+                with inference_phase("decode"):
+                    caption = processor.decode(token_ids, skip_special_tokens=True)
                 
                 print(f"Caption {i+1} generated: {len(caption)} characters", file=sys.stderr)
                 
@@ -1177,37 +2660,18 @@ def run_image_to_text(model_id: str, input_text: str, params: Dict[str, Any], lo
                     caption = caption[len(f"{os.path.basename(image_file_path)}: "):]
                 
                 if caption:
-                    captions.append(f"Image {i+1} ({os.path.basename(image_file_path)}): {caption}")
+                    remember_frame_result(model_id, image_file_path, caption, params)
+                    return f"Image {i+1} ({os.path.basename(image_file_path)}): {caption}"
                 else:
-                    captions.append(f"Image {i+1} ({os.path.basename(image_file_path)}): No caption could be generated")
+                    return f"Image {i+1} ({os.path.basename(image_file_path)}): No caption could be generated"
                     
             except Exception as e:
-                error_msg = f"Image {i+1} ({os.path.basename(image_file_path)}): ERROR - {str(e)}"
-                captions.append(error_msg)
                 print(f"Error processing image {i+1}: {e}", file=sys.stderr)
+                return f"Image {i+1} ({os.path.basename(image_file_path)}): ERROR - {str(e)}"
         
-        # Combine results
-        if len(captions) == 1:
-            # Single image result - clean format: just return the caption without numbering
-            result = captions[0]
-            # Remove "Image 1 (" prefix and clean up
-            if result.startswith("Image 1 ("):
-                # Extract just the caption part after the filename
-                match = re.search(r'Image 1 \([^)]+\): (.+)', result)
-                if match:
-                    return match.group(1)
-            return result
-        else:
-            # Multiple images result - return clean format for C# processing
-            clean_results = []
-            for result in captions:
-                # Extract just the caption part for each image
-                match = re.search(r'Image \d+ \([^)]+\): (.+)', result)
-                if match:
-                    clean_results.append(match.group(1))
-                else:
-                    clean_results.append(result)
-            return "\n\n".join(clean_results)
+        captions = map_inference(caption_image, list(enumerate(image_file_paths)))
+        
+        return _combine_image_captions(captions)
         
     except Exception as e:
         error_msg = str(e)
@@ -1225,7 +2689,7 @@ def run_image_to_text(model_id: str, input_text: str, params: Dict[str, Any], lo
 def check_model_cache_status(model_id):
     """Check if model is already cached and report download status"""
     try:
-        cache_dir = "C:\\Users\\tanne\\Documents\\CSimple\\Resources\\HFModels"
+        cache_dir = get_model_cache_dir()
         
         # Check for model files in transformers cache format
         model_cache_path = Path(cache_dir)
@@ -1290,7 +2754,7 @@ def force_download_model(model_id: str) -> bool:
         from huggingface_hub import snapshot_download
         import shutil
         
-        cache_dir = "C:\\Users\\tanne\\Documents\\CSimple\\Resources\\HFModels"
+        cache_dir = get_model_cache_dir()
         model_hash = model_id.replace("/", "--")
         model_cache_path = Path(cache_dir) / f"models--{model_hash}"
         
@@ -1318,14 +2782,977 @@ def force_download_model(model_id: str) -> bool:
         return False
 
 
+def _read_cpuinfo() -> Dict[str, Any]:
+    """CPU model name, physical core count and feature flags from /proc/cpuinfo (empty off Linux)."""
+    info = {}
+    try:
+        with open("/proc/cpuinfo", "r") as cpuinfo:
+            text = cpuinfo.read()
+    except OSError:
+        return info
+    model_name = re.search(r'^model name\s*:\s*(.+)$', text, re.MULTILINE)
+    if model_name:
+        info["model_name"] = model_name.group(1).strip()
+    flags = re.search(r'^flags\s*:\s*(.+)$', text, re.MULTILINE)
+    if flags:
+        info["flags"] = set(flags.group(1).split())
+    cores = set(re.findall(r'^physical id\s*:\s*(\d+)\s*$[\s\S]*?^core id\s*:\s*(\d+)\s*$', text, re.MULTILINE))
+    if cores:
+        info["physical_cores"] = len(cores)
+    return info
+
+
+def _total_memory_gb() -> Optional[float]:
+    try:
+        import psutil
+        return round(psutil.virtual_memory().total / (1024 ** 3), 1)
+    except ImportError:
+        pass
+    try:
+        with open("/proc/meminfo", "r") as meminfo:
+            total_kb = int(re.search(r'^MemTotal:\s*(\d+)', meminfo.read(), re.MULTILINE).group(1))
+        return round(total_kb / (1024 ** 2), 1)
+    except (OSError, AttributeError, ValueError):
+        return None
+
+
+def probe_hardware(torch_module=None) -> Dict[str, Any]:
+    """Cores, SIMD/matrix extensions (AVX2, AVX-512, AMX), memory and, given torch, GPUs of this machine."""
+    import platform
+    cpuinfo = _read_cpuinfo()
+    flags = cpuinfo.get("flags", set())
+    physical_cores = cpuinfo.get("physical_cores")
+    try:
+        import psutil
+        physical_cores = psutil.cpu_count(logical=False) or physical_cores
+    except ImportError:
+        pass
+    capability = None
+    if torch_module is not None and hasattr(torch_module.backends, "cpu"):
+        capability = torch_module.backends.cpu.get_cpu_capability()
+    hardware = {
+        "cpu": cpuinfo.get("model_name") or platform.processor() or platform.machine(),
+        "logical_cores": os.cpu_count() or 1,
+        "physical_cores": physical_cores or os.cpu_count() or 1,
+        "cpu_capability": capability,
+        "avx2": "avx2" in flags or capability in ("AVX2", "AVX512"),
+        "avx512": "avx512f" in flags or capability == "AVX512",
+        "avx512_bf16": "avx512_bf16" in flags,
+        "amx": "amx_tile" in flags,
+        "memory_gb": _total_memory_gb(),
+        "gpus": [],
+        "torch_version": torch_module.__version__ if torch_module is not None else None
+    }
+    if torch_module is not None and torch_module.cuda.is_available():
+        for index in range(torch_module.cuda.device_count()):
+            device = torch_module.cuda.get_device_properties(index)
+            hardware["gpus"].append({"name": device.name, "memory_gb": round(device.total_memory / (1024 ** 3), 1)})
+    return hardware
+
+
+def _hardware_fingerprint(hardware: Dict[str, Any]) -> str:
+    """Identity of the machine a profile was tuned on (CPU, cores, RAM); checked without importing torch."""
+    keys = ("cpu", "logical_cores", "physical_cores", "memory_gb")
+    return hashlib.sha1(json.dumps([hardware.get(key) for key in keys], sort_keys=True).encode("utf-8")).hexdigest()[:16]
+
+
+def _median_seconds(fn, repeats: int = 5) -> float:
+    fn()
+    timings = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        fn()
+        timings.append(time.perf_counter() - start)
+    return sorted(timings)[len(timings) // 2]
+
+
+def run_micro_benchmarks(torch_module, hardware: Dict[str, Any]) -> Dict[str, Any]:
+    """Short CPU benchmarks (a few seconds): model-sized matmul latency per thread count, reduced-precision speedup, batch throughput.
+    
+    The matmul has the shape of a decoder MLP projection during prefill; toy-sized matrices finish
+    before extra threads pay off and would steer the thread choice towards too few threads.
+    """
+    original_threads = torch_module.get_num_threads()
+    physical_cores = hardware["physical_cores"]
+    tokens, hidden_size, mlp_width = _tune_matmul_shape
+    activations = torch_module.randn(tokens, hidden_size)
+    weight = torch_module.randn(hidden_size, mlp_width)
+    results = {"matmul_ms_by_threads": {}, "dtype_speedup": {}, "items_per_second_by_batch": {}}
+    try:
+        with torch_module.inference_mode():
+            thread_counts = sorted({1, 2, 4, 8, 16, 32, physical_cores} & set(range(1, physical_cores + 1)))
+            for threads in thread_counts:
+                torch_module.set_num_threads(threads)
+                results["matmul_ms_by_threads"][threads] = round(_median_seconds(lambda: activations @ weight, 3) * 1000, 3)
+            
+            # Fewest threads within 25% of the best latency; the remaining cores go to more workers
+            best_ms = min(results["matmul_ms_by_threads"].values())
+            intra_op_threads = min(t for t, elapsed in results["matmul_ms_by_threads"].items() if elapsed <= best_ms * 1.25)
+            results["intra_op_threads"] = intra_op_threads
+            torch_module.set_num_threads(intra_op_threads)
+            
+            fp32_seconds = _median_seconds(lambda: activations @ weight, 3)
+            for dtype_name in ("bfloat16", "float16"):
+                reduced_activations = activations.to(getattr(torch_module, dtype_name))
+                reduced_weight = weight.to(getattr(torch_module, dtype_name))
+                try:
+                    results["dtype_speedup"][dtype_name] = round(fp32_seconds / _median_seconds(lambda: reduced_activations @ reduced_weight, 3), 2)
+                except RuntimeError:
+                    results["dtype_speedup"][dtype_name] = 0.0
+            
+            layer = torch_module.nn.Linear(_tune_hidden_size, _tune_hidden_size)
+            for batch_size in _tune_batch_sizes:
+                batch = torch_module.randn(batch_size, 64, _tune_hidden_size)
+                results["items_per_second_by_batch"][batch_size] = round(batch_size / _median_seconds(lambda: layer(batch), 3), 1)
+    finally:
+        torch_module.set_num_threads(original_threads)
+    return results
+
+
+def build_hardware_profile(torch_module) -> Dict[str, Any]:
+    """Probe this machine, benchmark it, and derive runtime settings (threads, workers, dtype, batch sizes)."""
+    hardware = probe_hardware(torch_module)
+    benchmarks = run_micro_benchmarks(torch_module, hardware)
+    
+    intra_op_threads = benchmarks["intra_op_threads"]
+    workers = max(1, min(4, hardware["physical_cores"] // intra_op_threads))
+    # Reduced precision only where the CPU runs it natively fast (AMX / AVX512-BF16); emulated bf16 is slower than fp32
+    speedups = benchmarks["dtype_speedup"]
+    cpu_dtype = max(speedups, key=speedups.get) if speedups and max(speedups.values()) >= _tune_min_dtype_speedup else "float32"
+    
+    # Smallest batch reaching 90% of peak throughput, capped on small-memory machines
+    throughput = benchmarks["items_per_second_by_batch"]
+    batch_size = min(size for size, rate in throughput.items() if rate >= 0.9 * max(throughput.values()))
+    if hardware["memory_gb"] is not None and hardware["memory_gb"] < 8:
+        batch_size = min(batch_size, 8)
+    
+    return {
+        "version": _hardware_profile_version,
+        "fingerprint": _hardware_fingerprint(hardware),
+        "created_at": time.time(),
+        "hardware": hardware,
+        "benchmarks": benchmarks,
+        "settings": {
+            "workers": workers,
+            "intra_op_threads": intra_op_threads,
+            "inter_op_threads": 1 if workers > 1 else None,
+            "cpu_dtype": cpu_dtype,
+            "models": {
+                "text-generation": {"dtype": cpu_dtype},
+                "vision-language": {"dtype": cpu_dtype},
+                "image-to-text": {"dtype": cpu_dtype},
+                "embedding": {"dtype": cpu_dtype, "batch_size": batch_size}
+            },
+            "environment": dict(_tuned_environment)
+        }
+    }
+
+
+def load_hardware_profile(mode: str = "on") -> Optional[Dict[str, Any]]:
+    """Tuned runtime profile for this machine (mode "off" disables, "refresh" re-tunes).
+    
+    The profile is persisted in the state directory and reused instantly while the hardware
+    fingerprint matches; otherwise torch is imported and the micro-benchmarks run once.
+    Tuned environment variables are applied before torch is imported. A torch upgrade is
+    noticed in setup_environment, which re-tunes.
+    """
+    global _hardware_profile
+    if mode == "off":
+        return None
+    profile_path = os.path.join(get_state_dir(), _hardware_profile_name)
+    profile = None
+    if mode != "refresh":
+        try:
+            with open(profile_path, "r", encoding="utf-8") as profile_file:
+                profile = json.load(profile_file)
+        except (OSError, ValueError):
+            profile = None
+    if (profile is not None and profile.get("version") == _hardware_profile_version
+            and profile.get("fingerprint") == _hardware_fingerprint(probe_hardware())):
+        _hardware_profile = profile
+        for name, value in profile["settings"].get("environment", {}).items():
+            os.environ.setdefault(name, value)
+        return profile
+    
+    # The environment does not depend on the benchmarks and only takes effect if set before torch is imported
+    for name, value in _tuned_environment.items():
+        os.environ.setdefault(name, value)
+    try:
+        import torch as torch_module
+    except ImportError:
+        return None
+    print("Tuning runtime for this machine (first start)...", file=sys.stderr)
+    profile = build_hardware_profile(torch_module)
+    try:
+        os.makedirs(os.path.dirname(profile_path), exist_ok=True)
+        with open(profile_path + ".tmp", "w", encoding="utf-8") as profile_file:
+            json.dump(profile, profile_file, indent=2)
+        os.replace(profile_path + ".tmp", profile_path)
+    except OSError as e:
+        print(f"Could not save hardware profile to {profile_path}: {e}", file=sys.stderr)
+    _hardware_profile = profile
+    return profile
+
+
+def get_tuned_setting(model_type: str, name: str, default=None):
+    """A per-model-type setting from the hardware profile (default when not tuned)."""
+    if _hardware_profile is None:
+        return default
+    return _hardware_profile["settings"].get("models", {}).get(model_type, {}).get(name, default)
+
+
+def select_model_dtype(model_type: str, on_cpu: bool, params: Dict[str, Any]):
+    """Load dtype: float16 on GPU; on CPU float32 unless params["cpu_dtype"] opts into reduced precision.
+    
+    "auto" uses the tuned dtype (bfloat16 only where AMX/AVX512-BF16 make it faster); reduced
+    precision can change outputs, so it is never chosen without being asked for.
+    """
+    if not on_cpu:
+        return torch.float16
+    cpu_dtype = params.get("cpu_dtype") or "float32"
+    if cpu_dtype == "auto":
+        cpu_dtype = get_tuned_setting(model_type, "dtype", "float32")
+    return getattr(torch, cpu_dtype)
+
+
+def configure_inference_scheduler(workers: Optional[int] = None, intra_op_threads: Optional[int] = None,
+                                  inter_op_threads: Optional[int] = None, model_concurrency: int = 1,
+                                  tuned_intra_op_threads: Optional[int] = None) -> Dict[str, Any]:
+    """Set the CPU/thread allocation for concurrent inference and return it.
+    
+    workers bounds how many independent inferences run at once. torch's intra-op thread
+    count is process-wide, so it is lowered to intra_op_threads (default cores // workers)
+    only once several inferences actually run together (see apply_thread_split); a single
+    request keeps torch's default of all cores unless intra_op_threads was given
+    (tuned_intra_op_threads from the hardware profile only sets the concurrent split). Must
+    run before setup_environment (inter-op threads can only be set before torch starts
+    parallel work).
+    """
+    global _inference_executor
+    cores = os.cpu_count() or 1
+    workers = max(1, workers or min(4, cores))
+    _scheduler_config.update({
+        "workers": workers,
+        "intra_op_threads": max(1, intra_op_threads or tuned_intra_op_threads or cores // workers),
+        "intra_op_explicit": bool(intra_op_threads),
+        "inter_op_threads": inter_op_threads,
+        "model_concurrency": max(1, model_concurrency or 1)
+    })
+    with _inference_executor_lock:
+        if _inference_executor is not None:
+            _inference_executor.shutdown(wait=False)
+            _inference_executor = None
+    with _model_slots_guard:
+        _model_slots.clear()
+    return get_thread_allocation()
+
+
+def get_thread_allocation() -> Dict[str, Any]:
+    """Current scheduler configuration (cores, workers, intra/inter-op threads, per-model concurrency)."""
+    if _scheduler_config["workers"] is None:
+        configure_inference_scheduler()
+    allocation = dict(_scheduler_config)
+    allocation["cores"] = os.cpu_count() or 1
+    if torch is not None:
+        allocation["torch_num_threads"] = torch.get_num_threads()
+        allocation["torch_num_interop_threads"] = torch.get_num_interop_threads()
+    return allocation
+
+
+def apply_thread_split():
+    """Lower torch's process-wide intra-op threads to the per-worker share once inferences run concurrently."""
+    global _thread_split_applied
+    if torch is None or _thread_split_applied or (_scheduler_config["workers"] or 1) <= 1:
+        return
+    torch.set_num_threads(_scheduler_config["intra_op_threads"])
+    _thread_split_applied = True
+
+
+def _get_inference_executor() -> ThreadPoolExecutor:
+    """Shared thread pool for per-item inference work (images, audio files) within a request."""
+    global _inference_executor
+    if _scheduler_config["workers"] is None:
+        configure_inference_scheduler()
+    with _inference_executor_lock:
+        if _inference_executor is None:
+            _inference_executor = ThreadPoolExecutor(max_workers=_scheduler_config["workers"], thread_name_prefix="inference")
+        return _inference_executor
+
+
+def map_inference(fn, items: list) -> list:
+    """Run fn(*item) for independent items concurrently on the scheduler, preserving order.
+    
+    Items must not submit further work to the scheduler themselves.
+    """
+    observe_batch_size(len(items))
+    if len(items) <= 1:
+        return [fn(*item) for item in items]
+    bound_fn = _bind_inference_record(fn)
+    
+    def run_item(*item):
+        try:
+            return bound_fn(*item)
+        finally:
+            with _metrics_lock:
+                _worker_queue_state["scheduler"] -= 1
+    
+    executor = _get_inference_executor()
+    apply_thread_split()
+    futures = []
+    for item in items:
+        with _metrics_lock:
+            _worker_queue_state["scheduler"] += 1
+        try:
+            futures.append(executor.submit(run_item, *item))
+        except Exception:
+            with _metrics_lock:
+                _worker_queue_state["scheduler"] -= 1
+            raise
+    return [future.result() for future in futures]
+
+
+def model_slot(model_key: Optional[str]) -> threading.BoundedSemaphore:
+    """Per-model concurrency slot; hold it around forward/generate calls on a shared model."""
+    with _model_slots_guard:
+        slot = _model_slots.get(model_key)
+        if slot is None:
+            slot = threading.BoundedSemaphore(_scheduler_config["model_concurrency"])
+            _model_slots[model_key] = slot
+        return slot
+
+
+def _get_model_load_lock(cache_key: str) -> threading.Lock:
+    """Return the lock guarding the load of a single model cache entry."""
+    with _model_load_locks_guard:
+        lock = _model_load_locks.get(cache_key)
+        if lock is None:
+            lock = threading.Lock()
+            _model_load_locks[cache_key] = lock
+        return lock
+
+
+def get_compile_cache_dir() -> str:
+    """Directory for persisted compiled artifacts (Inductor kernel cache and the compile manifest)."""
+    return os.path.join(get_state_dir(), "CompiledModels")
+
+
+def configure_compile_cache():
+    """Point the Inductor caches at the state dir so compiled kernels survive restarts (must run before torch is imported)."""
+    os.environ.setdefault("TORCHINDUCTOR_CACHE_DIR", os.path.join(get_compile_cache_dir(), "inductor"))
+    os.environ.setdefault("TORCHINDUCTOR_FX_GRAPH_CACHE", "1")
+    os.environ.setdefault("TORCHINDUCTOR_AUTOGRAD_CACHE", "1")
+
+
+def model_revision(model, model_path: str) -> str:
+    """Hub commit of a loaded model, or a digest of its local config.json."""
+    return config_revision(model.config, model_path)
+
+
+def config_revision(config, model_path: str) -> str:
+    """Hub commit a model config was loaded from, or a digest of its local config.json."""
+    commit = getattr(config, "_commit_hash", None)
+    if commit:
+        return commit[:12]
+    config_path = os.path.join(model_path, "config.json")
+    if os.path.isfile(config_path):
+        return _file_digest(config_path)[:12]
+    return "unknown"
+
+
+def _update_compile_manifest(cache_key: str, shape_bucket: Optional[int] = None, **fields) -> dict:
+    """Record a compiled model in the manifest (revision, model type, compiled shape buckets) and return its entry."""
+    manifest_path = os.path.join(get_compile_cache_dir(), _compile_manifest_name)
+    with _compile_manifest_lock:
+        try:
+            with open(manifest_path, "r", encoding="utf-8") as manifest_file:
+                manifest = json.load(manifest_file)
+        except (OSError, ValueError):
+            manifest = {}
+        entry = manifest.get(cache_key, {})
+        # A new revision compiles new graphs; buckets recorded for the old one no longer apply
+        if fields.get("revision") and entry.get("revision") != fields["revision"]:
+            entry = {}
+        entry.update(fields)
+        if shape_bucket is not None:
+            entry["shape_buckets"] = sorted(set(entry.get("shape_buckets", [])) | {shape_bucket})
+        manifest[cache_key] = entry
+        try:
+            os.makedirs(os.path.dirname(manifest_path), exist_ok=True)
+            with open(manifest_path + ".tmp", "w", encoding="utf-8") as manifest_file:
+                json.dump(manifest, manifest_file, indent=2)
+            os.replace(manifest_path + ".tmp", manifest_path)
+        except OSError as e:
+            print(f"Could not update compile manifest {manifest_path}: {e}", file=sys.stderr)
+        return dict(entry)
+
+
+def compile_for_inference(model, model_type: str, cache_key: str, model_path: str, params: Dict[str, Any]) -> bool:
+    """Compile the fixed-shape parts of a resident model with torch.compile (params["compile"] == "torch").
+    
+    Text generation decodes through a static KV cache with a compiled forward, sized by
+    static_cache_length, and prefills compiled at prompt lengths padded by prompt_bucket; BLIP compiles its vision encoder (fixed image size) and Whisper its
+    audio encoder (fixed 30 s window). Kernels persist under get_compile_cache_dir(), so each
+    (revision, shape bucket) compiles once and later starts load it from disk. Graphs dynamo
+    cannot handle run eagerly.
+    """
+    if params.get("compile", "off") != "torch" or not hasattr(torch, "compile"):
+        return False
+    torch._dynamo.config.suppress_errors = True
+    on_cpu = next(model.parameters()).device.type == "cpu"
+    try:
+        if model_type == "text-generation":
+            from transformers import CompileConfig
+            compile_config = CompileConfig(dynamic=False, mode="default" if on_cpu else "reduce-overhead")
+            # generate() only auto-compiles on accelerators unless told otherwise
+            compile_config._compile_all_devices = on_cpu or None
+            model.generation_config.compile_config = compile_config
+        elif model_type == "image-to-text" and hasattr(model, "vision_model"):
+            model.vision_model.forward = torch.compile(model.vision_model.forward, dynamic=False)
+        elif model_type == "automatic-speech-recognition" and getattr(model.config, "model_type", "") == "whisper":
+            encoder = model.get_encoder()
+            encoder.forward = torch.compile(encoder.forward, dynamic=False)
+        else:
+            return False
+    except Exception as e:
+        print(f"Could not compile {cache_key}, running eagerly: {e}", file=sys.stderr)
+        return False
+    _compiled_models[cache_key] = _update_compile_manifest(cache_key, model_type=model_type,
+                                                           revision=model_revision(model, model_path), compiled_at=time.time())
+    return True
+
+
+def static_cache_length(cache_key: str, needed_tokens: int, context_window: int) -> int:
+    """Static KV-cache length for compiled decoding: the next power of two of at least _static_cache_min_tokens, within the context window."""
+    length = _static_cache_min_tokens
+    while length < needed_tokens:
+        length *= 2
+    length = max(needed_tokens, min(length, context_window))
+    record = _compiled_models.get(cache_key)
+    if record is not None and length not in record.get("shape_buckets", []):
+        _compiled_models[cache_key] = _update_compile_manifest(cache_key, shape_bucket=length)
+    return length
+
+
+def fit_prompt_buckets(lengths: list, max_buckets: int = _prompt_max_buckets, alignment: int = _prompt_alignment) -> list:
+    """At most max_buckets bucket lengths (multiples of alignment) minimizing the total padding of the observed lengths.
+
+    Optimal 1-D partition by dynamic programming over the sorted distinct aligned lengths;
+    each bucket is the largest length of the run it covers.
+    """
+    counts = {}
+    for length in lengths:
+        aligned = -(-length // alignment) * alignment
+        counts[aligned] = counts.get(aligned, 0) + 1
+    values = sorted(counts)
+    if len(values) <= max_buckets:
+        return values
+    count_prefix, total_prefix = [0], [0]
+    for value in values:
+        count_prefix.append(count_prefix[-1] + counts[value])
+        total_prefix.append(total_prefix[-1] + counts[value] * value)
+
+    def padding(first: int, last: int) -> int:
+        # Tokens added when values[first..last] are all padded to values[last]
+        return values[last] * (count_prefix[last + 1] - count_prefix[first]) - (total_prefix[last + 1] - total_prefix[first])
+
+    # best[k][j]: least padding covering values[0..j] with k + 1 buckets, the last ending at j
+    best = [[padding(0, last) for last in range(len(values))]]
+    starts = [[0] * len(values)]
+    for k in range(1, max_buckets):
+        row, row_starts = [], []
+        for last in range(len(values)):
+            options = [(best[k - 1][first - 1] + padding(first, last), first) for first in range(k, last + 1)]
+            cost, first = min(options) if options else (best[k - 1][last], None)
+            row.append(cost)
+            row_starts.append(first)
+        best.append(row)
+        starts.append(row_starts)
+
+    buckets, last, k = [], len(values) - 1, max_buckets - 1
+    while last >= 0:
+        first = starts[k][last] if k > 0 else 0
+        if first is None:
+            k -= 1
+            continue
+        buckets.append(values[last])
+        last, k = first - 1, k - 1
+    return sorted(buckets)
+
+
+def prompt_bucket(cache_key: str, length: int, limit: int) -> int:
+    """Padded prompt length for compiled prefill of a model, recording the length in its traffic statistics.
+
+    Lengths are padded to the smallest bucket that keeps padding within _prompt_max_padding of
+    the padded length (or one alignment step); otherwise to the next multiple of
+    _prompt_alignment. Buckets are refitted with fit_prompt_buckets every
+    _prompt_refit_interval prompts and persisted in the compile manifest, so a restart compiles
+    the same prefill shapes. Before any traffic is seen, powers of two serve as buckets.
+    """
+    with _prompt_bucket_lock:
+        stats = _prompt_stats.get(cache_key)
+        if stats is None:
+            record = _compiled_models.get(cache_key) or {}
+            stats = _prompt_stats[cache_key] = {
+                "lengths": deque(record.get("prompt_lengths", []), maxlen=_prompt_length_window),
+                "buckets": record.get("prompt_buckets", []),
+                "since_refit": 0
+            }
+        stats["lengths"].append(length)
+        stats["since_refit"] += 1
+        refit = stats["since_refit"] >= _prompt_refit_interval
+        if refit:
+            stats["buckets"] = fit_prompt_buckets(list(stats["lengths"]))
+            stats["since_refit"] = 0
+        buckets = stats["buckets"]
+        observed = list(stats["lengths"]) if refit else None
+    if refit and cache_key in _compiled_models:
+        _compiled_models[cache_key] = _update_compile_manifest(cache_key, prompt_buckets=buckets, prompt_lengths=observed)
+
+    candidates = buckets or [_prompt_alignment << shift for shift in range(16)]
+    for bucket in candidates:
+        if length <= bucket <= limit and bucket - length <= max(_prompt_max_padding * bucket, _prompt_alignment):
+            return bucket
+    aligned = -(-length // _prompt_alignment) * _prompt_alignment
+    return aligned if aligned <= limit else length
+
+
+def get_onnx_export_dir(model_path: str, revision: str) -> str:
+    """Directory holding the exported ONNX graphs of one model revision."""
+    name = re.sub(r"[^A-Za-z0-9_.-]+", "_", model_path.strip("/\\"))[-80:]
+    return os.path.join(get_state_dir(), "OnnxModels", f"{name}-{revision}")
+
+
+def _read_onnx_export(export_dir: str) -> Optional[Dict[str, Any]]:
+    try:
+        with open(os.path.join(export_dir, _onnx_export_name), "r", encoding="utf-8") as export_file:
+            return json.load(export_file)
+    except (OSError, ValueError):
+        return None
+
+
+def export_onnx_model(model_type: str, model_path: str, is_local: bool, export_dir: str, quantize: bool = True) -> Dict[str, Any]:
+    """Export a Whisper or BLIP model as ONNX graphs (plus int8 copies) and write the export record.
+
+    Three graphs per model: the encoder; the decoder for the prompt, which also returns every
+    layer's self- and cross-attention keys/values; and decoder_with_past, which takes new tokens
+    plus those keys/values and returns the grown self-attention ones. Cross-attention keys/values
+    depend only on the encoder output, so they are computed once per image or audio window.
+    """
+    import inspect
+    from transformers import BlipForConditionalGeneration, WhisperForConditionalGeneration
+    from transformers.cache_utils import EncoderDecoderCache
+
+    architecture = _onnx_model_types[model_type]
+    model_class = WhisperForConditionalGeneration if architecture == "whisper" else BlipForConditionalGeneration
+    model = model_class.from_pretrained(model_path, torch_dtype=torch.float32, local_files_only=is_local).eval()
+    config = model.config
+
+    if architecture == "whisper":
+        num_layers = config.decoder_layers
+        start_token_id = config.decoder_start_token_id
+        encoder_input = torch.zeros(1, config.num_mel_bins, 2 * config.max_source_positions)
+        encoder_input_name = "input_features"
+        encoder_fn = lambda features: model.model.encoder(input_features=features).last_hidden_state
+
+        def run_decoder(input_ids, attention_mask, states, cache):
+            outputs = model.model.decoder(input_ids=input_ids, attention_mask=attention_mask, encoder_hidden_states=states,
+                                          past_key_values=cache, use_cache=True)
+            return model.proj_out(outputs.last_hidden_state), outputs.past_key_values
+    else:
+        num_layers = config.text_config.num_hidden_layers
+        start_token_id = config.text_config.bos_token_id
+        image_size = config.vision_config.image_size
+        encoder_input = torch.zeros(1, 3, image_size, image_size)
+        encoder_input_name = "pixel_values"
+        encoder_fn = lambda pixel_values: model.vision_model(pixel_values=pixel_values)[0]
+
+        def run_decoder(input_ids, attention_mask, states, cache):
+            outputs = model.text_decoder(input_ids=input_ids, attention_mask=attention_mask, encoder_hidden_states=states,
+                                         past_key_values=cache, use_cache=True, return_dict=True)
+            return outputs.logits, outputs.past_key_values
+
+    def flatten_cache(cache, include_cross: bool) -> list:
+        tensors = []
+        for layer in range(num_layers):
+            tensors += [cache.self_attention_cache.layers[layer].keys, cache.self_attention_cache.layers[layer].values]
+            if include_cross:
+                tensors += [cache.cross_attention_cache.layers[layer].keys, cache.cross_attention_cache.layers[layer].values]
+        return tensors
+
+    def decoder_fn(input_ids, states):
+        # An all-ones mask keeps the exporter off the packed-sequence detection path
+        logits, cache = run_decoder(input_ids, torch.ones_like(input_ids), states, None)
+        return (logits, *flatten_cache(cache, include_cross=True))
+
+    def decoder_with_past_fn(input_ids, states, *past):
+        cache = EncoderDecoderCache([tuple(past[4 * layer:4 * layer + 4]) for layer in range(num_layers)])
+        attention_mask = torch.ones(input_ids.shape[0], past[0].shape[2] + input_ids.shape[1], dtype=torch.long)
+        logits, cache = run_decoder(input_ids, attention_mask, states, cache)
+        return (logits, *flatten_cache(cache, include_cross=False))
+
+    class GraphModule(torch.nn.Module):
+        """One exportable part of the model (the model is registered so its weights become initializers)."""
+        def __init__(self, forward_fn):
+            super().__init__()
+            self.model = model
+            self.forward_fn = forward_fn
+
+        def forward(self, *inputs):
+            return self.forward_fn(*inputs)
+
+    present_names = [f"present.{layer}.{kind}.{part}" for layer in range(num_layers) for kind in ("self", "cross") for part in ("key", "value")]
+    past_names = [name.replace("present.", "past.", 1) for name in present_names]
+    present_self_names = [name for name in present_names if ".self." in name]
+    # Self-attention lengths grow per step; cross-attention lengths are the encoder's
+    kv_axes = lambda names, length: {name: {0: "batch", 2: "encoder_tokens" if ".cross." in name else length} for name in names}
+
+    # Use the TorchScript exporter where torch also offers the dynamo one; it handles dynamic_axes for these models
+    export_kwargs = {"dynamo": False} if "dynamo" in inspect.signature(torch.onnx.export).parameters else {}
+    os.makedirs(export_dir, exist_ok=True)
+    with torch.no_grad():
+        encoder_states = encoder_fn(encoder_input)
+        torch.onnx.export(GraphModule(encoder_fn), (encoder_input,), os.path.join(export_dir, "encoder.onnx"),
+                          input_names=[encoder_input_name], output_names=["last_hidden_state"],
+                          dynamic_axes={encoder_input_name: {0: "batch"}, "last_hidden_state": {0: "batch"}},
+                          opset_version=_onnx_opset, **export_kwargs)
+        prompt_ids = torch.tensor([[start_token_id, start_token_id]], dtype=torch.long)
+        torch.onnx.export(GraphModule(decoder_fn), (prompt_ids, encoder_states), os.path.join(export_dir, "decoder.onnx"),
+                          input_names=["input_ids", "encoder_hidden_states"], output_names=["logits"] + present_names,
+                          dynamic_axes={"input_ids": {0: "batch", 1: "tokens"}, "encoder_hidden_states": {0: "batch"},
+                                        "logits": {0: "batch", 1: "tokens"}, **kv_axes(present_names, "tokens")},
+                          opset_version=_onnx_opset, **export_kwargs)
+        past = decoder_fn(prompt_ids, encoder_states)[1:]
+        torch.onnx.export(GraphModule(decoder_with_past_fn), (prompt_ids[:, :1], encoder_states, *past),
+                          os.path.join(export_dir, "decoder_with_past.onnx"),
+                          input_names=["input_ids", "encoder_hidden_states"] + past_names, output_names=["logits"] + present_self_names,
+                          dynamic_axes={"input_ids": {0: "batch", 1: "tokens"}, "encoder_hidden_states": {0: "batch"},
+                                        "logits": {0: "batch", 1: "tokens"}, **kv_axes(past_names, "past_tokens"),
+                                        **kv_axes(present_self_names, "total_tokens")},
+                          opset_version=_onnx_opset, **export_kwargs)
+
+    record = {"model_type": model_type, "architecture": architecture, "revision": config_revision(config, model_path),
+              "version": _onnx_export_version, "opset": _onnx_opset, "exported_at": time.time(), "num_layers": num_layers,
+              "graphs": {"fp32": {"encoder": "encoder.onnx", "decoder": "decoder.onnx", "decoder_with_past": "decoder_with_past.onnx"}}}
+    del model
+    _write_onnx_export(export_dir, record)
+    return quantize_onnx_export(export_dir, record) if quantize else record
+
+
+def _write_onnx_export(export_dir: str, record: Dict[str, Any]):
+    record_path = os.path.join(export_dir, _onnx_export_name)
+    with open(record_path + ".tmp", "w", encoding="utf-8") as record_file:
+        json.dump(record, record_file, indent=2)
+    os.replace(record_path + ".tmp", record_path)
+
+
+def quantize_onnx_export(export_dir: str, record: Dict[str, Any]) -> Dict[str, Any]:
+    """Add int8 copies of the exported graphs (dynamic quantization of MatMul/Gemm weights) to an export record."""
+    try:
+        from onnxruntime.quantization import QuantType, quantize_dynamic
+        int8_graphs = {}
+        for part, file_name in record["graphs"]["fp32"].items():
+            int8_graphs[part] = file_name.replace(".onnx", ".int8.onnx")
+            quantize_dynamic(os.path.join(export_dir, file_name), os.path.join(export_dir, int8_graphs[part]),
+                             weight_type=QuantType.QInt8)
+    except Exception as e:
+        print(f"int8 quantization in {export_dir} failed, keeping fp32 graphs: {e}", file=sys.stderr)
+        return record
+    record = dict(record, graphs=dict(record["graphs"], int8=int8_graphs))
+    _write_onnx_export(export_dir, record)
+    return record
+
+
+def get_or_load_onnx_model(model_type: str, model_id: str, params: Dict[str, Any], local_model_path: Optional[str] = None,
+                           export_missing: bool = False) -> Optional[Dict[str, Any]]:
+    """ONNX Runtime sessions plus processor and configs for a Whisper or BLIP model, or None when there is no usable export.
+
+    Exports live per model revision under <state dir>/OnnxModels. Without export_missing
+    (--backend auto) a model that was never exported (or was exported in an older layout)
+    stays on transformers; --backend onnx exports it on first use. Sessions run on the CPU provider with params["onnx_threads"]
+    intra-op threads (default: the per-worker share once inferences run concurrently, else all cores).
+    """
+    precision = params.get("onnx_precision", "int8")
+    allocation = get_thread_allocation()
+    threads = params.get("onnx_threads") or (allocation["intra_op_threads"] if _thread_split_applied else allocation["cores"])
+    model_path, is_local = resolve_model_path(model_id, local_model_path)
+    cache_key = f"{model_path}:{precision}:{threads}"
+    cached = _onnx_model_cache.get(cache_key)
+    if cached is not None:
+        count_cache_event("onnx", "hit")
+        return cached
+
+    with _get_model_load_lock(f"onnx:{cache_key}"):
+        cached = _onnx_model_cache.get(cache_key)
+        if cached is not None:
+            count_cache_event("onnx", "hit")
+            return cached
+        if importlib.util.find_spec("onnxruntime") is None and not (export_missing and check_and_install_package("onnxruntime")):
+            return None
+
+        from transformers import AutoConfig, AutoProcessor, GenerationConfig
+        config = AutoConfig.from_pretrained(model_path, local_files_only=is_local)
+        if config.model_type != _onnx_model_types[model_type]:
+            _onnx_unexported_models.add(model_path)
+            return None
+        export_dir = get_onnx_export_dir(model_path, config_revision(config, model_path))
+        record = _read_onnx_export(export_dir)
+        if record is not None and record.get("version") != _onnx_export_version:
+            record = None
+        if record is None:
+            if not export_missing or not check_and_install_package("onnx"):
+                # Remembered so --backend auto does not re-read the config and export record every request
+                _onnx_unexported_models.add(model_path)
+                return None
+            print(f"Exporting {model_id} to ONNX in {export_dir}...", file=sys.stderr)
+            with inference_phase("onnx_export"):
+                record = export_onnx_model(model_type, model_path, is_local, export_dir, quantize=precision == "int8")
+        elif precision not in record["graphs"] and export_missing and check_and_install_package("onnx"):
+            record = quantize_onnx_export(export_dir, record)
+        count_cache_event("onnx", "miss")
+
+        import onnxruntime
+        options = onnxruntime.SessionOptions()
+        options.intra_op_num_threads = threads
+        options.inter_op_num_threads = 1
+        options.execution_mode = onnxruntime.ExecutionMode.ORT_SEQUENTIAL
+        options.graph_optimization_level = onnxruntime.GraphOptimizationLevel.ORT_ENABLE_ALL
+        loaded_precision = precision if precision in record["graphs"] else "fp32"
+        onnx_model = {
+            part: onnxruntime.InferenceSession(os.path.join(export_dir, file_name), sess_options=options,
+                                               providers=["CPUExecutionProvider"])
+            for part, file_name in record["graphs"][loaded_precision].items()
+        }
+        try:
+            generation_config = GenerationConfig.from_pretrained(model_path, local_files_only=is_local)
+        except Exception:
+            generation_config = GenerationConfig.from_model_config(config)
+        onnx_model.update({
+            "processor": AutoProcessor.from_pretrained(model_path, local_files_only=is_local),
+            "config": config,
+            "generation_config": generation_config,
+            "precision": loaded_precision,
+            "threads": threads,
+            "export_dir": export_dir
+        })
+        print(f"✓ ONNX Runtime backend: {model_id} ({loaded_precision}, {threads} threads)", file=sys.stderr)
+        _onnx_unexported_models.discard(model_path)
+        _onnx_model_cache[cache_key] = onnx_model
+        return onnx_model
+
+
+def select_onnx_model(model_type: str, model_id: str, params: Dict[str, Any], local_model_path: Optional[str] = None) -> Optional[Dict[str, Any]]:
+    """The ONNX Runtime model serving this request per params["backend"], or None to run on transformers."""
+    backend = params.get("backend", "auto")
+    model_key = local_model_path or model_id
+    if backend == "pytorch" or model_type not in _onnx_model_types or model_key in _onnx_failed_models:
+        return None
+    if backend == "auto" and resolve_model_path(model_id, local_model_path)[0] in _onnx_unexported_models:
+        return None
+    try:
+        onnx_model = get_or_load_onnx_model(model_type, model_id, params, local_model_path, export_missing=backend == "onnx")
+    except Exception as e:
+        # Remember the failure so every later request does not repeat a failing export
+        _onnx_failed_models.add(model_key)
+        print(f"ONNX Runtime backend unavailable for {model_id}, using transformers: {e}", file=sys.stderr)
+        return None
+    if onnx_model is None and backend == "onnx":
+        print(f"No ONNX export available for {model_id}, using transformers", file=sys.stderr)
+    return onnx_model
+
+
+def _onnx_decoder_step(onnx_model: Dict[str, Any], input_ids, encoder_states, past: Optional[Dict[str, Any]] = None) -> tuple:
+    """Run the decoder on new tokens; returns (last-position logits per row, keys/values to continue from).
+
+    Without past the prompt goes through the decoder graph, which also yields the cross-attention
+    keys/values; with past only the new tokens go through decoder_with_past.
+    """
+    session = onnx_model["decoder"] if past is None else onnx_model["decoder_with_past"]
+    feeds = {"input_ids": input_ids, "encoder_hidden_states": encoder_states}
+    if past is not None:
+        feeds.update({name.replace("present.", "past.", 1): value for name, value in past.items()})
+    input_names = {graph_input.name for graph_input in session.get_inputs()}
+    output_names = [graph_output.name for graph_output in session.get_outputs()]
+    outputs = dict(zip(output_names, session.run(output_names, {name: value for name, value in feeds.items() if name in input_names})))
+    state = dict(past or {})
+    state.update({name: value for name, value in outputs.items() if name != "logits"})
+    return outputs["logits"][:, -1], state
+
+
+def _onnx_greedy_decode(onnx_model: Dict[str, Any], encoder_states, prompt_ids: list, max_new_tokens: int, eos_token_id: int,
+                        suppress_ids: Optional[list] = None, begin_suppress_ids: Optional[list] = None) -> list:
+    """Greedy decoding with the exported decoder graphs and a key/value cache; returns the generated ids without prompt and eos."""
+    import numpy as np
+    generated = []
+    logits, state = _onnx_decoder_step(onnx_model, np.array([prompt_ids], dtype=np.int64), encoder_states)
+    for step in range(max_new_tokens):
+        logits = logits[0]
+        if suppress_ids:
+            logits[suppress_ids] = -np.inf
+        if step == 0 and begin_suppress_ids:
+            logits[begin_suppress_ids] = -np.inf
+        next_id = int(np.argmax(logits))
+        if next_id == eos_token_id:
+            break
+        generated.append(next_id)
+        if step + 1 < max_new_tokens:
+            logits, state = _onnx_decoder_step(onnx_model, np.array([[next_id]], dtype=np.int64), encoder_states, state)
+    return generated
+
+
+def _onnx_beam_search(onnx_model: Dict[str, Any], encoder_states, prompt_ids: list, max_length: int, eos_token_id: int,
+                      num_beams: int, length_penalty: float = 1.0, early_stopping=False) -> list:
+    """Beam search with the exported decoder graphs, following transformers' beam search step for step.
+
+    Keeps 2 * num_beams candidates per step, finishes a hypothesis when it emits eos or reaches
+    max_length (prompt included), scores finished ones by log-probability / generated length **
+    length_penalty, and applies the same early-stopping rule. Returns the best hypothesis
+    without prompt and eos.
+    """
+    import numpy as np
+    prompt_length = cur_len = len(prompt_ids)
+    beams_to_keep = 2 * num_beams
+    logits, state = _onnx_decoder_step(onnx_model, np.array([prompt_ids], dtype=np.int64), encoder_states)
+    # Every beam starts from the same prompt; only the first one is live until the first step
+    logits = np.repeat(logits, num_beams, axis=0)
+    state = {name: np.repeat(value, num_beams, axis=0) for name, value in state.items()}
+    encoder_states = np.repeat(encoder_states, num_beams, axis=0)
+    running = [list(prompt_ids) for _ in range(num_beams)]
+    running_scores = np.array([0.0] + [-1.0e9] * (num_beams - 1), dtype=np.float32)
+    finished = [([], -1.0e9, False)] * num_beams  # (sequence, score, is finished), best first
+    improvement_possible = True
+
+    while True:
+        shifted = logits - logits.max(axis=-1, keepdims=True)
+        log_probs = shifted - np.log(np.exp(shifted).sum(axis=-1, keepdims=True))
+        scores = (log_probs + running_scores[:, None]).reshape(-1)
+        vocab_size = log_probs.shape[-1]
+        top = np.argpartition(-scores, beams_to_keep)[:beams_to_keep]
+        top = top[np.argsort(-scores[top], kind="stable")]
+        candidates = [(running[index // vocab_size] + [int(index % vocab_size)], float(scores[index]), int(index // vocab_size)) for index in top]
+        hits = [sequence[-1] == eos_token_id or cur_len + 1 >= max_length for sequence, _, _ in candidates]
+
+        # Best num_beams unfinished candidates keep running
+        order = sorted(range(beams_to_keep), key=lambda rank: -(candidates[rank][1] - 1.0e9 * hits[rank]))[:num_beams]
+        running = [candidates[rank][0] for rank in order]
+        running_scores = np.array([candidates[rank][1] - 1.0e9 * hits[rank] for rank in order], dtype=np.float32)
+        beam_order = [candidates[rank][2] for rank in order]
+
+        # Finished candidates among the top num_beams compete with earlier hypotheses
+        all_finished = all(done for _, _, done in finished)
+        new_finished = []
+        for rank, (sequence, score, _) in enumerate(candidates):
+            just_finished = hits[rank] and rank < num_beams
+            score = score / ((cur_len + 1 - prompt_length) ** length_penalty)
+            if (all_finished and early_stopping is True) or not improvement_possible or not just_finished:
+                score -= 1.0e9
+            new_finished.append((sequence, score, just_finished))
+        merged = finished + new_finished
+        finished = [merged[index] for index in sorted(range(len(merged)), key=lambda index: -merged[index][1])[:num_beams]]
+
+        cur_len += 1
+        best_length = (max_length - prompt_length) if early_stopping == "never" and length_penalty > 0.0 else cur_len - prompt_length
+        best_possible = running_scores[0] / (best_length ** length_penalty)
+        worst_finished = [min(score for _, score, _ in finished) if done else -1.0e9 for _, _, done in finished]
+        improvement_possible = improvement_possible and any(best_possible > worst for worst in worst_finished)
+        all_finished = all(done for _, _, done in finished)
+        if not improvement_possible or (all_finished and early_stopping is True) or all(hits):
+            break
+
+        state = {name: value[beam_order] if ".self." in name else value for name, value in state.items()}
+        last_tokens = np.array([[sequence[-1]] for sequence in running], dtype=np.int64)
+        logits, state = _onnx_decoder_step(onnx_model, last_tokens, encoder_states, state)
+
+    best = finished[0][0][prompt_length:]
+    return best[:-1] if best and best[-1] == eos_token_id else best
+
+
+def run_onnx_captioning(onnx_model: Dict[str, Any], pixel_values, max_length: int, num_beams: int = 1) -> list:
+    """Caption token ids for one preprocessed image from the exported BLIP graphs (beam search when num_beams > 1).
+
+    Raises NotImplementedError for generation settings the ONNX decoding loop does not reproduce,
+    so the caller can fall back to transformers instead of producing a different caption.
+    """
+    text_config = onnx_model["config"].text_config
+    generation_config = onnx_model["generation_config"]
+    for name, neutral in _onnx_unsupported_generation_settings.items():
+        if getattr(generation_config, name, neutral) not in (neutral, None):
+            raise NotImplementedError(f"generation setting {name}={getattr(generation_config, name)} is not supported by the ONNX decoder")
+    encoder_states = onnx_model["encoder"].run(["last_hidden_state"], {"pixel_values": pixel_values.float().numpy()})[0]
+    if num_beams > 1:
+        # Unset (None) settings mean the transformers defaults
+        length_penalty = getattr(generation_config, "length_penalty", None)
+        early_stopping = getattr(generation_config, "early_stopping", None)
+        return _onnx_beam_search(onnx_model, encoder_states, [text_config.bos_token_id], max_length, text_config.sep_token_id, num_beams,
+                                 1.0 if length_penalty is None else length_penalty, False if early_stopping is None else early_stopping)
+    return _onnx_greedy_decode(onnx_model, encoder_states, [text_config.bos_token_id], max_length - 1, text_config.sep_token_id)
+
+
+def _whisper_prompt_ids(onnx_model: Dict[str, Any], encoder_states) -> list:
+    """Decoder prompt for transcription: start token, detected language and task for multilingual models, no timestamps."""
+    import numpy as np
+    generation_config = onnx_model["generation_config"]
+    prompt = [onnx_model["config"].decoder_start_token_id]
+    lang_to_id = getattr(generation_config, "lang_to_id", None)
+    if lang_to_id and getattr(generation_config, "is_multilingual", True):
+        # Language detection: the most likely language token after the start token, as generate() does
+        logits = onnx_model["decoder"].run(["logits"], {"input_ids": np.array([prompt], dtype=np.int64),
+                                                        "encoder_hidden_states": encoder_states})[0][0, -1]
+        language_ids = list(lang_to_id.values())
+        prompt.append(language_ids[int(np.argmax(logits[language_ids]))])
+        task_id = (getattr(generation_config, "task_to_id", None) or {}).get("transcribe")
+        if task_id is not None:
+            prompt.append(task_id)
+    no_timestamps_id = getattr(generation_config, "no_timestamps_token_id", None)
+    if no_timestamps_id is not None:
+        prompt.append(no_timestamps_id)
+    return prompt
+
+
+def run_onnx_transcription(onnx_model: Dict[str, Any], audio_array) -> tuple:
+    """(text, generated token count) for 16 kHz audio from the exported Whisper graphs, one 30 s window at a time."""
+    import numpy as np
+    processor, config, generation_config = onnx_model["processor"], onnx_model["config"], onnx_model["generation_config"]
+    max_length = min(getattr(generation_config, "max_length", None) or config.max_target_positions, config.max_target_positions)
+    window = _whisper_chunk_seconds * 16000
+    texts, token_count = [], 0
+    for start in range(0, max(1, len(audio_array)), window):
+        features = processor.feature_extractor(audio_array[start:start + window], sampling_rate=16000,
+                                               return_tensors="np")["input_features"].astype(np.float32)
+        encoder_states = onnx_model["encoder"].run(["last_hidden_state"], {"input_features": features})[0]
+        prompt = _whisper_prompt_ids(onnx_model, encoder_states)
+        token_ids = _onnx_greedy_decode(onnx_model, encoder_states, prompt, max_length - len(prompt), config.eos_token_id,
+                                        getattr(generation_config, "suppress_tokens", None),
+                                        getattr(generation_config, "begin_suppress_tokens", None))
+        token_count += len(token_ids)
+        texts.append(processor.tokenizer.decode(token_ids, skip_special_tokens=True).strip())
+    return " ".join(text for text in texts if text), token_count
+
+
+def model_cache_key(model_id: str, local_model_path: Optional[str] = None) -> str:
+    """Key of a model in its resident cache, load lock and model_slot."""
+    return local_model_path if local_model_path else model_id
+
+
 def get_or_load_model(model_id: str, params: Dict[str, Any], local_model_path: Optional[str] = None):
     """Get model and tokenizer from cache or load them with optimized performance."""
-    cache_key = local_model_path if local_model_path else model_id
+    cache_key = model_cache_key(model_id, local_model_path)
     
     # Check if already cached - fast path
     if cache_key in _model_cache and cache_key in _tokenizer_cache:
+        count_cache_event("model", "hit")
         return _model_cache[cache_key], _tokenizer_cache[cache_key]
     
+    # Serialize loads per model - a request for a model that is being warmed up waits for the warm-up
+    with _get_model_load_lock(cache_key):
+        if cache_key in _model_cache and cache_key in _tokenizer_cache:
+            count_cache_event("model", "hit")
+            return _model_cache[cache_key], _tokenizer_cache[cache_key]
+        count_cache_event("model", "miss")
+        return _load_model_and_tokenizer(model_id, cache_key, params, local_model_path)
+
+
+def _load_model_and_tokenizer(model_id: str, cache_key: str, params: Dict[str, Any], local_model_path: Optional[str] = None):
+    """Load a causal LM and its tokenizer and store them in the model cache."""
     # Special handling for problematic models
     if "vibevoice" in model_id.lower():
         raise Exception("The VibeVoice model architecture is not yet supported. Please try using an alternative TTS model like 'microsoft/speecht5_tts' or 'facebook/mms-tts-eng'.")
@@ -1333,14 +3760,8 @@ def get_or_load_model(model_id: str, params: Dict[str, Any], local_model_path: O
     # Use global imports for better performance
     from transformers import AutoTokenizer, AutoModelForCausalLM
     
-    # CRITICAL FIX: Don't use local_model_path if it doesn't exist or is empty
-    # This was causing the "preprocessor_config.json" not found errors
-    if local_model_path and os.path.exists(local_model_path) and os.listdir(local_model_path):
-        model_path_to_use = local_model_path
-        print(f"Using valid local model path: {local_model_path}", file=sys.stderr)
-    else:
-        model_path_to_use = model_id
-        print(f"Using HuggingFace Hub model: {model_id} (local path invalid or empty)", file=sys.stderr)
+    # Don't use local_model_path if it doesn't exist or is empty
+    model_path_to_use, is_local_model = resolve_model_path(model_id, local_model_path)
     
     # Optimized tokenizer loading
     try:
@@ -1348,8 +3769,8 @@ def get_or_load_model(model_id: str, params: Dict[str, Any], local_model_path: O
         tokenizer = AutoTokenizer.from_pretrained(
             model_path_to_use,
             trust_remote_code=params.get("trust_remote_code", True),
-            cache_dir="C:\\Users\\tanne\\Documents\\CSimple\\Resources\\HFModels" if not local_model_path else None,
-            local_files_only=bool(local_model_path),
+            cache_dir=None if is_local_model else get_model_cache_dir(),
+            local_files_only=is_local_model,
             use_fast=True,  # Prefer fast tokenizer for speed
             padding_side="left"  # Optimize for generation
         )
@@ -1358,8 +3779,8 @@ def get_or_load_model(model_id: str, params: Dict[str, Any], local_model_path: O
         tokenizer = AutoTokenizer.from_pretrained(
             model_path_to_use,
             trust_remote_code=params.get("trust_remote_code", True),
-            cache_dir="C:\\Users\\tanne\\Documents\\CSimple\\Resources\\HFModels" if not local_model_path else None,
-            local_files_only=bool(local_model_path),
+            cache_dir=None if is_local_model else get_model_cache_dir(),
+            local_files_only=is_local_model,
             use_fast=False
         )
     
@@ -1369,10 +3790,10 @@ def get_or_load_model(model_id: str, params: Dict[str, Any], local_model_path: O
     
     model_kwargs = {
         "trust_remote_code": params.get("trust_remote_code", True),
-        "torch_dtype": torch.float32 if force_cpu else torch.float16,
+        "torch_dtype": select_model_dtype("text-generation", force_cpu, params),
         "low_cpu_mem_usage": True,
-        "cache_dir": "C:\\Users\\tanne\\Documents\\CSimple\\Resources\\HFModels" if not local_model_path else None,
-        "local_files_only": bool(local_model_path)
+        "cache_dir": None if is_local_model else get_model_cache_dir(),
+        "local_files_only": is_local_model
     }
     
     # Optimize model loading strategy
@@ -1395,13 +3816,14 @@ def get_or_load_model(model_id: str, params: Dict[str, Any], local_model_path: O
         if not force_cpu:
             print(f"GPU loading failed, falling back to CPU: {e}", file=sys.stderr)
             model_kwargs["device_map"] = "cpu"
-            model_kwargs["torch_dtype"] = torch.float32
+            model_kwargs["torch_dtype"] = select_model_dtype("text-generation", True, params)
             model = AutoModelForCausalLM.from_pretrained(model_path_to_use, **model_kwargs)
         else:
             raise
     
     # Set model to eval mode for inference optimization
     model.eval()
+    compile_for_inference(model, "text-generation", cache_key, model_path_to_use, params)
     
     # Optimize for inference
     if hasattr(model, 'generation_config'):
@@ -1420,24 +3842,1388 @@ def get_or_load_model(model_id: str, params: Dict[str, Any], local_model_path: O
     return model, tokenizer
 
 
-def preload_models(model_ids: list, params: Dict[str, Any]) -> bool:
-    """Pre-load models into cache for faster subsequent execution."""
+def estimate_model_size_mb(model_id: str, local_model_path: Optional[str] = None) -> float:
+    """Estimate the in-memory size of a model from the size of its weight files (0 if unknown)."""
+    if local_model_path and os.path.isdir(local_model_path):
+        search_roots = [Path(local_model_path)]
+    else:
+        cache_dir = get_model_cache_dir()
+        snapshots_dir = Path(cache_dir) / f"models--{model_id.replace('/', '--')}" / "snapshots"
+        search_roots = [d for d in snapshots_dir.iterdir() if d.is_dir()] if snapshots_dir.exists() else []
+        search_roots.sort(key=lambda d: d.stat().st_mtime)
+    
+    total_bytes = 0
+    for root in search_roots[-1:]:  # Only the most recent snapshot
+        for dirpath, _, filenames in os.walk(root):
+            for filename in filenames:
+                if filename.lower().endswith(_weight_file_extensions):
+                    try:
+                        total_bytes += os.stat(os.path.join(dirpath, filename)).st_size
+                    except OSError:
+                        pass
+    return total_bytes / (1024 * 1024)
+
+
+def _default_warmup_budget_mb() -> Optional[float]:
+    """Default warm-up budget: half of physical memory, or no budget if it cannot be determined."""
+    try:
+        import psutil
+        return psutil.virtual_memory().total / (1024 * 1024) / 2
+    except Exception:
+        pass
+    try:
+        return os.sysconf("SC_PAGE_SIZE") * os.sysconf("SC_PHYS_PAGES") / (1024 * 1024) / 2
+    except (AttributeError, ValueError, OSError):
+        return None
+
+
+def _set_model_readiness(model_id: str, state: str):
+    """Record the warm-up state of a model ("queued", "loading", "warming", "ready", "skipped: ...", "failed: ...")."""
+    with _warmup_state_lock:
+        _model_readiness[model_id] = state
+    print(f"[warmup] {model_id}: {state}", file=sys.stderr)
+
+
+def _warm_up_model(model_id: str, params: Dict[str, Any], local_model_path: Optional[str] = None):
+    """Load a model into the cache and run a tiny forward pass to trigger lazy initialization."""
+    cache_key = model_cache_key(model_id, local_model_path)
+    try:
+        _set_model_readiness(model_id, "loading")
+        start_time = time.perf_counter()
+        model, tokenizer = get_or_load_model(model_id, params, local_model_path)
+        load_time = time.perf_counter() - start_time
+        
+        _set_model_readiness(model_id, "warming")
+        device = next(model.parameters()).device
+        dummy_inputs = tokenizer("warm up", return_tensors="pt")
+        dummy_inputs = {k: v.to(device) for k, v in dummy_inputs.items()}
+        # Same slot key as live text generation, so a warm-up never overlaps a request on the same model
+        with model_slot(cache_key), torch.no_grad():
+            model.generate(
+                **dummy_inputs,
+                max_new_tokens=2,
+                do_sample=False,
+                pad_token_id=tokenizer.pad_token_id if tokenizer.pad_token_id is not None else tokenizer.eos_token_id
+            )
+        warm_time = time.perf_counter() - start_time - load_time
+        _set_model_readiness(model_id, f"ready (load {load_time:.1f}s, warm-up {warm_time:.1f}s)")
+    except Exception as e:
+        _set_model_readiness(model_id, f"failed: {e}")
+        raise
+
+
+def start_model_warmup(model_ids: list, params: Dict[str, Any], memory_budget_mb: Optional[float] = None, max_workers: int = 2) -> dict:
+    """Start loading and warming up pipeline models in the background, within a memory budget.
+    
+    Returns immediately with a dict of model_id -> Future. Models that do not fit in the
+    remaining budget, or whose type has no resident cache, are marked as skipped. Entries are
+    model ids, "model_id=local_path" strings, or {"model_id", "local_model_path"} dicts, so the
+    warmed cache entry is the one later requests for that local path use.
+    """
+    global _warmup_executor, _warmup_reserved_mb
+    
     if not model_ids:
-        return True
+        return {}
     
-    print(f"Pre-loading {len(model_ids)} models into cache...", file=sys.stderr)
+    if memory_budget_mb is None:
+        memory_budget_mb = _default_warmup_budget_mb()
     
-    for model_id in model_ids:
+    with _warmup_state_lock:
+        if _warmup_executor is None:
+            _warmup_executor = ThreadPoolExecutor(max_workers=max(1, max_workers), thread_name_prefix="warmup")
+    
+    print(f"Warming up {len(model_ids)} model(s) in the background"
+          f"{f' (budget {memory_budget_mb:.0f} MB)' if memory_budget_mb else ''}...", file=sys.stderr)
+    
+    submitted = {}
+    for model_id, local_model_path in dict.fromkeys(_warmup_target(entry) for entry in model_ids):
+        cache_key = model_cache_key(model_id, local_model_path)
+        if model_id in _warmup_futures or cache_key in _model_cache:
+            submitted[model_id] = _warmup_futures.get(model_id)
+            continue
+        
+        # Only text-generation models have a resident cache to warm
+        model_type = detect_model_type(model_id)
+        if model_type != "text-generation":
+            _set_model_readiness(model_id, f"skipped: no resident cache for {model_type} models")
+            continue
+        
+        size_mb = estimate_model_size_mb(model_id, local_model_path)
+        with _warmup_state_lock:
+            if memory_budget_mb and _warmup_reserved_mb + size_mb > memory_budget_mb:
+                over_budget = True
+            else:
+                over_budget = False
+                _warmup_reserved_mb += size_mb
+        if over_budget:
+            _set_model_readiness(model_id, f"skipped: ~{size_mb:.0f} MB exceeds remaining warm-up budget")
+            continue
+        
+        _set_model_readiness(model_id, "queued")
+        future = _warmup_executor.submit(_warm_up_model, model_id, params, local_model_path)
+        _warmup_futures[model_id] = future
+        submitted[model_id] = future
+    
+    return submitted
+
+
+def _warmup_target(entry) -> tuple:
+    """(model_id, local_model_path) of a warm-up entry."""
+    if isinstance(entry, dict):
+        return entry.get("model_id"), entry.get("local_model_path") or None
+    model_id, _, local_model_path = str(entry).partition("=")
+    return model_id, local_model_path or None
+
+
+def stop_model_warmup():
+    """Cancel queued warm-ups; a load that is already running finishes without being waited for."""
+    with _warmup_state_lock:
+        executor = _warmup_executor
+    if executor is not None:
+        executor.shutdown(wait=False, cancel_futures=True)
+
+
+def get_warmup_report() -> Dict[str, str]:
+    """Return a snapshot of per-model warm-up readiness."""
+    with _warmup_state_lock:
+        return dict(_model_readiness)
+
+
+def clear_runtime_caches():
+    """Drop loaded models and all in-process caches (next inference starts cold; persisted indexes are kept)."""
+    global _frame_index
+    for name, cache in _resident_model_caches():
+        count_cache_event(name, "eviction", len(cache))
+        cache.clear()
+    for cache in (_tokenizer_cache, _embedding_indexes, _pixel_values_cache, _decoded_image_cache, _file_digest_cache, _dhash_cache, _processor_config_keys,
+                  _session_frames, _vision_embedding_cache, _node_output_cache, _context_window_cache, _section_token_cache,
+                  _draft_vocab_match_cache, _compiled_models, _prompt_stats, _onnx_failed_models, _onnx_unexported_models):
+        cache.clear()
+    with _frame_index_lock:
+        _frame_index = None
+    with _warmup_state_lock:
+        _model_readiness.clear()
+    import gc
+    gc.collect()
+
+
+def get_or_load_embedding_model(model_id: str, params: Dict[str, Any], local_model_path: Optional[str] = None) -> tuple:
+    """Get (model, processor) for embeddings from the resident cache, loading once.
+    
+    CLIP-style models (get_image_features) embed images and text into one space; other
+    encoders embed text by mean-pooling their last hidden state.
+    """
+    cache_key = local_model_path if local_model_path else model_id
+    cached = _embedding_model_cache.get(cache_key)
+    if cached is not None:
+        count_cache_event("embedding", "hit")
+        return cached
+    
+    with _get_model_load_lock(f"embedding:{cache_key}"):
+        cached = _embedding_model_cache.get(cache_key)
+        if cached is not None:
+            count_cache_event("embedding", "hit")
+            return cached
+        count_cache_event("embedding", "miss")
+        
+        from transformers import AutoModel, AutoProcessor, AutoTokenizer
+        
+        model_path_to_use, is_local_model = resolve_model_path(model_id, local_model_path)
+        print(f"Loading embedding model: {model_path_to_use}", file=sys.stderr)
+        model = AutoModel.from_pretrained(
+            model_path_to_use,
+            torch_dtype=select_model_dtype("embedding", True, params),
+            local_files_only=is_local_model
+        )
+        model.eval()
+        if hasattr(model, "get_image_features"):
+            processor = AutoProcessor.from_pretrained(model_path_to_use, local_files_only=is_local_model)
+        else:
+            processor = AutoTokenizer.from_pretrained(model_path_to_use, local_files_only=is_local_model)
+        
+        cached = (model, processor)
+        _embedding_model_cache[cache_key] = cached
+        return cached
+
+
+def _is_image_item(item: str) -> bool:
+    return item.lower().endswith(_image_extensions) and os.path.isfile(item)
+
+
+def _projected_features(output):
+    """Feature tensor from get_*_features (newer transformers return a model output holding it as pooler_output)."""
+    return output.pooler_output if hasattr(output, "pooler_output") else output
+
+
+def compute_embeddings(model_id: str, items: list, params: Dict[str, Any], local_model_path: Optional[str] = None):
+    """Embed items (image paths or text) in batches; returns a float32 NumPy array, one row per item."""
+    import numpy as np
+    
+    with inference_phase("model_load"):
+        model, processor = get_or_load_embedding_model(model_id, params, local_model_path)
+    multimodal = hasattr(model, "get_image_features")
+    image_items = [i for i, item in enumerate(items) if _is_image_item(item)]
+    text_items = [i for i, item in enumerate(items) if not _is_image_item(item)]
+    if image_items and not multimodal:
+        raise ValueError(f"{model_id} embeds text only; use a CLIP-style model for images")
+    
+    rows = [None] * len(items)
+    batch_size = get_tuned_setting("embedding", "batch_size", _embedding_batch_size)
+    with model_slot(f"embedding:{model_id}:{local_model_path}"), inference_phase("inference"), torch.no_grad():
+        for start in range(0, len(image_items), batch_size):
+            batch = image_items[start:start + batch_size]
+            pixel_values = torch.cat([get_pixel_values(items[i], processor, f"embedding:{model_id}:{local_model_path}") for i in batch])
+            features = _projected_features(model.get_image_features(pixel_values=pixel_values.to(model.device, dtype=model.dtype)))
+            for i, row in zip(batch, features.float().cpu().numpy()):
+                rows[i] = row
+        
+        tokenizer = getattr(processor, "tokenizer", processor)
+        # Some tokenizers report a huge sentinel model_max_length; cap at a typical encoder length
+        max_text_tokens = min(getattr(tokenizer, "model_max_length", 512) or 512, 512)
+        for start in range(0, len(text_items), batch_size):
+            batch = text_items[start:start + batch_size]
+            encoded = tokenizer([items[i] for i in batch], padding=True, truncation=True,
+                                max_length=max_text_tokens, return_tensors="pt").to(model.device)
+            if multimodal:
+                features = _projected_features(model.get_text_features(**encoded))
+            else:
+                hidden = model(**encoded).last_hidden_state
+                mask = encoded["attention_mask"].unsqueeze(-1).to(hidden.dtype)
+                features = (hidden * mask).sum(dim=1) / mask.sum(dim=1).clamp(min=1)
+            for i, row in zip(batch, features.float().cpu().numpy()):
+                rows[i] = row
+    return np.stack(rows)
+
+
+def get_embedding_index(index_path: str, dimension: Optional[int] = None, model_id: Optional[str] = None):
+    """Open (or create, when dimension is given) an embedding index, kept open for the process."""
+    from embedding_index import EmbeddingIndex
+    
+    if not os.path.isabs(index_path):
+        index_path = os.path.join(get_state_dir(), "EmbeddingIndexes", index_path)
+    with _embedding_indexes_lock:
+        index = _embedding_indexes.get(index_path)
+        if index is None:
+            index = EmbeddingIndex(index_path, dimension, model_id)
+            _embedding_indexes[index_path] = index
+        return index
+
+
+def run_embedding(model_id: str, input_text: str, params: Dict[str, Any], local_model_path: Optional[str] = None,
+                  items: Optional[list] = None, metadata: Optional[list] = None) -> str:
+    """Add items to, or search, an embedding index; returns a JSON result.
+    
+    Items are the input's non-empty lines (an existing image path or text each) unless given
+    explicitly. A search with several items uses the mean of their embeddings as the query.
+    """
+    try:
+        items = items if items is not None else [line.strip() for line in input_text.splitlines() if line.strip()]
+        if not items:
+            return "ERROR: No items to embed"
+        
+        embeddings = compute_embeddings(model_id, items, params, local_model_path)
+        index = get_embedding_index(params["embedding_index"], embeddings.shape[1], model_id)
+        
+        if params.get("embedding_action", "add") == "search":
+            from embedding_index import normalize_vectors
+            
+            query = normalize_vectors(embeddings).mean(axis=0)
+            results = []
+            for vector_id, score in index.search(query, params.get("top_k", 5)):
+                record = index.get_item(vector_id)
+                results.append({"id": vector_id, "score": round(score, 4), "item": record["item"],
+                                "metadata": record["metadata"], "added_at": record["added_at"]})
+            return json.dumps({"results": results}, ensure_ascii=False)
+        
+        ids = index.add(embeddings, items, metadata)
+        return json.dumps({"added": ids, "count": len(index)})
+    except ImportError as e:
+        return f"ERROR: Embedding index unavailable ({e}); embedding_index.py must be next to run_hf_model.py and NumPy installed"
+    except Exception as e:
+        print(f"Embedding error: {e}", file=sys.stderr)
+        return f"ERROR: Embedding failed: {e}"
+
+
+def enable_tracing():
+    """Start collecting tracing spans for this process."""
+    global _trace_events, _trace_origin
+    with _trace_lock:
+        _trace_events = []
+        _trace_origin = time.perf_counter()
+
+
+def _add_trace_span(name: str, start: float, end: float, category: str, args: Optional[dict] = None):
+    """Append a Chrome "complete" event for a span that ran from start to end (perf_counter values)."""
+    if _trace_events is None:
+        return
+    event = {
+        "name": name,
+        "cat": category,
+        "ph": "X",
+        "ts": round((start - _trace_origin) * 1e6, 1),
+        "dur": round((end - start) * 1e6, 1),
+        "pid": os.getpid(),
+        "tid": threading.get_ident()
+    }
+    if args:
+        event["args"] = args
+    with _trace_lock:
+        _trace_events.append(event)
+
+
+@contextmanager
+def trace_span(name: str, category: str = "span", **args):
+    """Tracing span around a block (no-op unless tracing is enabled)."""
+    if _trace_events is None:
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        _add_trace_span(name, start, time.perf_counter(), category, args)
+
+
+def write_chrome_trace(path: str):
+    """Write the collected spans as Chrome trace-event JSON (chrome://tracing, Perfetto)."""
+    with _trace_lock:
+        events = list(_trace_events or [])
+    thread_names = {thread.ident: thread.name for thread in threading.enumerate()}
+    metadata = [
+        {"name": "thread_name", "ph": "M", "pid": os.getpid(), "tid": tid, "args": {"name": thread_names.get(tid, str(tid))}}
+        for tid in dict.fromkeys(event["tid"] for event in events)
+    ]
+    with open(path, "w", encoding="utf-8") as trace_file:
+        json.dump({"traceEvents": metadata + events, "displayTimeUnit": "ms"}, trace_file)
+
+
+def format_trace_summary() -> str:
+    """Compact one-line summary: wall time covered by spans, then total ms per span name in first-seen order."""
+    with _trace_lock:
+        events = list(_trace_events or [])
+    if not events:
+        return "[trace] no spans recorded"
+    totals = {}
+    for event in events:
+        totals[event["name"]] = totals.get(event["name"], 0.0) + event["dur"] / 1000
+    wall_ms = (max(event["ts"] + event["dur"] for event in events) - min(event["ts"] for event in events)) / 1000
+    return f"[trace] wall={wall_ms:.0f}ms " + " ".join(f"{name}={elapsed:.1f}ms" for name, elapsed in totals.items())
+
+
+@contextmanager
+def inference_phase(name: str):
+    """Add the time spent in the block to the current inference's phase timings (no-op outside one)."""
+    start = time.perf_counter()
+    try:
+        if _profiling_active and torch is not None:
+            with torch.profiler.record_function(name):
+                yield
+        else:
+            yield
+    finally:
+        record_phase_time(name, start)
+
+
+def record_phase_time(name: str, start: float):
+    """Add the time since start (a time.perf_counter() value) to a phase of the current inference.
+    
+    Phases from items processed in parallel add up, like CPU time. Each phase is also a tracing span.
+    """
+    end = time.perf_counter()
+    _add_trace_span(name, start, end, "phase")
+    record = getattr(_inference_record_scope, "record", None)
+    if record is not None:
+        elapsed_ms = (end - start) * 1000
+        with _inference_record_lock:
+            record["timings_ms"][name] = record["timings_ms"].get(name, 0.0) + elapsed_ms
+
+
+def record_generated_tokens(count: int):
+    """Count tokens generated by the current inference."""
+    record = getattr(_inference_record_scope, "record", None)
+    if record is not None:
+        with _inference_record_lock:
+            record["tokens_generated"] = (record["tokens_generated"] or 0) + int(count)
+
+
+def _bind_inference_record(fn):
+    """Wrap fn so it records into the calling thread's inference record when run on another thread."""
+    record = getattr(_inference_record_scope, "record", None)
+    if record is None:
+        return fn
+    
+    def bound(*args):
+        previous = getattr(_inference_record_scope, "record", None)
+        _inference_record_scope.record = record
         try:
-            print(f"Loading {model_id}...", file=sys.stderr)
-            model, tokenizer = get_or_load_model(model_id, params)
-            print(f"✓ {model_id} loaded and cached", file=sys.stderr)
-        except Exception as e:
-            print(f"✗ Failed to preload {model_id}: {e}", file=sys.stderr)
-            return False
+            return fn(*args)
+        finally:
+            _inference_record_scope.record = previous
+    return bound
+
+
+def _observe_histogram(histograms: dict, key, buckets: tuple, value: float):
+    """Add a value to a cumulative-bucket histogram entry [bucket counts, sum, count] (caller holds _metrics_lock)."""
+    entry = histograms.get(key)
+    if entry is None:
+        entry = histograms[key] = [[0] * len(buckets), 0.0, 0]
+    for i, bound in enumerate(buckets):
+        if value <= bound:
+            entry[0][i] += 1
+    entry[1] += value
+    entry[2] += 1
+
+
+def observe_request(model_id: str, task: str, status: str, seconds: float):
+    """Count a finished inference and add its latency to the per-model histogram."""
+    with _metrics_lock:
+        key = (model_id, task, status)
+        _request_counts[key] = _request_counts.get(key, 0) + 1
+        _observe_histogram(_latency_histograms, (model_id, task), _latency_buckets_seconds, seconds)
+
+
+def observe_batch_size(size: int):
+    """Record how many items a batched/fanned-out inference call carried."""
+    with _metrics_lock:
+        _observe_histogram(_batch_size_histogram, "items", _batch_size_buckets, size)
+
+
+def count_cache_event(cache: str, event: str, count: int = 1):
+    """Count a cache hit, miss or eviction."""
+    if count:
+        with _metrics_lock:
+            key = (cache, event)
+            _cache_event_counts[key] = _cache_event_counts.get(key, 0) + count
+
+
+def get_rss_mb() -> Optional[float]:
+    """Current resident set size of this process in MB (None if it cannot be read)."""
+    try:
+        import psutil
+        return round(psutil.Process().memory_info().rss / (1024 * 1024), 1)
+    except ImportError:
+        pass
+    try:
+        with open("/proc/self/statm", "r") as statm:
+            return round(int(statm.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / (1024 * 1024), 1)
+    except (OSError, ValueError, AttributeError):
+        return None
+
+
+def _prometheus_labels(**labels) -> str:
+    """{name="value",...} with backslashes, quotes and newlines escaped."""
+    def escape(value) -> str:
+        return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+    return "{" + ",".join(f'{name}="{escape(value)}"' for name, value in labels.items()) + "}"
+
+
+def _format_histogram(lines: list, name: str, buckets: tuple, entry: list, **labels):
+    for bound, count in zip(buckets, entry[0]):
+        lines.append(f"{name}_bucket{_prometheus_labels(**labels, le=bound)} {count}")
+    lines.append(f"{name}_bucket{_prometheus_labels(**labels, le='+Inf')} {entry[2]}")
+    lines.append(f"{name}_sum{_prometheus_labels(**labels) if labels else ''} {entry[1]:.6f}")
+    lines.append(f"{name}_count{_prometheus_labels(**labels) if labels else ''} {entry[2]}")
+
+
+def format_prometheus_metrics() -> str:
+    """Prometheus text exposition (format 0.0.4) of request, latency, queue, batch, cache, memory and thread metrics."""
+    with _metrics_lock:
+        request_counts = dict(_request_counts)
+        latency_histograms = {key: [list(entry[0]), entry[1], entry[2]] for key, entry in _latency_histograms.items()}
+        batch_entry = _batch_size_histogram.get("items")
+        cache_events = dict(_cache_event_counts)
+        queue_state = dict(_worker_queue_state)
+    with _vision_embedding_lock:
+        for event, count in _vision_embedding_stats.items():
+            cache_events[("vision_embedding", {"hits": "hit", "misses": "miss", "evictions": "eviction"}[event])] = count
     
-    print(f"✓ All {len(model_ids)} models pre-loaded successfully", file=sys.stderr)
-    return True
+    lines = ["# HELP csimple_requests_total Inferences handled, by model, task and status.",
+             "# TYPE csimple_requests_total counter"]
+    for (model_id, task, status), count in sorted(request_counts.items()):
+        lines.append(f"csimple_requests_total{_prometheus_labels(model=model_id, task=task, status=status)} {count}")
+    
+    lines += ["# HELP csimple_request_latency_seconds End-to-end inference latency.",
+              "# TYPE csimple_request_latency_seconds histogram"]
+    for (model_id, task), entry in sorted(latency_histograms.items()):
+        _format_histogram(lines, "csimple_request_latency_seconds", _latency_buckets_seconds, entry, model=model_id, task=task)
+    
+    lines += ["# HELP csimple_batch_size Items per batched or fanned-out inference call.",
+              "# TYPE csimple_batch_size histogram"]
+    if batch_entry:
+        _format_histogram(lines, "csimple_batch_size", _batch_size_buckets, batch_entry)
+    
+    lines += ["# HELP csimple_queue_depth Work waiting or running, by queue.",
+              "# TYPE csimple_queue_depth gauge",
+              f'csimple_queue_depth{{queue="worker_requests_queued"}} {queue_state["queued"]}',
+              f'csimple_queue_depth{{queue="worker_requests_in_flight"}} {queue_state["in_flight"]}',
+              f'csimple_queue_depth{{queue="inference_scheduler"}} {queue_state["scheduler"]}']
+    
+    lines += ["# HELP csimple_cache_events_total Cache hits, misses and evictions, by cache.",
+              "# TYPE csimple_cache_events_total counter"]
+    for (cache, event), count in sorted(cache_events.items()):
+        lines.append(f"csimple_cache_events_total{_prometheus_labels(cache=cache, event=event)} {count}")
+    
+    lines += ["# HELP csimple_cache_entries Entries currently held, by cache.",
+              "# TYPE csimple_cache_entries gauge"]
+    for cache, entries in _resident_model_caches() + (("pixel_values", _pixel_values_cache), ("vision_embedding", _vision_embedding_cache),
+                                                      ("node_output", _node_output_cache)):
+        lines.append(f'csimple_cache_entries{{cache="{cache}"}} {len(entries)}')
+    
+    rss_mb = get_rss_mb()
+    peak_rss_mb = get_peak_memory_mb()["peak_rss_mb"]
+    if peak_rss_mb is not None and rss_mb is not None:
+        peak_rss_mb = max(peak_rss_mb, rss_mb)
+    lines += ["# HELP csimple_resident_memory_bytes Resident set size of the process.",
+              "# TYPE csimple_resident_memory_bytes gauge"]
+    if rss_mb is not None:
+        lines.append(f"csimple_resident_memory_bytes {int(rss_mb * 1024 * 1024)}")
+    lines += ["# HELP csimple_peak_resident_memory_bytes Peak resident set size of the process.",
+              "# TYPE csimple_peak_resident_memory_bytes gauge"]
+    if peak_rss_mb is not None:
+        lines.append(f"csimple_peak_resident_memory_bytes {int(peak_rss_mb * 1024 * 1024)}")
+    
+    allocation = get_thread_allocation()
+    lines += ["# HELP csimple_threads Configured inference workers and torch thread counts.",
+              "# TYPE csimple_threads gauge",
+              f'csimple_threads{{kind="inference_workers"}} {allocation["workers"]}',
+              f'csimple_threads{{kind="intra_op_concurrent"}} {allocation["intra_op_threads"]}']
+    if torch is not None:
+        lines.append(f'csimple_threads{{kind="torch_intra_op"}} {torch.get_num_threads()}')
+        lines.append(f'csimple_threads{{kind="torch_inter_op"}} {torch.get_num_interop_threads()}')
+    return "\n".join(lines) + "\n"
+
+
+def start_metrics_server(port: int):
+    """Serve format_prometheus_metrics() at http://127.0.0.1:<port>/metrics on a daemon thread."""
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+    
+    class MetricsHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.split("?")[0] not in ("/metrics", "/"):
+                self.send_error(404)
+                return
+            body = format_prometheus_metrics().encode("utf-8")
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+        
+        def log_message(self, format, *args):
+            pass
+    
+    server = ThreadingHTTPServer(("127.0.0.1", port), MetricsHandler)
+    threading.Thread(target=server.serve_forever, name="metrics-http", daemon=True).start()
+    print(f"Metrics at http://127.0.0.1:{server.server_address[1]}/metrics", file=sys.stderr)
+    return server
+
+
+def start_metrics_file_writer(path: str, interval: float):
+    """Rewrite the metrics file every interval seconds on a daemon thread (atomic replace)."""
+    def write_periodically():
+        while True:
+            try:
+                with open(path + ".tmp", "w", encoding="utf-8") as metrics_file:
+                    metrics_file.write(format_prometheus_metrics())
+                os.replace(path + ".tmp", path)
+            except OSError as e:
+                print(f"Could not write metrics to {path}: {e}", file=sys.stderr)
+            time.sleep(max(interval, 1.0))
+    
+    threading.Thread(target=write_periodically, name="metrics-file", daemon=True).start()
+
+
+def classify_error(message: str) -> str:
+    """Coarse error class for an "ERROR: ..." runner message."""
+    lowered = message.lower()
+    for error_class, fragments in _error_classes:
+        if any(fragment in lowered for fragment in fragments):
+            return error_class
+    return "inference"
+
+
+def _approximate_bytes(value, depth: int = 0) -> int:
+    """Payload bytes held by a cache entry: tensors, arrays, PIL images, strings and containers of them."""
+    if depth > 4 or value is None:
+        return 0
+    if torch is not None and isinstance(value, torch.Tensor):
+        return value.element_size() * value.nelement()
+    if hasattr(value, "nbytes") and isinstance(getattr(value, "nbytes"), int):
+        return value.nbytes
+    if hasattr(value, "getbands") and hasattr(value, "size"):
+        return value.size[0] * value.size[1] * len(value.getbands())
+    if isinstance(value, (str, bytes)):
+        return len(value)
+    if isinstance(value, dict):
+        return sum(_approximate_bytes(item, depth + 1) for item in value.values())
+    if isinstance(value, (list, tuple)):
+        return sum(_approximate_bytes(item, depth + 1) for item in value)
+    if hasattr(value, "items") and callable(value.items):
+        return sum(_approximate_bytes(item, depth + 1) for _, item in value.items())
+    return sys.getsizeof(value)
+
+
+def estimate_kv_cache_bytes(model) -> Optional[Dict[str, int]]:
+    """Key/value cache size of a generative model per token and at its full context window (None if not generative)."""
+    can_generate = getattr(model, "can_generate", None)
+    if not callable(can_generate) or not can_generate():
+        return None
+    config = model.config.get_text_config() if hasattr(model.config, "get_text_config") else model.config
+    layers = getattr(config, "decoder_layers", None) or getattr(config, "num_hidden_layers", None) or getattr(config, "n_layer", None)
+    heads = getattr(config, "num_attention_heads", None) or getattr(config, "decoder_attention_heads", None) or getattr(config, "n_head", None)
+    hidden_size = getattr(config, "hidden_size", None) or getattr(config, "d_model", None) or getattr(config, "n_embd", None)
+    if not (layers and heads and hidden_size):
+        return None
+    kv_heads = getattr(config, "num_key_value_heads", None) or heads
+    head_dim = getattr(config, "head_dim", None) or hidden_size // heads
+    element_size = next(model.parameters()).element_size()
+    per_token = 2 * layers * kv_heads * head_dim * element_size
+    context = getattr(config, "max_position_embeddings", None) or getattr(config, "n_positions", None) or _fallback_context_window
+    return {"bytes_per_token": per_token, "bytes_at_context": per_token * context, "context_tokens": context}
+
+
+def get_model_memory(model) -> Dict[str, Any]:
+    """Parameter and buffer bytes of a resident model, plus its KV-cache footprint when it generates."""
+    parameter_bytes = sum(p.element_size() * p.nelement() for p in model.parameters())
+    buffer_bytes = sum(b.element_size() * b.nelement() for b in model.buffers())
+    first_parameter = next(model.parameters(), None)
+    return {
+        "parameter_bytes": parameter_bytes,
+        "buffer_bytes": buffer_bytes,
+        "dtype": str(first_parameter.dtype).replace("torch.", "") if first_parameter is not None else None,
+        "device": str(first_parameter.device) if first_parameter is not None else None,
+        "kv_cache": estimate_kv_cache_bytes(model)
+    }
+
+
+def _resident_model_caches() -> tuple:
+    """(metrics name, cache) of every cache holding loaded models."""
+    return (("model", _model_cache), ("vision_language", _vision_model_cache), ("captioning", _captioning_model_cache),
+            ("speech", _speech_pipeline_cache), ("onnx", _onnx_model_cache), ("embedding", _embedding_model_cache))
+
+
+def _resident_caches() -> Dict[str, Any]:
+    """In-process caches that can hold images, audio arrays, tensors or text between requests."""
+    return {
+        "pixel_values": _pixel_values_cache, "decoded_image": _decoded_image_cache, "vision_embedding": _vision_embedding_cache,
+        "session_frames": _session_frames, "node_output": _node_output_cache, "section_tokens": _section_token_cache,
+        "dhash": _dhash_cache, "file_digest": _file_digest_cache
+    }
+
+
+def _cache_entry_counts() -> Dict[str, int]:
+    counts = {name: len(cache) for name, cache in _resident_model_caches()}
+    counts.update({name: len(cache) for name, cache in _resident_caches().items()})
+    return counts
+
+
+def start_memory_tracking(trace_allocations: bool = True):
+    """Take the memory baseline later reports are compared with, tracing Python allocations (tracemalloc) if asked."""
+    global _memory_baseline
+    import gc
+    import tracemalloc
+    if trace_allocations and not tracemalloc.is_tracing():
+        tracemalloc.start(_tracemalloc_frames)
+    gc.collect()
+    _memory_baseline = {
+        "rss_mb": get_rss_mb(),
+        "snapshot": tracemalloc.take_snapshot() if tracemalloc.is_tracing() else None,
+        "taken_at": time.time()
+    }
+
+
+@contextmanager
+def track_request_memory(request_id, command: str):
+    """Record the RSS (and traced Python heap) delta of one worker request in the memory log.
+    
+    A request is flagged when memory stays above its starting point by more than
+    _memory_retained_threshold_mb after it finishes and it did not load a model; the log lists
+    cache entries added meanwhile so retained images, audio or outputs can be told from leaks.
+    Requests running at the same time share the process, so their deltas overlap.
+    """
+    import tracemalloc
+    tracing = tracemalloc.is_tracing()
+    with _metrics_lock:
+        concurrent = _worker_queue_state["in_flight"] - 1
+    caches_before = _cache_entry_counts()
+    rss_before = get_rss_mb()
+    heap_before = tracemalloc.get_traced_memory()[0] if tracing else None
+    try:
+        yield
+    finally:
+        if tracing:
+            import gc
+            gc.collect()
+        rss_after = get_rss_mb()
+        caches_after = _cache_entry_counts()
+        entry = {
+            "id": request_id,
+            "command": command,
+            "finished_at": time.time(),
+            "concurrent_requests": concurrent,
+            "rss_before_mb": rss_before,
+            "rss_after_mb": rss_after,
+            "rss_delta_mb": round(rss_after - rss_before, 1) if rss_before is not None and rss_after is not None else None,
+            "cache_entries_added": {name: caches_after[name] - count for name, count in caches_before.items() if caches_after[name] != count}
+        }
+        retained_mb = entry["rss_delta_mb"] or 0.0
+        if tracing and heap_before is not None:
+            entry["python_heap_delta_mb"] = round((tracemalloc.get_traced_memory()[0] - heap_before) / (1024 * 1024), 2)
+            retained_mb = max(retained_mb, entry["python_heap_delta_mb"])
+        entry["retained_mb"] = round(retained_mb, 2)
+        # Loading a model is expected growth; anything else that stays is a retention candidate
+        loaded_model = any(name in entry["cache_entries_added"] for name, _ in _resident_model_caches())
+        entry["flagged"] = retained_mb > _memory_retained_threshold_mb and not loaded_model
+        with _memory_log_lock:
+            _memory_request_log.append(entry)
+
+
+def get_memory_report(top: int = 10) -> Dict[str, Any]:
+    """Memory introspection for the worker "memory" command.
+    
+    Resident models (parameter/buffer bytes, KV-cache footprint), payload bytes held by each
+    in-process cache, process RSS against the tracking baseline, the largest Python heap
+    growth since the baseline by allocation site (when tracemalloc is tracing), and the
+    per-request log with requests whose memory did not return to baseline flagged.
+    """
+    import tracemalloc
+    models = []
+    for cache_name, cache in _resident_model_caches():
+        for key, cached in list(cache.items()):
+            # Cached as the model, a (model, processor, ...) tuple, or a pipeline holding the model
+            model = cached[0] if isinstance(cached, tuple) else getattr(cached, "model", cached)
+            if hasattr(model, "parameters"):
+                models.append({"cache": cache_name, "key": key, **get_model_memory(model)})
+    caches = {name: {"entries": len(cache), "bytes": _approximate_bytes(dict(cache))} for name, cache in _resident_caches().items()}
+    
+    rss_mb = get_rss_mb()
+    report = {
+        "rss_mb": rss_mb,
+        "baseline_rss_mb": _memory_baseline["rss_mb"] if _memory_baseline else None,
+        "models": models,
+        "model_bytes": sum(model["parameter_bytes"] + model["buffer_bytes"] for model in models),
+        "caches": caches,
+        "python_heap": {"tracing": tracemalloc.is_tracing()}
+    }
+    report.update(get_peak_memory_mb())
+    if tracemalloc.is_tracing():
+        current, peak = tracemalloc.get_traced_memory()
+        report["python_heap"].update({"current_mb": round(current / (1024 * 1024), 1), "peak_mb": round(peak / (1024 * 1024), 1)})
+        if _memory_baseline and _memory_baseline["snapshot"] is not None:
+            growth = tracemalloc.take_snapshot().compare_to(_memory_baseline["snapshot"], "lineno")
+            report["python_heap"]["top_growth"] = [
+                {"location": str(stat.traceback), "size_delta_kb": round(stat.size_diff / 1024, 1), "count_delta": stat.count_diff}
+                for stat in growth[:top] if stat.size_diff > 0
+            ]
+    with _memory_log_lock:
+        requests = list(_memory_request_log)
+    report["requests"] = requests[-top:]
+    report["flagged_requests"] = [entry for entry in requests if entry["flagged"]]
+    return report
+
+
+def get_peak_memory_mb() -> Dict[str, Any]:
+    """Peak resident memory of this process (and peak CUDA allocation when a GPU is in use), in MB."""
+    peak = {"peak_rss_mb": None}
+    try:
+        import resource
+        max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        # ru_maxrss is in kilobytes on Linux and bytes on macOS
+        peak["peak_rss_mb"] = round(max_rss / (1024 * 1024 if sys.platform == "darwin" else 1024), 1)
+    except ImportError:
+        try:
+            import psutil
+            memory_info = psutil.Process().memory_info()
+            peak["peak_rss_mb"] = round(getattr(memory_info, "peak_wset", memory_info.rss) / (1024 * 1024), 1)
+        except ImportError:
+            pass
+    if torch is not None and torch.cuda.is_available():
+        peak["peak_gpu_mb"] = round(torch.cuda.max_memory_allocated() / (1024 * 1024), 1)
+    return peak
+
+
+def _sample_peak_rss(stop_event: threading.Event, peak: dict, interval: float):
+    """Keep the highest resident set size seen in peak["rss_mb"] until stop_event is set."""
+    while not stop_event.wait(interval):
+        rss_mb = get_rss_mb()
+        if rss_mb is not None and (peak["rss_mb"] is None or rss_mb > peak["rss_mb"]):
+            peak["rss_mb"] = rss_mb
+
+
+def run_model_with_envelope(model_id: str, input_text: str, params: Dict[str, Any], local_model_path: Optional[str] = None) -> Dict[str, Any]:
+    """Run one inference and return its result envelope.
+    
+    {"status", "output" | "error" + "error_class"[, "exception_type"], "model_type", "timings_ms": {model_load,
+    preprocess, inference, total}, "tokens_generated", "rss_mb", "rss_delta_mb", "peak_rss_mb"[, "peak_gpu_mb"]}.
+    Phases a runner does not go through are absent; a cached model shows a near-zero model_load. Memory is
+    measured for this request: resident memory after it, its change over the request, the highest resident
+    memory sampled every _peak_rss_sample_interval while it ran, and the CUDA allocation peak since it started
+    (requests running at the same time share the process, so their figures overlap). Errors are classified
+    by classify_error whether a runner returned them or raised; a raised exception also names its type.
+    """
+    record = {"timings_ms": {}, "tokens_generated": None}
+    previous = getattr(_inference_record_scope, "record", None)
+    _inference_record_scope.record = record
+    rss_before = get_rss_mb()
+    track_gpu = torch is not None and torch.cuda.is_available()
+    if track_gpu:
+        torch.cuda.reset_peak_memory_stats()
+    # Short-lived buffers (activations, decoded images) are freed before the request ends, so sample the peak while it runs
+    peak_rss = {"rss_mb": rss_before}
+    stop_sampling = threading.Event()
+    sampler = threading.Thread(target=_sample_peak_rss, args=(stop_sampling, peak_rss, _peak_rss_sample_interval),
+                               name="peak-rss-sampler", daemon=True)
+    sampler.start()
+    start = time.perf_counter()
+    exception_type = None
+    try:
+        with trace_span("run_model", "request", model_id=model_id):
+            result = run_model(model_id, input_text, params, local_model_path)
+    except Exception as e:
+        result = f"ERROR: {e}"
+        exception_type = type(e).__name__
+    finally:
+        _inference_record_scope.record = previous
+        stop_sampling.set()
+        sampler.join()
+    total_ms = (time.perf_counter() - start) * 1000
+    
+    envelope = build_result_envelope(result.strip() if result else "No output generated")
+    if envelope["status"] == "error":
+        if exception_type:
+            envelope["error_class"] = classify_error(f"{exception_type}: {envelope['error']}")
+            envelope["exception_type"] = exception_type
+        else:
+            envelope["error_class"] = classify_error(envelope["error"])
+    envelope["model_type"] = "embedding" if params.get("embedding_index") else detect_model_type(model_id)
+    observe_request(model_id, envelope["model_type"], envelope["status"], total_ms / 1000)
+    timings = {name: round(elapsed, 1) for name, elapsed in record["timings_ms"].items()}
+    timings["total"] = round(total_ms, 1)
+    envelope["timings_ms"] = timings
+    envelope["tokens_generated"] = record["tokens_generated"]
+    rss_after = get_rss_mb()
+    envelope["rss_mb"] = rss_after
+    envelope["rss_delta_mb"] = round(rss_after - rss_before, 1) if rss_before is not None and rss_after is not None else None
+    samples = [rss for rss in (peak_rss["rss_mb"], rss_after) if rss is not None]
+    envelope["peak_rss_mb"] = max(samples) if samples else None
+    if track_gpu or (torch is not None and torch.cuda.is_available()):
+        envelope["peak_gpu_mb"] = round(torch.cuda.max_memory_allocated() / (1024 * 1024), 1)
+    return envelope
+
+
+def _sample_stacks(stop_event: threading.Event, counts: dict, interval: float):
+    """Count collapsed Python stacks of every busy thread until stop_event is set."""
+    own_ident = threading.get_ident()
+    while not stop_event.wait(interval):
+        thread_names = {thread.ident: thread.name for thread in threading.enumerate()}
+        for ident, frame in sys._current_frames().items():
+            if ident == own_ident or os.path.basename(frame.f_code.co_filename) in _profile_idle_files:
+                continue
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+                frame = frame.f_back
+            stack.append(thread_names.get(ident, str(ident)))
+            key = ";".join(reversed(stack))
+            counts[key] = counts.get(key, 0) + 1
+
+
+def _profile_category(filename: str, function_name: str) -> str:
+    for category, file_fragments, function_fragments in _profile_categories:
+        if any(fragment in filename for fragment in file_fragments) or any(fragment in function_name for fragment in function_fragments):
+            return category
+    return "other"
+
+
+def summarize_python_profile(stats) -> Dict[str, float]:
+    """Self time in ms per hot-path category (regex input parsing, tokenizer/processor, model kernels, ...)."""
+    totals = {}
+    for (filename, _, function_name), (_, _, self_time, _, _) in stats.stats.items():
+        category = _profile_category(filename, function_name)
+        totals[category] = totals.get(category, 0.0) + self_time * 1000
+    return {category: round(elapsed, 1) for category, elapsed in sorted(totals.items(), key=lambda item: -item[1])}
+
+
+def profile_model_runs(model_id: str, input_text: str, params: Dict[str, Any], local_model_path: Optional[str] = None,
+                       runs: int = 1, output_dir: Optional[str] = None) -> Dict[str, Any]:
+    """Run one inference `runs` times under torch.profiler, cProfile and a stack sampler.
+    
+    Writes to output_dir: torch_operators.txt (operator hotspots, self CPU time), python_hotspots.txt
+    (cProfile, by self and cumulative time), python.prof (pstats dump for snakeviz and friends) and
+    stacks.folded (collapsed stacks of all busy threads for flamegraph.pl or speedscope). cProfile only
+    sees the calling thread; the sampler and torch.profiler also cover scheduler worker threads.
+    The first run includes model loading unless the model is already resident.
+    Returns the last run's envelope with a "profile" summary added.
+    """
+    global _profiling_active
+    import cProfile
+    import io
+    import pstats
+    
+    runs = max(1, runs)
+    if output_dir is None:
+        safe_model_id = re.sub(r'[^A-Za-z0-9_.-]+', '_', model_id or "model")
+        output_dir = os.path.join(get_state_dir(), "Profiles", f"{time.strftime('%Y%m%d-%H%M%S')}-{safe_model_id}")
+    os.makedirs(output_dir, exist_ok=True)
+    
+    activities = [torch.profiler.ProfilerActivity.CPU]
+    if torch.cuda.is_available():
+        activities.append(torch.profiler.ProfilerActivity.CUDA)
+    stack_counts = {}
+    stop_sampling = threading.Event()
+    sampler = threading.Thread(target=_sample_stacks, args=(stop_sampling, stack_counts, _profile_sample_interval),
+                               name="profile-sampler", daemon=True)
+    python_profiler = cProfile.Profile()
+    run_times_ms = []
+    
+    _profiling_active = True
+    sampler.start()
+    try:
+        with torch.profiler.profile(activities=activities, record_shapes=True) as torch_profiler:
+            for run_index in range(runs):
+                start = time.perf_counter()
+                with torch.profiler.record_function(f"run_{run_index}"):
+                    python_profiler.enable()
+                    try:
+                        envelope = run_model_with_envelope(model_id, input_text, params, local_model_path)
+                    finally:
+                        python_profiler.disable()
+                run_times_ms.append(round((time.perf_counter() - start) * 1000, 1))
+    finally:
+        _profiling_active = False
+        stop_sampling.set()
+        sampler.join()
+    
+    sort_key = "self_cuda_time_total" if len(activities) > 1 else "self_cpu_time_total"
+    operator_averages = torch_profiler.key_averages()
+    with open(os.path.join(output_dir, "torch_operators.txt"), "w", encoding="utf-8") as operators_file:
+        operators_file.write(operator_averages.table(sort_by=sort_key, row_limit=40))
+        operators_file.write("\n\nGrouped by input shape:\n")
+        operators_file.write(torch_profiler.key_averages(group_by_input_shape=True).table(sort_by=sort_key, row_limit=40))
+    
+    python_profiler.dump_stats(os.path.join(output_dir, "python.prof"))
+    report = io.StringIO()
+    stats = pstats.Stats(python_profiler, stream=report)
+    report.write("By self time:\n")
+    stats.sort_stats("tottime").print_stats(40)
+    report.write("\nBy cumulative time:\n")
+    stats.sort_stats("cumulative").print_stats(40)
+    with open(os.path.join(output_dir, "python_hotspots.txt"), "w", encoding="utf-8") as hotspots_file:
+        hotspots_file.write(report.getvalue())
+    
+    with open(os.path.join(output_dir, "stacks.folded"), "w", encoding="utf-8") as stacks_file:
+        for stack, count in sorted(stack_counts.items()):
+            stacks_file.write(f"{stack} {count}\n")
+    
+    # Phase and run ranges are in the table; the summary lists real operators (aten::, prims::, ...)
+    operators = [event for event in operator_averages if "::" in event.key]
+    top_operators = sorted(operators, key=lambda event: -event.self_cpu_time_total)[:10]
+    envelope["profile"] = {
+        "output_dir": output_dir,
+        "runs": runs,
+        "run_times_ms": run_times_ms,
+        "python_self_time_ms": summarize_python_profile(stats),
+        "top_operators_ms": {event.key: round(event.self_cpu_time_total / 1000, 2) for event in top_operators},
+        "stack_samples": sum(stack_counts.values())
+    }
+    return envelope
+
+
+def format_profile_summary(profile: Dict[str, Any]) -> str:
+    """Short stderr report of a profile_model_runs summary."""
+    lines = [f"[profile] {profile['runs']} run(s): " + ", ".join(f"{elapsed:.0f}ms" for elapsed in profile["run_times_ms"]),
+             "[profile] python self time: " + " ".join(f"{category}={elapsed:.0f}ms" for category, elapsed in profile["python_self_time_ms"].items()),
+             "[profile] top operators: " + " ".join(f"{name}={elapsed:.1f}ms" for name, elapsed in profile["top_operators_ms"].items()),
+             f"[profile] reports in {profile['output_dir']}"]
+    return "\n".join(lines)
+
+
+def run_model(model_id: str, input_text: str, params: Dict[str, Any], local_model_path: Optional[str] = None) -> str:
+    """Dispatch a single inference to the runner for the model's type."""
+    if params.get("embedding_index"):
+        return run_embedding(model_id, input_text, params, local_model_path)
+    model_type = detect_model_type(model_id)
+    runner = _model_runners.get(model_type)
+    if runner is None:
+        # Fast fallback for unknown types
+        return f"Model type '{model_type}' not fully implemented yet. Basic response: Processed '{input_text}' with {model_id}"
+    return runner(model_id, input_text, params, local_model_path)
+
+
+def _input_file_signature(input_text: str) -> list:
+    """(path, mtime, size) of files referenced in an input, so memoized outputs notice file changes."""
+    signature = []
+    for path in dict.fromkeys(match.strip() for match in _input_file_pattern.findall(input_text)):
+        try:
+            stat = os.stat(path)
+            signature.append((path, stat.st_mtime_ns, stat.st_size))
+        except OSError:
+            signature.append((path, None, None))
+    return signature
+
+
+def _node_memo_key(model_id: str, local_model_path: Optional[str], input_text: str, params: Dict[str, Any]) -> str:
+    """Hash identifying a node invocation: model, input, referenced file state and parameters."""
+    payload = json.dumps(
+        [model_id, local_model_path, input_text, _input_file_signature(input_text), params],
+        sort_keys=True, default=str
+    )
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+def _combine_node_inputs(node: dict, upstream: list) -> str:
+    """Build a node's input from its static input and upstream outputs, like the C# ensemble concatenation.
+    
+    File outputs (image/audio paths) are passed through as-is and comma separated; text outputs are
+    prefixed with the upstream node's name and separated by blank lines.
+    """
+    file_parts = []
+    text_parts = []
+    static_input = node.get("input")
+    if static_input:
+        text_parts.append(str(static_input))
+    for upstream_node, output in upstream:
+        if not output:
+            continue
+        if _input_file_pattern.fullmatch(output.strip()):
+            file_parts.append(output.strip())
+        elif len(upstream) == 1 and not static_input:
+            text_parts.append(output)
+        else:
+            text_parts.append(f"{upstream_node.get('name', upstream_node['id'])}: {output}")
+    
+    combined = ", ".join(file_parts)
+    if text_parts:
+        combined = f"{combined}, " + "\n\n".join(text_parts) if combined else "\n\n".join(text_parts)
+    return combined
+
+
+def _run_pipeline_node(node: dict, input_text: str, params: Dict[str, Any]) -> tuple:
+    """Run one model node, reusing a memoized output when nothing it depends on changed.
+    
+    Returns (output, memoized, metrics) where metrics are the envelope timings of a fresh run.
+    """
+    node_params = dict(params)
+    node_params.update(node.get("params") or {})
+    model_id = node["model_id"]
+    local_model_path = node.get("local_model_path")
+    
+    memo_key = _node_memo_key(model_id, local_model_path, input_text, node_params)
+    with _node_output_cache_lock:
+        if memo_key in _node_output_cache:
+            _node_output_cache.move_to_end(memo_key)
+            count_cache_event("node_output", "hit")
+            return _node_output_cache[memo_key], True, None
+    count_cache_event("node_output", "miss")
+    
+    envelope = run_model_with_envelope(model_id, input_text, node_params, local_model_path)
+    output = envelope["output"] if envelope["status"] == "ok" else f"ERROR: {envelope['error']}"
+    metrics = {key: value for key, value in envelope.items() if key not in ("status", "output", "error")}
+    
+    # Failures are not memoized so the next tick retries them
+    if output and not output.startswith("ERROR:"):
+        with _node_output_cache_lock:
+            _node_output_cache[memo_key] = output
+            while len(_node_output_cache) > _node_output_cache_size:
+                _node_output_cache.popitem(last=False)
+                count_cache_event("node_output", "eviction")
+    return output, False, metrics
+
+
+def load_pipeline_spec(pipeline_arg) -> dict:
+    """Load a pipeline graph given as a dict, inline JSON or a JSON file path."""
+    if isinstance(pipeline_arg, dict):
+        return pipeline_arg
+    if os.path.isfile(pipeline_arg):
+        with open(pipeline_arg, "r", encoding="utf-8") as pipeline_file:
+            return json.load(pipeline_file)
+    return json.loads(pipeline_arg)
+
+
+def execute_pipeline(pipeline: dict, params: Dict[str, Any], max_workers: Optional[int] = None) -> Dict[str, Any]:
+    """Execute a pipeline graph in this process, running independent branches concurrently.
+    
+    The graph has "nodes" (each with an "id" and either a "model_id", or a static "input" for
+    file/input nodes) and "edges" ({"from": id, "to": id}). Intermediate outputs stay in memory
+    and model nodes whose inputs did not change reuse their memoized output.
+    """
+    nodes = {node["id"]: node for node in pipeline.get("nodes", [])}
+    dependencies = {node_id: [] for node_id in nodes}
+    dependents = {node_id: [] for node_id in nodes}
+    for edge in pipeline.get("edges", []):
+        source, target = edge["from"], edge["to"]
+        if source not in nodes or target not in nodes:
+            raise ValueError(f"Pipeline edge references unknown node: {source} -> {target}")
+        dependencies[target].append(source)
+        dependents[source].append(target)
+    
+    outputs = {}
+    errors = {}
+    memoized = []
+    metrics = {}
+    remaining = {node_id: len(deps) for node_id, deps in dependencies.items()}
+    ready = [node_id for node_id, count in remaining.items() if count == 0]
+    running = {}
+    
+    def complete(node_id: str, output: str):
+        outputs[node_id] = output
+        if output.startswith("ERROR:"):
+            errors[node_id] = output
+        for dependent in dependents[node_id]:
+            remaining[dependent] -= 1
+            if remaining[dependent] == 0:
+                ready.append(dependent)
+    
+    # Nodes get their own pool so they can fan out per-item work to the inference scheduler without deadlocking
+    max_workers = max_workers or get_thread_allocation()["workers"]
+    with ThreadPoolExecutor(max_workers=max(1, max_workers), thread_name_prefix="pipeline") as executor:
+        while ready or running:
+            while ready:
+                node_id = ready.pop(0)
+                node = nodes[node_id]
+                upstream = [(nodes[dep], outputs.get(dep, "")) for dep in dependencies[node_id]]
+                failed_upstream = [dep for dep in dependencies[node_id] if dep in errors]
+                if failed_upstream:
+                    complete(node_id, f"ERROR: Skipped because upstream node(s) failed: {', '.join(failed_upstream)}")
+                elif not node.get("model_id"):
+                    # Input/file nodes just provide their value
+                    complete(node_id, _combine_node_inputs(node, upstream))
+                else:
+                    node_input = _combine_node_inputs(node, upstream)
+                    running[executor.submit(_run_pipeline_node, node, node_input, params)] = node_id
+                    if len(running) > 1:
+                        apply_thread_split()
+            
+            if not running:
+                break
+            done, _ = wait_futures(list(running), return_when=FIRST_COMPLETED)
+            for future in done:
+                node_id = running.pop(future)
+                try:
+                    output, was_memoized, node_metrics = future.result()
+                    if was_memoized:
+                        memoized.append(node_id)
+                    else:
+                        metrics[node_id] = node_metrics
+                except Exception as e:
+                    output = f"ERROR: {e}"
+                complete(node_id, output)
+    
+    unexecuted = [node_id for node_id in nodes if node_id not in outputs]
+    if unexecuted:
+        raise ValueError(f"Pipeline graph has a cycle involving: {', '.join(unexecuted)}")
+    
+    return {
+        "status": "error" if errors else "ok",
+        "outputs": outputs,
+        "errors": errors,
+        "memoized": memoized,
+        "metrics": metrics
+    }
+
+
+def enable_request_recording(path: str):
+    """Append every inference request this process receives to a JSONL recording (see record_request)."""
+    global _request_record_path
+    os.makedirs(path + ".files", exist_ok=True)
+    _request_record_path = path
+
+
+def _referenced_files(value) -> list:
+    """Screenshot and audio paths mentioned anywhere in a request (inputs, pipeline node inputs, items)."""
+    if isinstance(value, str):
+        return [match.strip() for match in _input_file_pattern.findall(value)]
+    if isinstance(value, dict):
+        return [path for item in value.values() for path in _referenced_files(item)]
+    if isinstance(value, list):
+        return [path for item in value for path in _referenced_files(item)]
+    return []
+
+
+def record_request(request: dict):
+    """Append an inference, pipeline or embed request to the recording for load_generator.py.
+    
+    Each line is {"recorded_at", "request", "files"}; referenced files are copied once per
+    content digest into <recording>.files/ so a replay still has the screenshots and audio
+    after the capture loop has overwritten the originals. Control commands are not recorded.
+    """
+    if _request_record_path is None or request.get("command") not in (None, "embed"):
+        return
+    import shutil
+    files = {}
+    for path in dict.fromkeys(_referenced_files(request)):
+        try:
+            name = _file_digest(path) + os.path.splitext(path)[1].lower()
+            target = os.path.join(_request_record_path + ".files", name)
+            if not os.path.exists(target):
+                shutil.copyfile(path, target)
+            files[path] = name
+        except OSError:
+            files[path] = None
+    line = json.dumps({"recorded_at": time.time(), "request": request, "files": files}, ensure_ascii=False)
+    with _request_record_lock:
+        try:
+            with open(_request_record_path, "a", encoding="utf-8") as record_file:
+                record_file.write(line + "\n")
+        except OSError as e:
+            print(f"Could not record request to {_request_record_path}: {e}", file=sys.stderr)
+
+
+def _handle_worker_request(request: dict, params: Dict[str, Any]) -> dict:
+    """Handle one resident-worker request and build its JSON response."""
+    response = {"id": request.get("id")}
+    command = request.get("command")
+    if command == "warmup":
+        start_model_warmup(request.get("model_ids") or [], params, request.get("memory_budget_mb"))
+        response.update({"status": "ok", "readiness": get_warmup_report()})
+    elif command == "status":
+        response.update({
+            "status": "ok",
+            "readiness": get_warmup_report(),
+            "cached_models": list(_model_cache),
+            "threads": get_thread_allocation(),
+            "hardware_profile": _hardware_profile["settings"] if _hardware_profile else None,
+            "compiled_models": _compiled_models,
+            "onnx_models": {key: {"precision": onnx_model["precision"], "threads": onnx_model["threads"]}
+                            for key, onnx_model in _onnx_model_cache.items()}
+        })
+    elif command == "metrics":
+        response.update({"status": "ok", "metrics": format_prometheus_metrics()})
+    elif command == "memory":
+        if request.get("tracemalloc") or request.get("reset_baseline"):
+            import tracemalloc
+            start_memory_tracking(bool(request.get("tracemalloc")) or tracemalloc.is_tracing())
+        response.update({"status": "ok", **get_memory_report(request.get("top", 10))})
+    elif command == "trace":
+        if _trace_events is None:
+            enable_tracing()
+        if request.get("path"):
+            write_chrome_trace(request["path"])
+        response.update({"status": "ok", "summary": format_trace_summary()})
+        if request.get("reset"):
+            enable_tracing()
+    elif command == "embed":
+        request_params = dict(params)
+        request_params.update(request.get("params") or {})
+        request_params.update({
+            "embedding_index": request["index"],
+            "embedding_action": request.get("action", "add"),
+            "top_k": request.get("top_k", params.get("top_k", 5))
+        })
+        output = run_embedding(request["model_id"], request.get("input", ""), request_params, request.get("local_model_path"),
+                               items=request.get("items"), metadata=request.get("metadata"))
+        if output.startswith("ERROR:"):
+            response.update({"status": "error", "error": output})
+        else:
+            response.update({"status": "ok", **json.loads(output)})
+    elif "pipeline" in request:
+        request_params = dict(params)
+        request_params.update(request.get("params") or {})
+        response.update(execute_pipeline(load_pipeline_spec(request["pipeline"]), request_params))
+    elif "model_id" in request:
+        request_params = dict(params)
+        request_params.update(request.get("params") or {})
+        response.update(run_model_with_envelope(request["model_id"], request.get("input", ""), request_params, request.get("local_model_path")))
+    else:
+        response.update({"status": "error", "error": f"Unrecognized request: {sorted(request)}"})
+    return response
+
+
+def write_stdout_bytes(payload: bytes):
+    """Write bytes straight to the binary stdout buffer; writes from concurrent threads never interleave."""
+    with _stdout_lock:
+        sys.stdout.flush()
+        stdout_buffer = getattr(sys.stdout, "buffer", None)
+        if stdout_buffer is None:
+            # Wrapped stdout without a binary buffer (Windows codecs writer): it encodes UTF-8 itself
+            sys.stdout.write(payload.decode("utf-8"))
+            sys.stdout.flush()
+        else:
+            stdout_buffer.write(payload)
+            stdout_buffer.flush()
+
+
+def build_result_envelope(result: str) -> dict:
+    """JSON envelope for a runner result: a status field instead of the "ERROR: " text prefix."""
+    if result.startswith("ERROR:"):
+        return {"status": "error", "error": result[len("ERROR:"):].strip()}
+    return {"status": "ok", "output": result}
+
+
+def encode_result(envelope: Dict[str, Any], output_format: str = "text") -> bytes:
+    """Encode a result envelope for stdout once, as UTF-8, without lossy conversions.
+    
+    text/framed carry the output (or "ERROR: <error>"); json carries the whole envelope.
+    framed: b"FRAME <ok|error> <n>\n" followed by exactly n bytes of UTF-8 payload (no terminator),
+    so outputs containing newlines or arbitrary text can be read back by byte count.
+    """
+    if output_format == "json":
+        return (json.dumps(envelope, ensure_ascii=False) + "\n").encode("utf-8")
+    text = envelope["output"] if envelope["status"] == "ok" else f"ERROR: {envelope['error']}"
+    payload = text.encode("utf-8", errors="replace")
+    if output_format == "framed":
+        return f"FRAME {envelope['status']} {len(payload)}\n".encode("ascii") + payload
+    return payload + b"\n"
+
+
+def _write_worker_response(response: dict):
+    """Write one JSON response line; responses of concurrent requests never interleave."""
+    write_stdout_bytes((json.dumps(response, ensure_ascii=False) + "\n").encode("utf-8"))
+
+
+def _serve_one_request(request: dict, params: Dict[str, Any]):
+    """Handle a worker request on a request thread and write its response."""
+    with _metrics_lock:
+        _worker_queue_state["queued"] -= 1
+        _worker_queue_state["in_flight"] += 1
+    try:
+        command = request.get("command") or ("pipeline" if "pipeline" in request else "inference")
+        with trace_span("request", "request", id=request.get("id"), command=command), track_request_memory(request.get("id"), command):
+            response = _handle_worker_request(request, params)
+    except Exception as e:
+        response = {"id": request.get("id"), "status": "error", "error": str(e)}
+    finally:
+        with _metrics_lock:
+            _worker_queue_state["in_flight"] -= 1
+    _write_worker_response(response)
+
+
+def serve_requests(params: Dict[str, Any]) -> int:
+    """Resident worker loop: one JSON request per stdin line, one JSON response per stdout line.
+    
+    Models, tokenizers and memoized node outputs stay in memory between requests, so a pipeline
+    tick costs one round-trip instead of one process launch per node. Requests are handled
+    concurrently on the scheduler's worker count; responses carry the request "id" and may
+    arrive out of order.
+    """
+    apply_thread_split()
+    allocation = get_thread_allocation()
+    if _memory_baseline is None:
+        start_memory_tracking(trace_allocations=False)
+    print(f"Worker ready ({allocation['workers']} workers, {allocation.get('torch_num_threads', allocation['intra_op_threads'])} torch threads)", file=sys.stderr, flush=True)
+    shutdown_id = None
+    with ThreadPoolExecutor(max_workers=allocation["workers"], thread_name_prefix="request") as request_executor:
+        for line in sys.stdin:
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                request = json.loads(line)
+            except json.JSONDecodeError as e:
+                _write_worker_response({"id": None, "status": "error", "error": f"Invalid JSON request: {e}"})
+                continue
+            if request.get("command") == "shutdown":
+                shutdown_id = request.get("id")
+                break
+            record_request(request)
+            with _metrics_lock:
+                _worker_queue_state["queued"] += 1
+            request_executor.submit(_serve_one_request, request, params)
+    # In-flight requests finish before the shutdown acknowledgement; queued warm-ups are dropped
+    stop_model_warmup()
+    _write_worker_response({"id": shutdown_id, "status": "ok", "command": "shutdown"})
+    return 0
 
 
 def main() -> int:
@@ -1447,10 +5233,32 @@ def main() -> int:
         
         # Skip verbose logging in fast mode for speed
         if not args.fast_mode:
-            print(f"Setting up environment for model: {args.model_id}", file=sys.stderr)
+            print(f"Setting up environment for model: {args.model_id or 'pipeline'}", file=sys.stderr)
+        
+        # Resource locations and the thread split must be known before transformers/torch are imported
+        configure_resource_dirs(args.cache_dir, args.audio_output_dir)
+        configure_vision_embedding_cache(args.vision_cache_mb)
+        if args.compile != "off":
+            configure_compile_cache()
+        # Tuned threads/workers fill in whatever was not given explicitly
+        tuned = (load_hardware_profile(args.auto_tune) or {}).get("settings", {})
+        configure_inference_scheduler(args.inference_workers or tuned.get("workers"), args.intra_op_threads,
+                                      args.inter_op_threads or tuned.get("inter_op_threads"), args.model_concurrency,
+                                      tuned_intra_op_threads=tuned.get("intra_op_threads"))
+        
+        if args.trace:
+            enable_tracing()
+        if args.record_requests:
+            enable_request_recording(args.record_requests)
+        if args.metrics_port is not None:
+            start_metrics_server(args.metrics_port)
+        if args.metrics_file:
+            start_metrics_file_writer(args.metrics_file, args.metrics_interval)
         
         # Environment setup with caching
-        if not setup_environment():
+        with trace_span("setup_environment"):
+            environment_ready = setup_environment()
+        if not environment_ready:
             print("ERROR: Failed to set up Python environment", file=sys.stderr)
             return 1
         
@@ -1462,16 +5270,49 @@ def main() -> int:
             "trust_remote_code": args.trust_remote_code,
             "cpu_optimize": args.cpu_optimize,
             "offline_mode": args.offline_mode,
-            "fast_mode": args.fast_mode
+            "fast_mode": args.fast_mode,
+            "draft_model_id": args.draft_model_id,
+            "max_input_tokens": args.max_input_tokens,
+            "max_image_side": args.max_image_side,
+            "phash_threshold": args.phash_threshold,
+            "phash_max_age": args.phash_max_age,
+            "session_id": args.session_id,
+            "vision_roi": args.vision_roi,
+            "roi_max_fraction": args.roi_max_fraction,
+            "roi_refresh_frames": args.roi_refresh_frames,
+            "stop_sequences": args.stop,
+            "response_format": args.response_format,
+            "json_schema": args.json_schema,
+            "embedding_index": args.embedding_index,
+            "embedding_action": args.embedding_action,
+            "top_k": args.top_k,
+            "compile": args.compile,
+            "backend": args.backend,
+            "onnx_precision": args.onnx_precision,
+            "onnx_threads": args.onnx_threads,
+            "cpu_dtype": args.cpu_dtype
         }
         
-        # Pre-load models if specified (for batch processing optimization)
-        if hasattr(args, 'preload_models') and args.preload_models:
-            if not preload_models(args.preload_models, params):
-                print("WARNING: Some models failed to preload", file=sys.stderr)
+        # Warm-up only pays off in the resident worker; a one-shot process would exit before using the models
+        if args.preload_models and args.serve:
+            start_model_warmup(args.preload_models, params, args.warmup_memory_budget_mb, args.warmup_workers)
+        elif args.preload_models:
+            print("--preload_models only applies with --serve; ignoring it for this one-shot request", file=sys.stderr)
+        
+        # Resident worker and whole-pipeline modes keep everything in this process
+        if args.serve and args.track_memory:
+            start_memory_tracking()
+        if args.serve:
+            return serve_requests(params)
+        if args.pipeline:
+            pipeline = load_pipeline_spec(args.pipeline)
+            record_request({"pipeline": pipeline, "params": params})
+            pipeline_result = execute_pipeline(pipeline, params)
+            write_stdout_bytes((json.dumps(pipeline_result, ensure_ascii=False) + "\n").encode("utf-8"))
+            return 0 if pipeline_result["status"] == "ok" else 1
         
         # Skip expensive cache validation in fast mode
-        if not args.local_model_path or not (os.path.exists(args.local_model_path) and os.listdir(args.local_model_path)):
+        if args.model_id and not resolve_model_path(args.model_id, args.local_model_path)[1]:
             if not args.fast_mode:
                 # Only do cache validation in non-fast mode
                 cache_valid = check_model_cache_status(args.model_id)
@@ -1480,56 +5321,18 @@ def main() -> int:
                     # Don't fail if download fails - let the model loading handle it
                     force_download_model(args.model_id)
         
-        # Detect model type once
-        model_type = detect_model_type(args.model_id)
+        record_request({"model_id": args.model_id, "input": args.input, "local_model_path": args.local_model_path, "params": params})
         
-        # Pre-build params dict to avoid repeated dict creation
-        params = {
-            "max_length": args.max_length,
-            "temperature": args.temperature,
-            "top_p": args.top_p,
-            "trust_remote_code": args.trust_remote_code,
-            "cpu_optimize": args.cpu_optimize,
-            "offline_mode": args.offline_mode,
-            "fast_mode": args.fast_mode
-        }
-        
-        # Preload models if specified
-        if args.preload_models:
-            preload_success = preload_models(args.preload_models, params)
-            if not preload_success:
-                print("ERROR: Failed to preload specified models", file=sys.stderr)
-                return 1
-        
-        # Direct dispatch for performance
-        if model_type == "vision-language":
-            result = run_vision_language(args.model_id, args.input, params, args.local_model_path)
-        elif model_type == "text-generation":
-            result = run_text_generation(args.model_id, args.input, params, args.local_model_path)
-        elif model_type == "automatic-speech-recognition":
-            result = run_speech_recognition(args.model_id, args.input, params, args.local_model_path)
-        elif model_type == "image-to-text":
-            result = run_image_to_text(args.model_id, args.input, params, args.local_model_path)
-        elif model_type == "text-to-speech":
-            result = run_text_to_speech(args.model_id, args.input, params, args.local_model_path)
+        # Direct dispatch for performance; the envelope carries status, timings, tokens and peak memory
+        if args.profile:
+            envelope = profile_model_runs(args.model_id, args.input, params, args.local_model_path, args.profile, args.profile_dir)
+            print(format_profile_summary(envelope["profile"]), file=sys.stderr)
         else:
-            # Fast fallback for unknown types
-            result = f"Model type '{model_type}' not fully implemented yet. Basic response: Processed '{args.input}' with {args.model_id}"
-        
-        # Minimal output processing for speed
-        clean_result = result.strip() if result else "No output generated"
+            envelope = run_model_with_envelope(args.model_id, args.input, params, args.local_model_path)
         
-        # Handle Unicode encoding issues on Windows by encoding to UTF-8 and handling errors gracefully
-        try:
-            # Try to encode to detect and handle Unicode issues
-            encoded_result = clean_result.encode('utf-8', errors='replace').decode('utf-8')
-            # Remove or replace problematic Unicode characters for Windows console compatibility
-            safe_result = encoded_result.encode('ascii', errors='replace').decode('ascii')
-            print(safe_result, flush=True)
-        except UnicodeError:
-            # Fallback: Remove all non-ASCII characters
-            safe_result = ''.join(char for char in clean_result if ord(char) < 128)
-            print(safe_result, flush=True)
+        # UTF-8 straight to the binary stdout buffer: one encode, no ASCII replacement of non-English text
+        with trace_span("output"):
+            write_stdout_bytes(encode_result(envelope, args.output_format))
         return 0
         
     except KeyboardInterrupt:
@@ -1538,10 +5341,33 @@ def main() -> int:
     except Exception as e:
         error_msg = f"ERROR: {str(e)}"
         print(error_msg, file=sys.stderr)
+        # Structured formats always deliver a parseable result on stdout
+        if getattr(args, 'output_format', 'text') != "text":
+            write_stdout_bytes(encode_result({"status": "error", "error": str(e), "error_class": type(e).__name__}, args.output_format))
         # Skip traceback in fast mode to avoid overhead
         if not getattr(args, 'fast_mode', False):
             traceback.print_exc(file=sys.stderr)
         return 1
+    finally:
+        # Tracing is only enabled once arguments are parsed
+        if _trace_events is not None:
+            print(format_trace_summary(), file=sys.stderr, flush=True)
+        # Tracing can also be switched on by a worker "trace" command, which writes its own file
+        if _trace_events is not None and args.trace:
+            try:
+                write_chrome_trace(args.trace)
+            except OSError as e:
+                print(f"Could not write trace to {args.trace}: {e}", file=sys.stderr)
+
+
+# Runner per detected model type (see run_model)
+_model_runners = {
+    "vision-language": run_vision_language,
+    "text-generation": run_text_generation,
+    "automatic-speech-recognition": run_speech_recognition,
+    "image-to-text": run_image_to_text,
+    "text-to-speech": run_text_to_speech
+}
 
 
 if __name__ == "__main__":
@@ -120,6 +120,7 @@ namespace CSimple.Services
                     Arguments = arguments,
                     RedirectStandardOutput = true,
                     RedirectStandardError = true,
+                    StandardOutputEncoding = Encoding.UTF8, // run_hf_model.py writes UTF-8 bytes to stdout
                     UseShellExecute = false,
                     CreateNoWindow = true,
                     WorkingDirectory = Path.GetDirectoryName(huggingFaceScriptPath)
@@ -224,6 +225,7 @@ namespace CSimple.Services
                     Arguments = arguments,
                     RedirectStandardOutput = true,
                     RedirectStandardError = true,
+                    StandardOutputEncoding = Encoding.UTF8,
                     UseShellExecute = false,
                     CreateNoWindow = true
                 };